@@ -1,22 +1,43 @@
 # app.py
 # -*- coding: utf-8 -*-
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, abort, request, jsonify, send_from_directory
 from flask_cors import CORS
-from functools import wraps
+from functools import partial, wraps
 from dotenv import load_dotenv
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
-import os, requests, re, hmac, hashlib
+import os, re, hmac, hashlib, json, asyncio, inspect
 
-from bots.manager import BotManager
+try:
+    import orjson  # اختياري: تحليل أسرع لأجسام الويبهوكس
+except ImportError:
+    orjson = None
 
 # ================= Load env =================
+# قبل استيراد وحدات المشروع لأنها تقرأ os.getenv عند الاستيراد
 load_dotenv()
+
+from bots.manager import BotManager, BULK_MAX_BOTS, PLATFORMS, RegistryUnavailable
+from bots import tg_bot
+from bots.tg_bot import CONTENT_TYPES as TG_CONTENT_TYPES
+from services.workers import pool
+from services import auth, http_client
+from services.tts import audio_cache
+from services.history import store as history_store
+from services.dedup import dedup
+from services.coalesce import coalescer
+from services import resilience
+from services.outbox import outbox
+from services import reply_cache
+from services import metrics
+from services.aio import runner
+
 SUPABASE_URL         = os.getenv("SUPABASE_URL")
 SUPABASE_ANON_KEY    = os.getenv("SUPABASE_ANON_KEY")
 META_VERIFY_TOKEN    = os.getenv("META_VERIFY_TOKEN", "")
 META_APP_SECRET      = os.getenv("META_APP_SECRET", "")  # optional: HMAC for Meta webhooks
 PUBLIC_BASE          = os.getenv("PUBLIC_BASE", "https://piaaz.com")
+METRICS_TOKEN        = os.getenv("METRICS_TOKEN", "")  # Bearer token for /metrics (unset = route disabled)
 FRONT_ALLOWED_ORIGINS = [
     o.strip() for o in os.getenv(
         "FRONT_ALLOWED_ORIGINS",
@@ -51,6 +72,9 @@ limiter = Limiter(
 
 manager = BotManager()
 
+# فتح اتصالات keep-alive مسبقًا مع المزوّدين يحدث لكل worker بعد fork، لا هنا:
+# gunicorn.conf.py (post_fork)، asgi.py (lifespan startup)، و __main__ أدناه
+
 # ================= Security headers =================
 @app.after_request
 def harden_headers(resp):
@@ -85,30 +109,24 @@ def require_auth(f):
             return jsonify({"error": "Invalid token format"}), 401
 
         try:
-            resp = requests.get(
-                f"{SUPABASE_URL}/auth/v1/user",
-                headers={"Authorization": f"Bearer {token}", "apikey": SUPABASE_ANON_KEY},
-                timeout=10
-            )
-        except requests.RequestException:
+            claims = auth.verify_token(token)
+        except auth.AuthUnavailable:
             return jsonify({"error": "Auth server not reachable"}), 503
 
-        if resp.status_code != 200:
+        if claims is None:
             return jsonify({"error": "Invalid or expired token"}), 401
         return f(*args, **kwargs)
     return decorated
 
 # ================= Optional: verify Meta signature =================
-def verify_meta_signature() -> bool:
+def valid_meta_signature(body: bytes, sig: str) -> bool:
     """يتحقق من X-Hub-Signature-256 إذا ضبّطت META_APP_SECRET."""
     if not META_APP_SECRET:
         return True
-    sig = request.headers.get("X-Hub-Signature-256", "")
-    if not sig.startswith("sha256="):
+    if not sig or not sig.startswith("sha256="):
         return False
     provided = sig.split("=", 1)[1]
-    body = request.get_data() or b""
-    expected = hmac.new(META_APP_SECRET.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    expected = hmac.new(META_APP_SECRET.encode("utf-8"), body or b"", hashlib.sha256).hexdigest()
     return hmac.compare_digest(provided, expected)
 
 # ================= Protected API =================
@@ -125,7 +143,7 @@ def activate():
     data = request.get_json(force=True, silent=True)
     if not isinstance(data, dict):
         return jsonify({"error": "invalid payload"}), 400
-    if data.get("platform") not in ("telegram", "whatsapp", "instagram"):
+    if data.get("platform") not in PLATFORMS:
         return jsonify({"error": "unsupported platform"}), 400
     bot_id = manager.create(data)
     return jsonify({"ok": True, "id": bot_id})
@@ -151,10 +169,121 @@ def restart_bot(bot_id):
 @require_auth
 @limiter.limit("20/minute")
 def delete_bot(bot_id):
-    manager.stop(bot_id)
-    manager.bots_meta.pop(bot_id, None)
+    manager.delete(bot_id)
     return jsonify({"ok": True})
 
+# ================= Bulk API =================
+# دفعة كاملة تُرفض (400) إذا فشل التحقق من أي عنصر، و 503 إذا رفض السجل الكتابة (لم يتغير شيء)؛
+# وإلا 202 ونتيجة لكل بوت بنفس الترتيب: الويبهوك/الاشتراك يكمل في الخلفية (webhook_ok في GET /api/bots)
+def _bulk_items(field: str):
+    data = request.get_json(force=True, silent=True)
+    items = data.get(field) if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return None, f"'{field}' must be a non-empty list"
+    if len(items) > BULK_MAX_BOTS:
+        return None, f"at most {BULK_MAX_BOTS} bots per request"
+    return items, None
+
+def _bulk_invalid(errors: list):
+    return jsonify({"error": "validation failed", "errors": errors}), 400
+
+@app.post("/api/bots/bulk/activate")
+@require_auth
+@limiter.limit("5/minute")
+def bulk_activate():
+    items, err = _bulk_items("bots")
+    if err:
+        return jsonify({"error": err}), 400
+    errors, seen = [], set()
+    for i, meta in enumerate(items):
+        if not isinstance(meta, dict):
+            errors.append({"index": i, "error": "invalid payload"})
+            continue
+        reason = manager.validate(meta, seen)
+        if reason:
+            errors.append({"index": i, "id": meta.get("id"), "error": reason})
+    if errors:
+        return _bulk_invalid(errors)
+    return jsonify({"ok": True, "results": manager.create_many(items)}), 202
+
+@app.post("/api/bots/bulk/update")
+@require_auth
+@limiter.limit("5/minute")
+def bulk_update():
+    items, err = _bulk_items("bots")
+    if err:
+        return jsonify({"error": err}), 400
+    errors, seen = [], set()
+    for i, upd in enumerate(items):
+        bot_id = upd.get("id") if isinstance(upd, dict) else None
+        if not isinstance(bot_id, str) or not bot_id:
+            reason = "missing id"
+        elif bot_id in seen:
+            reason = "duplicate id"
+        elif "platform" in upd and upd["platform"] not in PLATFORMS:
+            reason = "unsupported platform"
+        elif any(k in upd and not isinstance(upd[k], dict) for k in ("company", "creds")):
+            reason = "company/creds must be objects"
+        else:
+            seen.add(bot_id)
+            continue
+        errors.append({"index": i, "id": bot_id, "error": reason})
+    if errors:
+        return _bulk_invalid(errors)
+    updates = [(u["id"], {k: v for k, v in u.items() if k != "id"}) for u in items]
+    return jsonify({"ok": True, "results": manager.update_many(updates)}), 202
+
+@app.post("/api/bots/bulk/delete")
+@require_auth
+@limiter.limit("5/minute")
+def bulk_delete():
+    ids, err = _bulk_items("ids")
+    if err:
+        return jsonify({"error": err}), 400
+    errors = [{"index": i, "error": "invalid id"} for i, bot_id in enumerate(ids)
+              if not isinstance(bot_id, str) or not bot_id]
+    if errors:
+        return _bulk_invalid(errors)
+    return jsonify({"ok": True, "results": manager.delete_many(ids)}), 202
+
+# إحصائيات تشغيلية (عمق الطابور، استغلال الثريدات...) لضبط الأحجام
+@app.get("/api/stats")
+@require_auth
+@limiter.limit("30/minute")
+def stats():
+    return jsonify({
+        "workers": {**pool.stats(), "longest_queues": pool.queue_lengths()},
+        "auth": auth.stats(),
+        "http": http_client.stats(),
+        "routing": manager.routing_stats(),
+        "tts_cache": audio_cache.stats(),
+        "history": history_store.stats(),
+        "dedup": dedup.stats(),
+        "coalesce": coalescer.stats(),
+        "outbox": outbox.stats(),
+        "reply_cache": reply_cache.stats(),
+        "aio": runner.stats(),
+    })
+
+# مقاييس Prometheus (text exposition). محمية بـ METRICS_TOKEN، والمسار معطّل (404) إن لم يُضبط:
+# التسميات تكشف معرّفات البوتات وحجم الحركة
+@app.get("/metrics")
+@limiter.exempt
+def prometheus_metrics():
+    if not METRICS_TOKEN:
+        abort(404)
+    provided = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(provided, f"Bearer {METRICS_TOKEN}"):
+        return jsonify({"error": "Unauthorized"}), 401
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+# حالة القواطع (circuit breakers) لكل مزوّد/مفتاح مع آخر التحولات
+@app.get("/api/breakers")
+@require_auth
+@limiter.limit("60/minute")
+def breakers():
+    return jsonify(resilience.snapshot())
+
 # أخطاء موحّدة لمسارات الـ API فقط
 @app.errorhandler(404)
 def not_found(e):
@@ -162,6 +291,10 @@ def not_found(e):
         return jsonify({"error": "not found"}), 404
     return e
 
+@app.errorhandler(RegistryUnavailable)
+def registry_unavailable(e):
+    return jsonify({"error": "bot registry unavailable, nothing was changed"}), 503
+
 @app.errorhandler(405)
 def not_allowed(e):
     if request.path.startswith("/api/"):
@@ -169,19 +302,182 @@ def not_allowed(e):
     return e
 
 # ================= Webhooks (public) =================
+# الويبهوكس ترجع 200 فورًا بعد التحقق، والمعالجة الفعلية في ثريدات services.workers.
+# لو الطابور ممتلئ نرجع 503 حتى يعيد المزوّد الإرسال لاحقًا بدل ضياع الرسالة.
+# كل حدث يُقيَّد بمفتاح المحادثة: رسائل نفس المحادثة بالترتيب، والمحادثات المختلفة بالتوازي.
+def _tg_chat_id(payload: dict):
+    for k in ("message", "edited_message", "channel_post", "callback_query"):
+        obj = payload.get(k)
+        if isinstance(obj, dict):
+            if k == "callback_query":
+                obj = obj.get("message") or {}
+            return (obj.get("chat") or {}).get("id")
+    return None
+
+# إعادة الإرسال من المزوّد (update_id / message id / mid) تُتجاهل قبل الطابور إن رآها هذا الـ worker
+# (ذاكرة فقط، بدون I/O في مسار الـ ack). التكرار عبر الـ workers وبعد إعادة التشغيل تفحصه المهمة
+# نفسها في SQLite (dedup.claim) لكل مفاتيحها دفعة واحدة، وتعالج الجديد فقط.
+# لو رُفضت المهمة (طابور ممتلئ) نلغي التسجيل حتى تُعالَج إعادة الإرسال القادمة.
+def _fresh_payload(field, keys: list, payload: dict, fresh: set):
+    """payload بالعناصر الجديدة فقط (keys بنفس ترتيب payload[field]، None لعنصر بلا معرّف)، أو None."""
+    if field is None:
+        return payload if not keys or keys[0] in fresh else None
+    items = [item for item, k in zip(payload.get(field) or [], keys) if k is None or k in fresh]
+    return {**payload, field: items} if items else None
+
+def _run_claimed(fn, source: str, field, keys: list, state: dict, payload: dict, *args):
+    # state: نتيجة claim تبقى للمحاولات التالية (RetryLater) فلا تُحسب المهمة تكرارًا لنفسها
+    if "fresh" not in state:
+        state["fresh"] = dedup.claim(keys, source)
+    payload = _fresh_payload(field, keys, payload, state["fresh"])
+    if payload is not None:
+        return fn(payload, *args)
+
+async def _arun_claimed(fn, source: str, field, keys: list, state: dict, payload: dict, *args):
+    if "fresh" not in state:
+        state["fresh"] = await asyncio.to_thread(dedup.claim, keys, source)
+    payload = _fresh_payload(field, keys, payload, state["fresh"])
+    if payload is not None:
+        await fn(payload, *args)
+
+def _submit_fresh(source: str, field, dedup_keys: list, fn, payload: dict, *args, key=None,
+                  submit=pool.submit) -> bool:
+    run = _arun_claimed if inspect.iscoroutinefunction(fn) else _run_claimed
+    if submit(partial(run, fn, source, field, dedup_keys, {}), payload, *args, key=key):
+        return True
+    for k in dedup_keys:
+        if k:
+            dedup.forget(k, shared=False)
+    return False
+
+# ----- الفرز (triage) -----
+# الـ body يُقرأ ويُحلَّل مرة واحدة (orjson إن وُجد)، ثم يُصنَّف كل حدث ويُحسب في
+# webhook_events_total{type}. أحداث الحالة (sent/delivered/read) والـ echo والتفاعلات
+# تُؤكَّد بـ 200 مباشرة بدون المرور على المدير أو الطوابير؛ فقط الرسائل تُوجَّه للبوتات.
+def parse_json(raw: bytes) -> dict:
+    try:
+        data = orjson.loads(raw) if orjson else json.loads(raw)
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+def _count_event(platform: str, kind: str, n: int = 1):
+    metrics.inc("webhook_events_total", n, platform=platform, type=kind)
+
+def _tg_update_type(payload: dict) -> str:
+    msg = payload.get("message")
+    if isinstance(msg, dict):
+        return "message" if any(k in msg for k in TG_CONTENT_TYPES) else "unsupported_message"
+    return next((k for k in payload if k != "update_id"), "other")
+
+def _ig_event_type(ev: dict) -> str:
+    message = ev.get("message")
+    if isinstance(message, dict):
+        return "echo" if message.get("is_echo") else "message"
+    for kind in ("reaction", "read", "postback", "delivery"):
+        if kind in ev:
+            return kind
+    return "other"
+
+def _enqueue_whatsapp(data: dict, submit=pool.submit, route=None) -> bool:
+    route = route or manager.route_whatsapp
+    ok = True
+    for entry in (data.get("entry") or []):
+        for ch in (entry.get("changes") or []):
+            value = ch.get("value") or {}
+            statuses = value.get("statuses") or []
+            if statuses:
+                _count_event("whatsapp", "status", len(statuses))
+            grouped, dedup_keys = {}, {}
+            for msg in (value.get("messages") or []):
+                if msg.get("type") == "reaction":
+                    _count_event("whatsapp", "reaction")
+                    continue
+                _count_event("whatsapp", "message")
+                mid = msg.get("id")
+                if mid and not dedup.first_seen(f"wa:{mid}", "whatsapp"):
+                    metrics.inc("webhooks_dropped_total", platform="whatsapp", reason="duplicate")
+                    continue
+                sender = msg.get("from")
+                grouped.setdefault(sender, []).append(msg)
+                dedup_keys.setdefault(sender, []).append(f"wa:{mid}" if mid else None)
+            if not statuses and "messages" not in value:
+                _count_event("whatsapp", "other")
+            # phone_number_id يقابل بوتًا واحدًا، والمرسل يحدد المحادثة: مهمة لكل مرسل بمفتاحه
+            phone_id = (value.get("metadata") or {}).get("phone_number_id")
+            for sender, msgs in grouped.items():
+                ok &= _submit_fresh("whatsapp", "messages", dedup_keys[sender], route, {**value, "messages": msgs},
+                                    key=("wa", phone_id, sender), submit=submit)
+    return ok
+
+def _enqueue_instagram(data: dict, submit=pool.submit, route=None) -> bool:
+    route = route or manager.route_instagram
+    ok = True
+    for entry in (data.get("entry") or []):
+        for ch in (entry.get("changes") or []):
+            value = ch.get("value") or {}
+            grouped, dedup_keys = {}, {}
+            for ev in (value.get("messaging") or []):
+                kind = _ig_event_type(ev)
+                _count_event("instagram", kind)
+                if kind != "message":
+                    continue  # echo لرسائلنا، تفاعلات، قراءة...
+                mid = ev["message"].get("mid")
+                if mid and not dedup.first_seen(f"ig:{mid}", "instagram"):
+                    metrics.inc("webhooks_dropped_total", platform="instagram", reason="duplicate")
+                    continue
+                conv = ((ev.get("recipient") or {}).get("id") or entry.get("id"),
+                        (ev.get("sender") or {}).get("id"))
+                grouped.setdefault(conv, []).append(ev)
+                dedup_keys.setdefault(conv, []).append(f"ig:{mid}" if mid else None)
+            for (rid, sender), evs in grouped.items():
+                ok &= _submit_fresh("instagram", "messaging", dedup_keys[(rid, sender)], route,
+                                    {**value, "messaging": evs}, entry.get("id"), key=("ig", rid, sender),
+                                    submit=submit)
+    return ok
+
+# منطق الاستقبال مفصول عن Flask: asgi.py يستدعي نفس الدوال مع submit/route الخاصة بمسار asyncio.
+# كلها تأخذ الـ body الخام وترجع (body, status).
+def accept_telegram(bot_id: str, raw: bytes, submit=pool.submit, method: str = "process_update"):
+    metrics.inc("webhooks_received_total", platform="telegram")
+    payload = parse_json(raw)
+    kind = _tg_update_type(payload)
+    _count_event("telegram", kind)
+    if kind != "message":
+        return {"ok": True}, 200  # لا handler لهذا النوع في البوت
+    bot = manager.get_bot(bot_id)
+    if not bot or not hasattr(bot, method):
+        metrics.inc("webhooks_dropped_total", platform="telegram", reason="unroutable")
+        return {"error": "bot not found or not ready"}, 404
+    update_id = payload.get("update_id")
+    dedup_key = f"tg:{bot_id}:{update_id}"
+    if update_id is not None and not dedup.first_seen(dedup_key, "telegram"):
+        metrics.inc("webhooks_dropped_total", platform="telegram", reason="duplicate")
+        return {"ok": True, "duplicate": True}, 200
+    if not _submit_fresh("telegram", None, [dedup_key] if update_id is not None else [], getattr(bot, method),
+                         payload, key=("tg", bot_id, _tg_chat_id(payload)), submit=submit):
+        metrics.inc("webhooks_dropped_total", platform="telegram", reason="busy")
+        return {"ok": False, "error": "busy"}, 503
+    metrics.inc("webhooks_routed_total", platform="telegram", bot=bot_id)
+    return {"ok": True}, 200
+
+def accept_meta(platform: str, raw: bytes, signature: str, submit=pool.submit, route=None):
+    metrics.inc("webhooks_received_total", platform=platform)
+    if not valid_meta_signature(raw, signature):
+        metrics.inc("webhooks_dropped_total", platform=platform, reason="bad_signature")
+        return {"error": "invalid signature"}, 401
+    data = parse_json(raw)
+    enqueue = _enqueue_whatsapp if platform == "whatsapp" else _enqueue_instagram
+    if not enqueue(data, submit=submit, route=route):
+        metrics.inc("webhooks_dropped_total", platform=platform, reason="busy")
+        return {"ok": False, "error": "busy"}, 503
+    return {"ok": True}, 200
+
 # Telegram
 @app.post("/webhooks/telegram/<bot_id>")
 def telegram_webhook(bot_id):
-    bot = manager.bots_obj.get(bot_id)
-    if not bot or not hasattr(bot, "process_update"):
-        return jsonify({"error": "bot not found or not ready"}), 404
-    try:
-        payload = request.get_json(force=True, silent=True) or {}
-        bot.process_update(payload)
-        return jsonify({"ok": True})
-    except Exception as e:
-        print("[TG webhook] error:", e)
-        return jsonify({"ok": False}), 500
+    body, status = accept_telegram(bot_id, request.get_data() or b"")
+    return jsonify(body), status
 
 # Meta verification (GET)
 @app.get("/webhooks/meta")
@@ -198,32 +494,16 @@ def meta_verify():
 # WhatsApp
 @app.post("/webhooks/whatsapp")
 def whatsapp_webhook():
-    if not verify_meta_signature():
-        return jsonify({"error": "invalid signature"}), 401
-    data = request.get_json(force=True, silent=True) or {}
-    try:
-        for entry in (data.get("entry") or []):
-            for ch in (entry.get("changes") or []):
-                manager.route_whatsapp(ch.get("value") or {})
-        return jsonify({"ok": True})
-    except Exception as e:
-        print("[WA webhook] error:", e)
-        return jsonify({"ok": False}), 500
+    body, status = accept_meta("whatsapp", request.get_data() or b"",
+                               request.headers.get("X-Hub-Signature-256", ""))
+    return jsonify(body), status
 
 # Instagram
 @app.post("/webhooks/instagram")
 def instagram_webhook():
-    if not verify_meta_signature():
-        return jsonify({"error": "invalid signature"}), 401
-    data = request.get_json(force=True, silent=True) or {}
-    try:
-        for entry in (data.get("entry") or []):
-            for ch in (entry.get("changes") or []):
-                manager.route_instagram(ch.get("value") or {})
-        return jsonify({"ok": True})
-    except Exception as e:
-        print("[IG webhook] error:", e)
-        return jsonify({"ok": False}), 500
+    body, status = accept_meta("instagram", request.get_data() or b"",
+                               request.headers.get("X-Hub-Signature-256", ""))
+    return jsonify(body), status
 
 # ================= Frontend =================
 FRONT = os.path.join(os.path.dirname(__file__), "..", "frontend")
@@ -249,5 +529,7 @@ def health():
 
 if __name__ == "__main__":
     # في الإنتاج (Gunicorn/Render) عادةً ما يُستبدَل بـ gunicorn
+    tg_bot.use_shared_session()
+    http_client.prewarm()
     app.run(host="0.0.0.0", port=5000)
 
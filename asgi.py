@@ -0,0 +1,202 @@
+# asgi.py
+# -*- coding: utf-8 -*-
+"""
+نقطة دخول ASGI (مسار asyncio):
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8000
+
+- POST /webhooks/telegram/<bot_id> و /webhooks/whatsapp و /webhooks/instagram:
+  نفس منطق الاستقبال في app.py (تحقق، dedup، 503 عند الامتلاء)، لكن المعالجة
+  (OpenAI / ElevenLabs / الإرسال) تعمل كمهام asyncio في services.aio عبر httpx
+  بدل ثريدات services.workers. آلاف المحادثات المنتظرة لا تحجز ثريدات.
+- بقية المسارات (/api/*، /metrics، الواجهة...) تُمرَّر لتطبيق Flask كما هو عبر
+  محوّل WSGI بسيط في ثريد.
+
+يتطلب httpx و uvicorn (اختياريان؛ gunicorn app:app يبقى المسار المتزامن).
+"""
+import os
+import sys
+import json
+import asyncio
+import logging
+from io import BytesIO
+from typing import List, Optional, Tuple
+from urllib.parse import unquote
+
+import app as flask_app
+from bots import tg_bot
+from services import async_http, http_client
+from services.aio import runner
+from services.coalesce import coalescer
+
+MAX_BODY = flask_app.app.config.get("MAX_CONTENT_LENGTH") or 1024 * 1024
+# عند الإيقاف: أقصى مدة لإكمال الرسائل المقبولة (رُدّ عليها بـ 200) قبل الخروج
+SHUTDOWN_DRAIN_S = float(os.getenv("SHUTDOWN_DRAIN", "25"))
+
+Headers = List[Tuple[bytes, bytes]]
+
+
+async def _read_body(receive) -> Optional[bytes]:
+    """يقرأ الـ body كاملًا، أو None إذا تجاوز MAX_BODY."""
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > MAX_BODY:
+            return None
+        chunks.append(chunk)
+        if not message.get("more_body"):
+            break
+    return b"".join(chunks)
+
+
+async def _send(send, status: int, body: bytes, headers: Headers):
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _send_json(send, status: int, obj: dict):
+    body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+    await _send(send, status, body, [(b"content-type", b"application/json"),
+                                     (b"content-length", str(len(body)).encode())])
+
+
+def _header(scope, name: bytes) -> str:
+    for k, v in scope.get("headers") or []:
+        if k.lower() == name:
+            return v.decode("latin-1")
+    return ""
+
+
+# --------------- الويبهوكس (asyncio) ---------------
+
+async def _webhook(scope, receive, send, path: str) -> bool:
+    """يعالج ويبهوكس المزوّدين؛ يرجع False لو المسار ليس منها."""
+    if path.startswith("/webhooks/telegram/"):
+        bot_id = unquote(path[len("/webhooks/telegram/"):])
+        if not bot_id or "/" in bot_id:
+            return False
+        raw = await _read_body(receive)
+        if raw is None:
+            await _send_json(send, 413, {"error": "payload too large"})
+            return True
+        # الاستقبال يلمس SQLite (dedup/السجل) وقد يبني البوت: في ثريد حتى لا يُحجب الـ loop
+        body, status = await asyncio.to_thread(
+            flask_app.accept_telegram, bot_id, raw, runner.submit_threadsafe, "aprocess_update")
+        await _send_json(send, status, body)
+        return True
+
+    routes = {
+        "/webhooks/whatsapp": ("whatsapp", flask_app.manager.aroute_whatsapp),
+        "/webhooks/instagram": ("instagram", flask_app.manager.aroute_instagram),
+    }
+    if path not in routes:
+        return False
+    platform, route = routes[path]
+    raw = await _read_body(receive)
+    if raw is None:
+        await _send_json(send, 413, {"error": "payload too large"})
+        return True
+    body, status = await asyncio.to_thread(
+        flask_app.accept_meta, platform, raw, _header(scope, b"x-hub-signature-256"),
+        runner.submit_threadsafe, route)
+    await _send_json(send, status, body)
+    return True
+
+
+# --------------- بقية المسارات: Flask عبر WSGI ---------------
+
+def _environ(scope, body: bytes) -> dict:
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for k, v in scope.get("headers") or []:
+        name = k.decode("latin-1").upper().replace("-", "_")
+        value = v.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif name != "CONTENT_LENGTH":
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def _call_wsgi(environ: dict) -> Tuple[int, Headers, bytes]:
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"] = int(status.split(" ", 1)[0])
+        started["headers"] = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]
+
+    result = flask_app.app(environ, start_response)
+    try:
+        body = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return started["status"], started["headers"], body
+
+
+async def _wsgi(scope, receive, send):
+    raw = await _read_body(receive)
+    if raw is None:
+        await _send_json(send, 413, {"error": "payload too large"})
+        return
+    status, headers, body = await asyncio.to_thread(_call_wsgi, _environ(scope, raw))
+    await _send(send, status, body, headers)
+
+
+# --------------- ASGI ---------------
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            runner.bind(asyncio.get_running_loop())
+            # لكل عملية uvicorn (بعد fork عند --workers)
+            tg_bot.use_shared_session()
+            http_client.prewarm()
+            if not async_http.available():
+                logging.warning("httpx is not installed: asyncio webhook processing will fail")
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            # ما في مخزن الدمج وطابور المهام قُبل من المزوّد: نكمله قبل إغلاق الاتصالات
+            coalescer.flush_all()
+            await runner.join(SHUTDOWN_DRAIN_S)
+            await async_http.aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    if runner.loop is None:
+        runner.bind(asyncio.get_running_loop())
+    if scope["method"] == "POST" and await _webhook(scope, receive, send, scope["path"]):
+        return
+    await _wsgi(scope, receive, send)
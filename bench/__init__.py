@@ -0,0 +1,12 @@
+# bench/__init__.py
+# -*- coding: utf-8 -*-
+"""
+أدوات قياس الأداء بدون أي اتصال خارجي:
+  - bench.fakes:   سيرفرات محلية بديلة لـ OpenAI / ElevenLabs / Graph / Telegram
+                   مع توزيع زمن استجابة ونسبة أخطاء قابلة للضبط
+  - bench.loadgen: مولّد حمل يرسل webhooks واقعية (TG/WA/IG) بمعدل ثابت
+                   ويطبع p50/p95/p99 والإنتاجية والذاكرة
+  - bench.run:     سيناريو كامل داخل عملية واحدة (fakes + app.py + loadgen)
+
+    python -m bench.run --rate 50 --duration 30
+"""
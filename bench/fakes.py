@@ -0,0 +1,297 @@
+# bench/fakes.py
+# -*- coding: utf-8 -*-
+"""
+سيرفرات HTTP محلية تحاكي المزوّدين الخارجيين (stdlib فقط):
+  openai   POST .../chat/completions        (JSON أو SSE عند stream=true)
+  eleven   POST .../text-to-speech/<voice>  (بايتات ogg وهمية)
+  graph    POST /<ver>/<id>/messages | /media | /subscribed_apps
+  telegram POST /bot<token>/<method>        (sendMessage, editMessageText, sendVoice, setWebhook...)
+
+كل سيرفر له توزيع زمن استجابة ونسبة أخطاء (429 مع Retry-After أو 500):
+    fixed:0.2 | uniform:0.1:0.6 | lognormal:<median>:<sigma> | 0
+
+تشغيل منفصل (مثلًا أمام gunicorn):
+    python -m bench.fakes --openai-latency lognormal:0.8:0.4 --error-rate 0.02
+"""
+import os
+import json
+import math
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+from urllib.parse import parse_qs
+
+SERVICES = ("openai", "eleven", "graph", "telegram")
+
+DEFAULT_LATENCY = {
+    "openai": "lognormal:0.8:0.4",
+    "eleven": "lognormal:0.6:0.3",
+    "graph": "lognormal:0.12:0.3",
+    "telegram": "lognormal:0.08:0.3",
+}
+
+FAKE_REPLY = "أهلًا بك! دوامنا من 9 صباحًا حتى 6 مساءً، ويسعدنا تواصلك معنا على الرقم المذكور."
+
+
+class Latency:
+    """يولّد زمن انتظار حسب المواصفة النصية."""
+
+    def __init__(self, spec: str):
+        self.spec = spec or "0"
+        parts = self.spec.split(":")
+        self.kind = parts[0]
+        self.args = [float(x) for x in parts[1:]]
+        if self.kind not in ("0", "fixed", "uniform", "lognormal"):
+            raise ValueError(f"unknown latency spec: {spec}")
+
+    def sample(self) -> float:
+        if self.kind == "fixed":
+            return self.args[0]
+        if self.kind == "uniform":
+            return random.uniform(self.args[0], self.args[1])
+        if self.kind == "lognormal":
+            median, sigma = self.args[0], (self.args[1] if len(self.args) > 1 else 0.5)
+            return random.lognormvariate(math.log(max(median, 1e-6)), sigma)
+        return 0.0
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, service: str, port: int = 0, latency: str = "0", error_rate: float = 0.0,
+                 stream_chunks: int = 12):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.service = service
+        self.latency = Latency(latency)
+        self.error_rate = error_rate
+        self.stream_chunks = stream_chunks
+        self.counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, what: str) -> int:
+        with self._lock:
+            self.counts[what] = self.counts.get(what, 0) + 1
+            self._seq += 1
+            return self._seq
+
+    def start(self) -> "FakeServer":
+        self._thread = threading.Thread(target=self.serve_forever, name=f"fake-{self.service}", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: FakeServer
+
+    def log_message(self, fmt, *args):
+        pass
+
+    # --------------- أدوات ---------------
+
+    def _body(self) -> bytes:
+        if "chunked" in (self.headers.get("Transfer-Encoding") or "").lower():
+            # رفع بالبث (ELEVEN_STREAM_UPLOAD)
+            out = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0].strip() or b"0", 16)
+                if not size:
+                    self.rfile.readline()
+                    return b"".join(out)
+                out.append(self.rfile.read(size))
+                self.rfile.readline()
+        n = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(n) if n else b""
+
+    def _json_body(self) -> dict:
+        try:
+            return json.loads(self._body() or b"{}")
+        except ValueError:
+            return {}
+
+    def _send(self, status: int, body: bytes, ctype: str = "application/json", headers: Optional[dict] = None):
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _json(self, obj, status: int = 200, headers: Optional[dict] = None):
+        self._send(status, json.dumps(obj, ensure_ascii=False).encode("utf-8"), headers=headers)
+
+    def _maybe_fail(self, route: str) -> bool:
+        if self.server.error_rate and random.random() < self.server.error_rate:
+            self.server.count(f"{route}:error")
+            throttled = random.random() < 0.5
+            if self.server.service == "telegram":
+                # نفس شكل أخطاء Bot API (ok/error_code/parameters) حتى يصنّفها outbox كمؤقتة
+                if throttled:
+                    self._json({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                "parameters": {"retry_after": 1}}, 429, {"Retry-After": "1"})
+                else:
+                    self._json({"ok": False, "error_code": 500, "description": "Internal Server Error"}, 500)
+            elif throttled:
+                self._json({"error": "rate limited"}, 429, {"Retry-After": "1"})
+            else:
+                self._json({"error": "internal"}, 500)
+            return True
+        return False
+
+    # --------------- التوجيه ---------------
+
+    def do_GET(self):
+        self._body()
+        self._json({"ok": True, "service": self.server.service})
+
+    def do_POST(self):
+        path, _, qs = self.path.partition("?")
+        srv = self.server
+        if srv.service == "telegram" and path.startswith("/bot"):
+            route = path.rsplit("/", 1)[-1]
+        elif srv.service == "openai":
+            route = "chat"
+        elif srv.service == "eleven":
+            route = "tts"
+        else:
+            route = path.rsplit("/", 1)[-1]
+
+        if srv.service == "openai":
+            req = self._json_body()
+        elif route in ("media", "sendVoice"):
+            self._body()  # multipart: لا نحتاج محتواه
+            req = {}
+        else:
+            req = self._json_body()
+        if qs:
+            # telebot يرسل المعاملات في query string
+            req = {**{k: v[-1] for k, v in parse_qs(qs).items()}, **req}
+
+        time.sleep(srv.latency.sample())
+        if self._maybe_fail(route):
+            return
+        seq = srv.count(route)
+
+        if srv.service == "openai":
+            return self._openai(req)
+        if srv.service == "eleven":
+            return self._send(200, b"OggS" + os.urandom(4096), "audio/ogg")
+        if srv.service == "telegram":
+            return self._telegram(route, req, seq)
+        return self._graph(route, seq)
+
+    def _openai(self, req: dict):
+        if not req.get("stream"):
+            return self._json({
+                "id": "chatcmpl-bench",
+                "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": FAKE_REPLY},
+                             "finish_reason": "stop"}],
+            })
+        words = FAKE_REPLY.split(" ")
+        n = max(1, min(self.server.stream_chunks, len(words)))
+        step = math.ceil(len(words) / n)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def chunk(data: bytes):
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+        for i in range(0, len(words), step):
+            piece = " ".join(words[i:i + step]) + (" " if i + step < len(words) else "")
+            event = {"choices": [{"index": 0, "delta": {"content": piece}}]}
+            chunk(b"data: " + json.dumps(event, ensure_ascii=False).encode("utf-8") + b"\n\n")
+            time.sleep(0.02)
+        chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _telegram(self, method: str, req: dict, seq: int):
+        if method in ("sendMessage", "editMessageText", "sendVoice"):
+            chat_id = req.get("chat_id") or 0
+            try:
+                chat_id = int(chat_id)
+            except (TypeError, ValueError):
+                chat_id = 0
+            return self._json({"ok": True, "result": {
+                "message_id": req.get("message_id") or seq,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": req.get("text", ""),
+            }})
+        return self._json({"ok": True, "result": True})
+
+    def _graph(self, route: str, seq: int):
+        if route == "messages":
+            return self._json({"messaging_product": "whatsapp", "messages": [{"id": f"wamid.bench{seq}"}],
+                               "recipient_id": "bench", "message_id": f"m_bench{seq}"})
+        if route == "media":
+            return self._json({"id": f"media-{seq}"})
+        return self._json({"success": True})
+
+
+def start_all(latency: Optional[Dict[str, str]] = None, error_rate: float = 0.0,
+              error_rates: Optional[Dict[str, float]] = None) -> Dict[str, FakeServer]:
+    latency = {**DEFAULT_LATENCY, **(latency or {})}
+    error_rates = error_rates or {}
+    return {
+        s: FakeServer(s, latency=latency[s], error_rate=error_rates.get(s, error_rate)).start()
+        for s in SERVICES
+    }
+
+
+def env_for(servers: Dict[str, FakeServer]) -> Dict[str, str]:
+    """متغيرات البيئة التي توجّه app.py إلى السيرفرات المحلية."""
+    return {
+        "OPENAI_API_BASE": servers["openai"].base_url + "/v1/chat/completions",
+        "ELEVEN_API_BASE": servers["eleven"].base_url + "/v1/text-to-speech",
+        "GRAPH_API_BASE": servers["graph"].base_url + "/v19.0",
+        "TELEGRAM_API_BASE": servers["telegram"].base_url,
+        "HTTP_PREWARM": "",
+    }
+
+
+def counts(servers: Dict[str, FakeServer]) -> Dict[str, Dict[str, int]]:
+    out = {}
+    for name, s in servers.items():
+        with s._lock:
+            out[name] = dict(s.counts)
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Local stand-ins for OpenAI / ElevenLabs / Graph / Telegram")
+    for s in SERVICES:
+        ap.add_argument(f"--{s}-latency", default=DEFAULT_LATENCY[s])
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    args = ap.parse_args()
+
+    servers = start_all({s: getattr(args, f"{s}_latency") for s in SERVICES}, args.error_rate)
+    for k, v in env_for(servers).items():
+        print(f"export {k}={v}")
+    try:
+        while True:
+            time.sleep(10)
+            print(json.dumps(counts(servers)), flush=True)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+# bench/loadgen.py
+# -*- coding: utf-8 -*-
+"""
+مولّد حمل للـ webhooks: يرسل payloads واقعية لـ Telegram / WhatsApp / Instagram
+بمعدل ثابت (open-loop: موعد كل طلب محدد مسبقًا، فالتأخير يُحسب من الموعد لا من
+لحظة الإرسال، ولا يخفي بطء السيرفر) ويطبع p50/p95/p99 والإنتاجية والذاكرة.
+
+    python -m bench.loadgen --url http://127.0.0.1:8000 --rate 100 --duration 30 \\
+        --tg-bots bot_a,bot_b --wa-phones 1001,1002 --ig-ids 2001 --pid 12345
+"""
+import os
+import json
+import time
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import requests
+
+TEXTS = [
+    "كم السعر؟", "وين موقعكم", "متى تفتحون", "السلام عليكم", "مرحبا",
+    "هل عندكم توصيل للرياض؟", "أبغى أحجز موعد بكرة الساعة 5",
+    "كم مدة التوصيل", "هل يوجد خصم للطلاب", "شكراً جزيلاً",
+    "عندي مشكلة في الطلب رقم 48213 ما وصلني لحد الآن", "ممكن رقم التواصل؟",
+]
+
+
+# --------------- payloads ---------------
+
+class Payloads:
+    """يبني webhooks بنفس شكل المزوّدين، بمعرّفات فريدة حتى لا يعتبرها dedup تكرارًا."""
+
+    def __init__(self, users: int = 500, seed: Optional[int] = None):
+        self.users = users
+        self.rng = random.Random(seed)
+        self._seq = int(time.time() * 1000) % 10**9
+        self._lock = threading.Lock()
+
+    def _next(self) -> int:
+        with self._lock:
+            self._seq += 1
+            return self._seq
+
+    def telegram(self, bot_id: str) -> dict:
+        n = self._next()
+        chat_id = 700000000 + self.rng.randrange(self.users)
+        return {
+            "update_id": n,
+            "message": {
+                "message_id": n,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private", "first_name": "Bench"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+                "text": self.rng.choice(TEXTS),
+            },
+        }
+
+    def whatsapp(self, phone_id: str) -> dict:
+        n = self._next()
+        wa_user = str(966500000000 + self.rng.randrange(self.users))
+        return {
+            "object": "whatsapp_business_account",
+            "entry": [{
+                "id": "bench-waba",
+                "changes": [{
+                    "field": "messages",
+                    "value": {
+                        "messaging_product": "whatsapp",
+                        "metadata": {"display_phone_number": "966110000000", "phone_number_id": phone_id},
+                        "contacts": [{"profile": {"name": "Bench"}, "wa_id": wa_user}],
+                        "messages": [{
+                            "from": wa_user,
+                            "id": f"wamid.bench.{n}",
+                            "timestamp": str(int(time.time())),
+                            "type": "text",
+                            "text": {"body": self.rng.choice(TEXTS)},
+                        }],
+                    },
+                }],
+            }],
+        }
+
+    def instagram(self, ig_id: str) -> dict:
+        n = self._next()
+        sender = str(17840000000000 + self.rng.randrange(self.users))
+        return {
+            "object": "instagram",
+            "entry": [{
+                "id": ig_id,
+                "time": int(time.time() * 1000),
+                "changes": [{
+                    "field": "messages",
+                    "value": {
+                        "messaging": [{
+                            "sender": {"id": sender},
+                            "recipient": {"id": ig_id},
+                            "timestamp": int(time.time() * 1000),
+                            "message": {"mid": f"m_bench.{n}", "text": self.rng.choice(TEXTS)},
+                        }],
+                    },
+                }],
+            }],
+        }
+
+
+# --------------- القياس ---------------
+
+def percentile(sorted_vals: List[float], p: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    k = min(len(sorted_vals) - 1, max(0, int(round(p / 100.0 * (len(sorted_vals) - 1)))))
+    return sorted_vals[k]
+
+
+def read_memory(pid: Optional[int] = None) -> Dict[str, float]:
+    """RSS الحالي والأقصى (MB) من /proc (لينكس)."""
+    path = f"/proc/{pid or 'self'}/status"
+    out: Dict[str, float] = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    key = "rss_mb" if line.startswith("VmRSS") else "peak_rss_mb"
+                    out[key] = round(int(line.split()[1]) / 1024.0, 1)
+    except OSError:
+        pass
+    return out
+
+
+class LoadGen:
+    def __init__(self, url: str, rate: float, duration: float, targets: Dict[str, List[str]],
+                 mix: Optional[Dict[str, float]] = None, concurrency: int = 64, users: int = 500,
+                 seed: Optional[int] = None):
+        self.url = url.rstrip("/")
+        self.rate = rate
+        self.duration = duration
+        self.targets = {k: v for k, v in targets.items() if v}
+        if not self.targets:
+            raise ValueError("no target bots (tg-bots / wa-phones / ig-ids)")
+        mix = {k: w for k, w in (mix or {p: 1.0 for p in self.targets}).items() if k in self.targets}
+        self.platforms = list(mix)
+        self.weights = [mix[p] for p in self.platforms]
+        self.concurrency = concurrency
+        self.payloads = Payloads(users, seed)
+        self.rng = random.Random(seed)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = {p: [] for p in self.platforms}
+        self.statuses: Dict[str, int] = {}
+        self.lag_max = 0.0
+
+    def _session(self) -> requests.Session:
+        s = getattr(self._local, "s", None)
+        if s is None:
+            s = self._local.s = requests.Session()
+        return s
+
+    def _request(self, platform: str) -> tuple:
+        target = self.rng.choice(self.targets[platform])
+        if platform == "telegram":
+            return f"{self.url}/webhooks/telegram/{target}", self.payloads.telegram(target)
+        if platform == "whatsapp":
+            return f"{self.url}/webhooks/whatsapp", self.payloads.whatsapp(target)
+        return f"{self.url}/webhooks/instagram", self.payloads.instagram(target)
+
+    def _fire(self, platform: str, url: str, body: bytes, scheduled: float):
+        try:
+            r = self._session().post(url, data=body, headers={"Content-Type": "application/json"}, timeout=30)
+            status = str(r.status_code)
+        except requests.RequestException as e:
+            status = type(e).__name__
+        took = time.monotonic() - scheduled
+        with self._lock:
+            self.latencies[platform].append(took)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def run(self) -> dict:
+        total = int(self.rate * self.duration)
+        interval = 1.0 / self.rate
+        t0 = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="loadgen") as ex:
+            for i in range(total):
+                scheduled = t0 + i * interval
+                delay = scheduled - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    self.lag_max = max(self.lag_max, -delay)
+                platform = self.rng.choices(self.platforms, self.weights)[0]
+                url, payload = self._request(platform)
+                body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                ex.submit(self._fire, platform, url, body, scheduled)
+        return self.report(time.monotonic() - t0)
+
+    def report(self, elapsed: float) -> dict:
+        def summary(vals: List[float]) -> dict:
+            vals = sorted(vals)
+            return {
+                "count": len(vals),
+                "p50_ms": round(percentile(vals, 50) * 1000, 1),
+                "p95_ms": round(percentile(vals, 95) * 1000, 1),
+                "p99_ms": round(percentile(vals, 99) * 1000, 1),
+                "max_ms": round((vals[-1] if vals else 0.0) * 1000, 1),
+            }
+
+        all_vals = [v for vals in self.latencies.values() for v in vals]
+        return {
+            "target_rps": self.rate,
+            "achieved_rps": round(len(all_vals) / elapsed, 1) if elapsed else 0.0,
+            "elapsed_s": round(elapsed, 2),
+            "generator_max_lag_ms": round(self.lag_max * 1000, 1),
+            "statuses": dict(self.statuses),
+            "latency": summary(all_vals),
+            "by_platform": {p: summary(v) for p, v in self.latencies.items()},
+        }
+
+
+def _csv(value: str) -> List[str]:
+    return [x.strip() for x in (value or "").split(",") if x.strip()]
+
+
+def _mix(value: str) -> Optional[Dict[str, float]]:
+    if not value:
+        return None
+    aliases = {"tg": "telegram", "wa": "whatsapp", "ig": "instagram"}
+    out = {}
+    for part in _csv(value):
+        k, _, w = part.partition("=")
+        out[aliases.get(k, k)] = float(w or 1)
+    return out
+
+
+def add_arguments(ap: argparse.ArgumentParser):
+    ap.add_argument("--rate", type=float, default=50.0, help="webhooks per second")
+    ap.add_argument("--duration", type=float, default=20.0, help="seconds")
+    ap.add_argument("--mix", default="", help="e.g. tg=0.4,wa=0.4,ig=0.2")
+    ap.add_argument("--concurrency", type=int, default=64)
+    ap.add_argument("--users", type=int, default=500, help="distinct end users per platform")
+    ap.add_argument("--seed", type=int, default=None)
+    ap.add_argument("--json", action="store_true", help="print the report as JSON only")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Webhook load generator")
+    ap.add_argument("--url", required=True)
+    ap.add_argument("--tg-bots", default="", help="comma-separated bot ids")
+    ap.add_argument("--wa-phones", default="", help="comma-separated phone_number_id values")
+    ap.add_argument("--ig-ids", default="", help="comma-separated IG user / page ids")
+    ap.add_argument("--pid", type=int, default=None, help="server pid for memory readings")
+    add_arguments(ap)
+    args = ap.parse_args()
+
+    gen = LoadGen(args.url, args.rate, args.duration,
+                  {"telegram": _csv(args.tg_bots), "whatsapp": _csv(args.wa_phones), "instagram": _csv(args.ig_ids)},
+                  _mix(args.mix), args.concurrency, args.users, args.seed)
+    mem_before = read_memory(args.pid) if args.pid else {}
+    report = gen.run()
+    if args.pid:
+        report["memory"] = {"before": mem_before, "after": read_memory(args.pid)}
+    print(json.dumps(report, ensure_ascii=False, indent=None if args.json else 2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+# bench/run.py
+# -*- coding: utf-8 -*-
+"""
+سيناريو قياس كامل داخل عملية واحدة، بدون أي اتصال خارجي:
+  1) يشغّل السيرفرات البديلة (bench.fakes) ويوجّه لها OPENAI / GRAPH / ELEVEN / Telegram
+  2) يسجّل بوتات وهمية في سجل مؤقت ثم يشغّل app.py على منفذ محلي
+  3) يرسل الحمل (bench.loadgen) وينتظر تفريغ الطوابير
+  4) يطبع زمن قبول الويبهوك (p50/p95/p99)، الإنتاجية حتى آخر رد مُرسَل، والذاكرة
+
+    python -m bench.run --rate 50 --duration 30 --bots 5 --reply-mode text
+    python -m bench.run --openai-latency fixed:2 --error-rate 0.05 --json > after.json
+    python -m bench.run --server asgi   # asgi.py عبر uvicorn (مسار asyncio)
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+
+from bench import fakes
+from bench.loadgen import LoadGen, add_arguments, read_memory, _mix
+
+
+def _seed_bots(db_path: str, n: int, reply_mode: str) -> dict:
+    from bots.registry import BotRegistry
+
+    reg = BotRegistry(db_path)
+    company = {
+        "name": "متجر القياس", "city": "الرياض",
+        "hours": {"from": "9:00", "to": "18:00", "days": ["الأحد", "الاثنين", "الثلاثاء"]},
+        "phone": {"cc": "+966", "number": "110000000"},
+        "prompt": "أجب باختصار.",
+    }
+    voice = {"ek": "bench-eleven-key", "vid": "bench-voice"}
+    targets = {"telegram": [], "whatsapp": [], "instagram": []}
+    for i in range(n):
+        tg_id, wa_id, ig_id = f"bench_tg_{i}", f"bench_wa_{i}", f"bench_ig_{i}"
+        reg.put(tg_id, {"id": tg_id, "platform": "telegram", "reply_mode": reply_mode, "company": company,
+                        "voice": voice, "creds": {"tgToken": f"{100000 + i}:BENCH", "openai": "sk-bench"}})
+        reg.put(wa_id, {"id": wa_id, "platform": "whatsapp", "reply_mode": reply_mode, "company": company,
+                        "voice": voice, "creds": {"waToken": "bench", "waPhoneId": str(1000 + i),
+                                                  "openai": "sk-bench"}})
+        reg.put(ig_id, {"id": ig_id, "platform": "instagram", "reply_mode": "text", "company": company,
+                        "creds": {"igAccess": "bench", "igUserId": str(2000 + i), "igPageId": str(3000 + i),
+                                  "openai": "sk-bench"}})
+        targets["telegram"].append(tg_id)
+        targets["whatsapp"].append(str(1000 + i))
+        targets["instagram"].append(str(2000 + i))
+    return targets
+
+
+def _pending(app_module) -> int:
+    w = app_module.pool.stats()
+    o = app_module.outbox.stats()["pool"]
+    c = app_module.coalescer.stats()
+    a = app_module.runner.stats()
+    return (w["queue_depth"] + w["busy"] + o["queue_depth"] + o["busy"] + c["pending_conversations"]
+            + a["queue_depth"] + a["running"])
+
+
+def _serve_wsgi(app_module):
+    from werkzeug.serving import make_server
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    app_module.tg_bot.use_shared_session()
+    httpd = make_server("127.0.0.1", 0, app_module.app, threaded=True)
+    threading.Thread(target=httpd.serve_forever, name="bench-app", daemon=True).start()
+    return httpd.server_port, httpd.shutdown
+
+
+def _serve_asgi():
+    import socket
+    import uvicorn
+    import asgi
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    server = uvicorn.Server(uvicorn.Config(asgi.app, log_level="error", lifespan="on"))
+    threading.Thread(target=server.run, kwargs={"sockets": [sock]}, name="bench-app", daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+
+    def stop():
+        server.should_exit = True
+
+    return sock.getsockname()[1], stop
+
+
+def main():
+    ap = argparse.ArgumentParser(description="End-to-end offline benchmark of app.py")
+    ap.add_argument("--bots", type=int, default=3, help="bots per platform")
+    ap.add_argument("--reply-mode", default="text", choices=["text", "voice", "both"])
+    ap.add_argument("--server", default="wsgi", choices=["wsgi", "asgi"],
+                    help="wsgi: app.py (threads), asgi: asgi.py on uvicorn (asyncio)")
+    for s in fakes.SERVICES:
+        ap.add_argument(f"--{s}-latency", default=fakes.DEFAULT_LATENCY[s])
+    ap.add_argument("--error-rate", type=float, default=0.0, help="429/500 rate for every fake API")
+    ap.add_argument("--drain-timeout", type=float, default=60.0)
+    add_arguments(ap)
+    args = ap.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    servers = fakes.start_all({s: getattr(args, f"{s}_latency") for s in fakes.SERVICES}, args.error_rate)
+    tmp = tempfile.mkdtemp(prefix="piaaz-bench-")
+    os.environ.update(fakes.env_for(servers))
+    os.environ.update({
+        "SUPABASE_URL": os.environ.get("SUPABASE_URL") or "http://127.0.0.1:9",
+        "SUPABASE_ANON_KEY": os.environ.get("SUPABASE_ANON_KEY") or "bench",
+        "META_APP_SECRET": "",
+        "BOTS_DB_PATH": os.path.join(tmp, "bots.db"),
+        "DEDUP_DB_PATH": os.path.join(tmp, "dedup.db"),
+        "HISTORY_DB_PATH": os.path.join(tmp, "history.db"),
+        "TTS_CACHE_DIR": os.path.join(tmp, "tts_cache"),
+    })
+    targets = _seed_bots(os.environ["BOTS_DB_PATH"], args.bots, args.reply_mode)
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as app_module
+
+    app_module.limiter.enabled = False  # حد الـ IP الواحد يقيس المولّد لا السيرفر
+    logging.getLogger().setLevel(logging.WARNING)
+    port, stop_server = _serve_asgi() if args.server == "asgi" else _serve_wsgi(app_module)
+    url = f"http://127.0.0.1:{port}"
+
+    mem_before = read_memory()
+    gen = LoadGen(url, args.rate, args.duration, targets, _mix(args.mix), args.concurrency, args.users, args.seed)
+    t0 = time.monotonic()
+    report = gen.run()
+
+    # انتظار تفريغ الطوابير: الإنتاجية الفعلية = ردود مُرسلة / الزمن حتى آخر رد
+    deadline = time.monotonic() + args.drain_timeout
+    while time.monotonic() < deadline and _pending(app_module) > 0:
+        time.sleep(0.1)
+    drained = _pending(app_module) == 0
+    elapsed = time.monotonic() - t0
+
+    sent = fakes.counts(servers)
+    replies = (sent["telegram"].get("sendMessage", 0) + sent["telegram"].get("sendVoice", 0)
+               + sent["graph"].get("messages", 0))
+    report["end_to_end"] = {
+        "drained": drained,
+        "elapsed_s": round(elapsed, 2),
+        "replies_sent": replies,
+        "replies_per_s": round(replies / elapsed, 1) if elapsed else 0.0,
+        "llm_calls": sent["openai"].get("chat", 0),
+        "fake_api_calls": sent,
+    }
+    report["memory"] = {"before": mem_before, "after": read_memory()}
+    report["app"] = {
+        "workers": app_module.pool.stats(),
+        "outbox": app_module.outbox.stats(),
+        "coalesce": app_module.coalescer.stats(),
+        "dedup": app_module.dedup.stats(),
+        "aio": app_module.runner.stats(),
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=None if args.json else 2))
+
+    stop_server()
+    for s in servers.values():
+        s.stop()
+    shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# bench/tg_dispatch.py
+# -*- coding: utf-8 -*-
+"""
+قياس دقيق لكلفة CPU لتوجيه update تيليجرام واحد (بدون شبكة ولا معالجة الرسالة):
+  telebot: Update.de_json + process_new_updates عبر handlers مسجلة (المسار القديم)
+  dict:    TelegramClientBot.process_update (قراءة الـ dict مباشرة)
+
+    python -m bench.tg_dispatch --n 20000
+"""
+import json
+import time
+import argparse
+
+from telebot import TeleBot
+from telebot.types import Update
+
+from bench.loadgen import Payloads
+
+
+def _telebot_dispatch(bot: TeleBot):
+    def run(data: dict):
+        bot.process_new_updates([Update.de_json(data)])
+    return run
+
+
+def _telebot_bot() -> TeleBot:
+    bot = TeleBot("100000:BENCH", parse_mode="HTML", threaded=False)
+
+    @bot.message_handler(content_types=["text", "voice", "audio"])
+    def _on_message(m):
+        pass
+
+    @bot.message_handler(commands=["start", "help"])
+    def _on_start(m):
+        pass
+
+    return bot
+
+
+def _dict_dispatch():
+    from bots.tg_bot import TelegramClientBot
+
+    bot = TelegramClientBot("bench_tg", "100000:BENCH", "sk-bench", {})
+    # نقيس التوجيه فقط: المعالجة والإرسال بدون عمل
+    bot._handle_message = lambda *a: None
+    bot._send_text = lambda *a, **kw: None
+    return bot.process_update
+
+
+def _measure(fn, updates, rounds: int) -> float:
+    """متوسط CPU لكل update (ميكروثانية)."""
+    for u in updates[:200]:
+        fn(u)  # إحماء
+    t0 = time.process_time()
+    for _ in range(rounds):
+        for u in updates:
+            fn(u)
+    return (time.process_time() - t0) / (rounds * len(updates)) * 1e6
+
+
+def main():
+    ap = argparse.ArgumentParser(description="CPU per Telegram update: telebot vs dict dispatch")
+    ap.add_argument("--n", type=int, default=20000, help="updates per round")
+    ap.add_argument("--rounds", type=int, default=3)
+    ap.add_argument("--json", action="store_true")
+    args = ap.parse_args()
+
+    payloads = Payloads(seed=1)
+    updates = [payloads.telegram("bench_tg") for _ in range(args.n)]
+    for u in updates[::10]:
+        u["message"]["text"] = "/start"
+
+    telebot_us = _measure(_telebot_dispatch(_telebot_bot()), updates, args.rounds)
+    dict_us = _measure(_dict_dispatch(), updates, args.rounds)
+    report = {
+        "updates": args.n * args.rounds,
+        "telebot_us_per_update": round(telebot_us, 2),
+        "dict_us_per_update": round(dict_us, 2),
+        "saved_us_per_update": round(telebot_us - dict_us, 2),
+        "speedup": round(telebot_us / dict_us, 1) if dict_us else None,
+    }
+    print(json.dumps(report, indent=None if args.json else 2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,17 @@
 # bots/ig_bot.py
 # -*- coding: utf-8 -*-
-import requests
+import os
+import functools
 from typing import Dict, Any, Optional
-from services.nlp import generate_reply
+from services import async_http, http_client, metrics
+from services.aio import runner
+from services.nlp import agenerate_reply, generate_reply, is_fallback
+from services.history import BotHistory
+from services import reply_cache
+from services.coalesce import coalescer
+from services.outbox import outbox
 
-GRAPH = "https://graph.facebook.com/v19.0"
+GRAPH = os.getenv("GRAPH_API_BASE", "https://graph.facebook.com/v19.0")
 
 class InstagramDMClientBot:
     """
@@ -18,31 +25,62 @@ class InstagramDMClientBot:
         self.token = page_access_token
         self.openai_key = openai_key
         self.profile = profile
-        self.history: Dict[str, list] = {}  # ig_user -> history
+        self.history = BotHistory(bot_id)  # ig_user -> history (services.history)
+        self.reply_cache = reply_cache.for_bot(bot_id)
 
     def _headers(self):
         return {"Authorization": f"Bearer {self.token}"}
 
-    def send_text(self, recipient_id: str, text: str):
+    def send_text(self, recipient_id: str, text: str) -> bool:
         """
-        endpoint: POST /{ig_user_id}/messages
+        يضع الإرسال في services.outbox ويرجع فورًا. إن امتلأ الطابور تُعاد معالجة الرسالة
+        (RetryLater داخل services.workers) أو يُرسل متزامنًا — انظر outbox.send_or_retry.
         """
-        url = f"{GRAPH}/{self.ig_user_id}/messages"
-        payload = {
+        return outbox.send_or_retry("instagram", self.ig_user_id, recipient_id, self._post_text, recipient_id, text)
+
+    def _text_payload(self, recipient_id: str, text: str) -> dict:
+        return {
             "recipient": {"id": recipient_id},
             "message": {"text": text},
             "messaging_type": "RESPONSE"
         }
-        r = requests.post(url, headers=self._headers(), json=payload, timeout=30)
+
+    def _post_text(self, recipient_id: str, text: str):
+        """
+        endpoint: POST /{ig_user_id}/messages
+        """
+        url = f"{GRAPH}/{self.ig_user_id}/messages"
+        r = http_client.post(url, headers=self._headers(), json=self._text_payload(recipient_id, text))
+        r.raise_for_status()
+        return r.json()
+
+    async def asend_text(self, recipient_id: str, text: str) -> bool:
+        return await outbox.asend("instagram", self.ig_user_id, recipient_id, self._apost_text, recipient_id, text)
+
+    async def _apost_text(self, recipient_id: str, text: str):
+        url = f"{GRAPH}/{self.ig_user_id}/messages"
+        r = await async_http.post(url, headers=self._headers(), json=self._text_payload(recipient_id, text))
         r.raise_for_status()
         return r.json()
 
     def handle_webhook(self, entry_change_value: Dict[str, Any]):
         """
         value = payload['entry'][...]['changes'][...]['value']
-        نتعامل مع أول event فيه رسائل
+        نعالج كل events الرسائل؛ الرسائل المتتالية من نفس المرسل تُدمج
+        (services.coalesce) في طلب OpenAI واحد ورد واحد.
         """
         # Instagram يحط الرسائل تحت "messaging"
+        for sender, user_text in self._incoming(entry_change_value):
+            coalescer.add((self.id, sender), user_text, lambda text, to=sender: self._reply(to, text))
+
+    async def ahandle_webhook(self, entry_change_value: Dict[str, Any]):
+        """نسخة asyncio: الرد المدمج يُنفَّذ كمهمة في services.aio بدل ثريد."""
+        for sender, user_text in self._incoming(entry_change_value):
+            coalescer.add((self.id, sender), user_text, functools.partial(self._areply, sender),
+                          submit=runner.submit_threadsafe)
+
+    def _incoming(self, entry_change_value: Dict[str, Any]):
+        """(sender, user_text) لكل event رسالة."""
         events = entry_change_value.get("messaging") or []
         for ev in events:
             sender = ev.get("sender", {}).get("id")
@@ -54,15 +92,37 @@ class InstagramDMClientBot:
                 user_text = (message.get("text") or "").strip()
             else:
                 user_text = "(رسالة غير نصية)"
+            yield sender, user_text
 
-            sys = self._build_system_prompt(self.profile.get("company", {}))
-            hist = self.history.get(sender, [])
+    def _reply(self, sender: str, user_text: str):
+        metrics.bind("instagram", self.id, conversation=sender)
+        sys = self._build_system_prompt(self.profile.get("company", {}))
+        hist = self.history.get(sender, [])
+        cache_key, reply = self.reply_cache.lookup(self.profile, hist, user_text)
+        if reply is None:
             reply = generate_reply(self.openai_key, sys, hist, user_text)
 
-            hist += [{"role": "user", "content": user_text}, {"role": "assistant", "content": reply}]
-            self.history[sender] = hist[-30:]
+        # الإرسال قبل الذاكرة والكاش: طابور ممتلئ يرمي RetryLater (تُعاد الرسالة ولم يُحفظ شيء)
+        if not self.send_text(sender, reply):
+            return
+        self.reply_cache.store(cache_key, reply)
+        hist += [{"role": "user", "content": user_text}, {"role": "assistant", "content": reply}]
+        self.history[sender] = hist[-30:]
+
+    async def _areply(self, sender: str, user_text: str):
+        metrics.bind("instagram", self.id, conversation=sender)
+        sys = self._build_system_prompt(self.profile.get("company", {}))
+        hist = await self.history.aget(sender, [])  # SQLite في ثريد
+        cache_key, reply = self.reply_cache.lookup(self.profile, hist, user_text)
+        if reply is None:
+            reply = await agenerate_reply(self.openai_key, sys, hist, user_text)
 
-            self.send_text(sender, reply)
+        # مثل _reply: الكاش والذاكرة بعد تسليم الرد فقط، ورسالة التعطّل لا تُحفظ
+        if not await self.asend_text(sender, reply) or is_fallback(reply):
+            return
+        self.reply_cache.store(cache_key, reply)
+        hist += [{"role": "user", "content": user_text}, {"role": "assistant", "content": reply}]
+        await self.history.aset(sender, hist[-30:])
 
     def _build_system_prompt(self, company: dict) -> str:
         name  = company.get("name", "الشركة")
@@ -84,3 +144,4 @@ class InstagramDMClientBot:
         if new_openai:
             self.openai_key = new_openai
         self.profile = new_profile
+        self.reply_cache.clear()
@@ -2,14 +2,22 @@
 # -*- coding: utf-8 -*-
 import os
 import time
+import asyncio
 import logging
 import threading
-from typing import Dict, Optional
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Optional, Tuple
 
-import requests
+from services import http_client, metrics
+from services.history import store as history_store
+from services import reply_cache
+from services.resilience import RetryLater
 
 # Telegram (مطلوب)
-from bots.tg_bot import TelegramClientBot
+from bots.tg_bot import TelegramClientBot, TELEGRAM_API_BASE
+from bots.registry import BotRegistry, BOTS_DB_PATH
 
 # WhatsApp (اختياري)
 try:
@@ -24,27 +32,286 @@ except Exception:
     InstagramDMClientBot = None  # ما نكسر التطبيق لو الملف مش موجود
 
 
-GRAPH = "https://graph.facebook.com/v19.0"
+GRAPH = os.getenv("GRAPH_API_BASE", "https://graph.facebook.com/v19.0")
 PUBLIC_BASE = os.environ.get("PUBLIC_BASE", "https://piaaz-servers.onrender.com")
 
+# أقصى تأخير حتى يرى هذا الـ worker تعديلات workers أخرى على السجل
+REGISTRY_SYNC_INTERVAL = float(os.environ.get("BOTS_SYNC_INTERVAL", "1.0"))
+
+# العمليات الجماعية: أقصى عدد بوتات في طلب واحد، وعدد طلبات setWebhook/subscribe المتزامنة
+BULK_MAX_BOTS    = int(os.environ.get("BOTS_BULK_MAX", "1000"))
+BULK_CONCURRENCY = int(os.environ.get("BOTS_BULK_CONCURRENCY", "16"))
+
+PLATFORMS = ("telegram", "whatsapp", "instagram")
+
+_NOT_BUILT = object()  # البوت مسجّل لكن كائنه لم يُبنَ بعد (يُبنى مع أول webhook)
+
+
+class RegistryUnavailable(Exception):
+    """السجل الدائم رفض كتابة عملية جماعية: لم يتغير شيء (لا في السجل ولا في اللقطة)."""
+
+
+# ثريدات setWebhook/subscribe للعمليات الجماعية: مشتركة بين كل الطلبات، فالحد
+# BULK_CONCURRENCY للعملية كلها وليس لكل طلب. تُنشأ عند أول استخدام لكل pid (بعد fork).
+_bulk_pool: Optional[ThreadPoolExecutor] = None
+_bulk_pool_pid: Optional[int] = None
+_bulk_pool_lock = threading.Lock()
+
+
+def _bulk_executor() -> ThreadPoolExecutor:
+    global _bulk_pool, _bulk_pool_pid
+    pid = os.getpid()
+    if _bulk_pool is None or _bulk_pool_pid != pid:
+        with _bulk_pool_lock:
+            if _bulk_pool is None or _bulk_pool_pid != pid:
+                _bulk_pool = ThreadPoolExecutor(max_workers=max(1, BULK_CONCURRENCY), thread_name_prefix="bots-bulk")
+                _bulk_pool_pid = pid
+    return _bulk_pool
+
+
+class RoutingSnapshot:
+    """
+    لقطة غير قابلة للتعديل لـ meta كل البوتات وفهارس التوجيه.
+    أي تغيير يبني لقطة جديدة ويستبدلها بإسناد واحد (ذرّي)، فالقراءة في مسار
+    الويبهوك لا تحتاج أي قفل ولا تنتظر عمليات الإدارة.
+    """
+    __slots__ = ("meta", "wa", "ig", "version")
+
+    def __init__(self, meta: Dict[str, dict], wa: Dict[str, str], ig: Dict[str, str], version: int):
+        self.meta: Mapping[str, dict] = MappingProxyType(meta)  # id -> meta (لا تُعدَّل في مكانها)
+        self.wa: Mapping[str, str] = MappingProxyType(wa)       # waPhoneId -> bot_id
+        self.ig: Mapping[str, str] = MappingProxyType(ig)       # igUserId / igPageId -> bot_id
+        self.version = version
+
+
+def _routing_keys(meta: Optional[dict]) -> List[Tuple[str, str]]:
+    """[("wa"|"ig", key)] معرّفات المنصة التي يُوجَّه بها البوت."""
+    if not meta:
+        return []
+    creds = meta.get("creds") or {}
+    platform = meta.get("platform")
+    if platform == "whatsapp":
+        raw = [("wa", creds.get("waPhoneId"))]
+    elif platform == "instagram":
+        raw = [("ig", creds.get("igUserId")), ("ig", creds.get("igPageId"))]
+    else:
+        return []
+    return [(index, key.strip()) for index, key in raw if isinstance(key, str) and key.strip()]
+
+
+def _hook_key(meta: Optional[dict]) -> Optional[tuple]:
+    """ما يحدد ويبهوك/اشتراك المنصة: تغيّره يعني إلغاء القديم وتفعيل الجديد."""
+    if not meta:
+        return None
+    creds = meta.get("creds") or {}
+    platform = meta.get("platform")
+    if platform == "telegram":
+        return platform, creds.get("tgToken")
+    if platform == "whatsapp":
+        return platform, creds.get("waPhoneId"), creds.get("waToken")
+    if platform == "instagram":
+        return platform, creds.get("igPageId"), creds.get("igAccess")
+    return (platform,)
+
+
 class BotManager:
     """
     إدارة عدة بوتات عبر منصات مختلفة:
       - Telegram (مُفعّل + تعيين ويبهوك تلقائي)
       - WhatsApp Cloud (اختياري: subscribe تلقائي للرقم)
       - Instagram DM (اختياري: subscribe تلقائي للصفحة)
+
+    التزامن:
+      - القراءة (التوجيه، get_bot، list) من RoutingSnapshot بدون قفل
+      - عمليات دورة الحياة (create/update/restart/stop/delete) تأخذ قفل البوت نفسه فقط
+      - _lock يحمي استبدال اللقطة والعدادات فقط (بدون أي I/O)
+      - استدعاءات الشبكة (setWebhook / subscribed_apps / remove_webhook) بعد تحرير كل الأقفال
     """
 
-    def __init__(self):
-        self.bots_meta: Dict[str, dict] = {}   # id -> meta/config (كما تأتي من الواجهة)
-        self.bots_obj:  Dict[str, object] = {} # id -> كائن البوت المشغّل أو None
-        self._lock = threading.RLock()
+    def __init__(self, registry: Optional[BotRegistry] = None):
+        self.bots_obj: Dict[str, object] = {}  # id -> كائن البوت المشغّل أو None (غيابه = لم يُبنَ بعد)
+        self._snapshot = RoutingSnapshot({}, {}, {}, 0)
+        self._lock = threading.Lock()
+        self._bot_locks: Dict[str, threading.RLock] = {}
+        self._sync_lock = threading.Lock()
+        self.unroutable = {"whatsapp": 0, "instagram": 0}
+        self.hook_status: Dict[str, dict] = {}  # id -> نتيجة آخر setWebhook/subscribe في هذا الـ worker
+        self._last_id_ms = 0
         logging.getLogger(__name__).setLevel(logging.INFO)
 
+        if registry is None and BOTS_DB_PATH:
+            registry = BotRegistry()
+        self.registry = registry
+        self._seen_seq = 0          # آخر generation طبّقناه من السجل
+        self._data_version = None   # PRAGMA data_version عند آخر فحص
+        self._next_sync = 0.0
+        self._load_registry()
+
+    @property
+    def bots_meta(self) -> Mapping[str, dict]:
+        return self._snapshot.meta
+
+    # --------------- اللقطة والأقفال ---------------
+
+    def _bot_lock(self, bot_id: str) -> threading.RLock:
+        lock = self._bot_locks.get(bot_id)
+        if lock is None:
+            with self._lock:
+                lock = self._bot_locks.setdefault(bot_id, threading.RLock())
+        return lock
+
+    def _publish(self, changes: Dict[str, Optional[dict]]):
+        """يبني لقطة جديدة بتطبيق {bot_id: meta أو None للحذف} ويستبدلها ذرّيًا."""
+        with self._lock:
+            old = self._snapshot
+            meta, indexes = dict(old.meta), {"wa": dict(old.wa), "ig": dict(old.ig)}
+            for bot_id, new in changes.items():
+                for index, key in _routing_keys(old.meta.get(bot_id)):
+                    if indexes[index].get(key) == bot_id:
+                        del indexes[index][key]
+                if new is None:
+                    meta.pop(bot_id, None)
+                    continue
+                meta[bot_id] = new
+                for index, key in _routing_keys(new):
+                    other = indexes[index].get(key)
+                    if other and other != bot_id:
+                        logging.warning("Routing key %s moved from %s to %s", key, other, bot_id)
+                    indexes[index][key] = bot_id
+            self._snapshot = RoutingSnapshot(meta, indexes["wa"], indexes["ig"], old.version + 1)
+
+    # --------------- السجل الدائم ---------------
+
+    def _load_registry(self):
+        """
+        يحمّل meta لكل البوتات المسجلة ويبني فهارس التوجيه فقط؛
+        لا نبني أي كائن بوت هنا حتى يبقى زمن الإقلاع ثابتًا مهما كثرت البوتات.
+        """
+        if not self.registry:
+            return
+        t0 = time.monotonic()
+        try:
+            # seq قبل القراءة: أي تغيير بينهما سيُعاد تطبيقه في sync (التطبيق idempotent)
+            seq = self.registry.last_seq()
+            metas = self.registry.load_all()
+            self._data_version = self.registry.data_version()
+        except Exception:
+            logging.exception("Loading bot registry failed")
+            return
+        self._publish(metas)
+        self._seen_seq = seq
+        logging.info("Loaded %d bot(s) from registry in %.1fms", len(metas), (time.monotonic() - t0) * 1000)
+
+    def _persist(self, bot_id: str, meta: Optional[dict]):
+        if not self.registry:
+            return
+        try:
+            if meta is None:
+                self.registry.delete(bot_id)
+            else:
+                self.registry.put(bot_id, meta)
+        except Exception:
+            logging.exception("Persisting bot %s failed", bot_id)
+
+    def sync(self, force: bool = False):
+        """
+        يطبّق تعديلات workers الأخرى على السجل (تفعيل/تحديث/حذف) تدريجيًا:
+        فحص رخيص لـ data_version كل BOTS_SYNC_INTERVAL، ثم قراءة التغييرات بعد آخر seq فقط.
+        ثريد واحد يطبّق التغييرات؛ البقية يكملون باللقطة الحالية بدل الانتظار.
+        """
+        if not self.registry:
+            return
+        now = time.monotonic()
+        if not force and now < self._next_sync:
+            return
+        if not self._sync_lock.acquire(blocking=force):
+            return
+        try:
+            self._next_sync = now + REGISTRY_SYNC_INTERVAL
+            dv = self.registry.data_version()
+            if dv == self._data_version and not force:
+                return
+            self._data_version = dv
+            while True:
+                rows, oldest = self.registry.changes_since(self._seen_seq)
+                if oldest > self._seen_seq + 1:
+                    # فاتتنا تغييرات حُذفت من السجل: إعادة تحميل كاملة
+                    logging.warning("Registry changes pruned past seq=%s, full reload", self._seen_seq)
+                    self._reload_all()
+                    return
+                if not rows:
+                    return
+                for seq, bot_id, _op in rows:
+                    self._apply_change(bot_id)
+                    self._seen_seq = seq
+        except Exception:
+            logging.exception("Registry sync failed")
+        finally:
+            self._sync_lock.release()
+
+    def _reload_all(self):
+        seq = self.registry.last_seq()
+        metas = self.registry.load_all()
+        for bot_id in list(self._snapshot.meta):
+            if bot_id not in metas:
+                self._apply_change(bot_id, None)
+        for bot_id, meta in metas.items():
+            self._apply_change(bot_id, meta)
+        self._seen_seq = seq
+
+    def _apply_change(self, bot_id: str, meta=_NOT_BUILT):
+        """
+        يطبّق meta الحالية من السجل على هذا الـ worker. لا نستدعي bot.stop() ولا
+        أي webhook هنا — الـ worker صاحب التعديل قام بذلك؛ نكتفي بإسقاط الكائن القديم.
+        """
+        if meta is _NOT_BUILT:
+            meta = self.registry.get(bot_id)
+        with self._bot_lock(bot_id):
+            old = self._snapshot.meta.get(bot_id)
+            if meta == old:
+                return
+            self._publish({bot_id: meta})
+            if meta is None:
+                self.bots_obj.pop(bot_id, None)
+                history_store.drop_bot(bot_id)
+                reply_cache.drop_bot(bot_id)
+                logging.info("Synced delete of %s", bot_id)
+                return
+
+            bot = self.bots_obj.get(bot_id)
+            if old is None or self._need_restart_after_update(old, meta) or not hasattr(bot, "update_profile"):
+                self.bots_obj.pop(bot_id, None)  # يُبنى من جديد مع أول webhook
+            else:
+                try:
+                    bot.update_profile(self._build_profile(meta), (meta.get("creds") or {}).get("openai"))
+                except Exception:
+                    logging.exception("Synced hot update failed for %s", bot_id)
+        logging.info("Synced update of %s", bot_id)
+
+    def get_bot(self, bot_id: str):
+        """يرجع كائن البوت، ويبنيه عند أول طلب إن كان مسجلًا ولم يُبنَ بعد."""
+        self.sync()
+        bot = self.bots_obj.get(bot_id, _NOT_BUILT)
+        if bot is not _NOT_BUILT:
+            return bot
+        with self._bot_lock(bot_id):
+            bot = self.bots_obj.get(bot_id, _NOT_BUILT)
+            if bot is not _NOT_BUILT:
+                return bot
+            meta = self._snapshot.meta.get(bot_id)
+            if meta is None:
+                return None
+            bot = self.bots_obj[bot_id] = self._build_safe(bot_id, meta)
+            return bot
+
     # --------------- أدوات داخلية ---------------
 
     def _gen_id(self) -> str:
-        return f"bot_{int(time.time() * 1000)}"
+        # معرّف فريد حتى لو أُنشئ أكثر من بوت في نفس الميلي ثانية (العمليات الجماعية)
+        with self._lock:
+            ms = max(int(time.time() * 1000), self._last_id_ms + 1)
+            self._last_id_ms = ms
+        return f"bot_{ms}"
 
     def _required_creds(self, platform: str):
         if platform == "telegram":
@@ -70,6 +337,7 @@ class BotManager:
             "reply_mode": meta.get("reply_mode", "text"),
             "company": meta.get("company", {}),
             "voice": meta.get("voice"),
+            "reply_cache": bool(meta.get("reply_cache", reply_cache.REPLY_CACHE_DEFAULT)),
         }
 
     def _need_restart_after_update(self, old: dict, new: dict) -> bool:
@@ -85,111 +353,179 @@ class BotManager:
         keys = sensitive_by_platform.get(new.get("platform"), [])
         return any((o.get(k) != n.get(k)) for k in keys)
 
+    @staticmethod
+    def _merge_meta(old: dict, meta_update: dict) -> dict:
+        """
+        meta جديدة بالكامل (company / creds قواميس جديدة أيضًا): القديمة في اللقطة
+        لا تُعدَّل أبدًا، وإلا يرى _need_restart_after_update نفس القاموس قبل وبعد.
+        """
+        merged = {**old}
+        for k, v in meta_update.items():
+            if k in ("company", "creds") and isinstance(v, dict):
+                merged[k] = {**(old.get(k) or {}), **v}
+            else:
+                merged[k] = v
+        return merged
+
     # ---------- تفعيل/اشتراك Webhook تلقائي ----------
+    # تُستدعى دائمًا خارج الأقفال (مهلات حتى 20 ثانية)
 
-    def _auto_webhook_telegram(self, bot_id: str, tg_token: str):
+    def _auto_webhook_telegram(self, bot_id: str, tg_token: str) -> bool:
         """يضبط Webhook لتيليجرام مباشرة."""
         if not tg_token:
-            return
-        url = f"https://api.telegram.org/bot{tg_token}/setWebhook"
+            return False
+        url = f"{TELEGRAM_API_BASE}/bot{tg_token}/setWebhook"
         webhook = f"{PUBLIC_BASE}/webhooks/telegram/{bot_id}"
         try:
-            r = requests.post(url, json={"url": webhook}, timeout=15)
+            r = http_client.post(url, json={"url": webhook})
             ok = r.json().get("ok", False) if r.headers.get("content-type","").startswith("application/json") else False
             logging.info("[TG auto-webhook] %s -> %s | ok=%s status=%s", bot_id, webhook, ok, r.status_code)
+            return bool(ok)
         except Exception:
             logging.exception("[TG auto-webhook] failed for %s", bot_id)
+            return False
 
-    def _auto_subscribe_whatsapp(self, phone_id: str, wa_token: str):
+    def _auto_subscribe_whatsapp(self, phone_id: str, wa_token: str) -> bool:
         """
         يشترك الرقم في التطبيق (لا يضبط رابط الويبهوك من هنا؛
         الرابط يُضبط مرة من لوحة Meta على /webhooks/meta).
         """
         if not (phone_id and wa_token):
-            return
+            return False
         url = f"{GRAPH}/{phone_id}/subscribed_apps"
         try:
-            r = requests.post(url, headers={"Authorization": f"Bearer {wa_token}"}, timeout=20)
+            r = http_client.post(url, headers={"Authorization": f"Bearer {wa_token}"}, timeout=20)
             logging.info("[WA subscribe] phone_id=%s status=%s body=%s", phone_id, r.status_code, r.text[:200])
+            return r.ok
         except Exception:
             logging.exception("[WA subscribe] failed")
+            return False
 
-    def _auto_subscribe_instagram(self, page_id: str, page_token: str):
+    def _auto_subscribe_instagram(self, page_id: str, page_token: str) -> bool:
         """
         يشترك الصفحة في التطبيق لاستقبال رسائل IG (الويبهوك على مستوى التطبيق يجب ضبطه من لوحة Meta).
         """
         if not (page_id and page_token):
-            return
+            return False
         url = f"{GRAPH}/{page_id}/subscribed_apps"
         try:
-            r = requests.post(url, headers={"Authorization": f"Bearer {page_token}"}, timeout=20)
+            r = http_client.post(url, headers={"Authorization": f"Bearer {page_token}"}, timeout=20)
             logging.info("[IG subscribe] page_id=%s status=%s body=%s", page_id, r.status_code, r.text[:200])
+            return r.ok
         except Exception:
             logging.exception("[IG subscribe] failed")
+            return False
+
+    def _activate(self, bot_id: str, meta: dict) -> Optional[bool]:
+        """ويبهوك/اشتراك المنصة (بدون أقفال)، ثم تسجيل النتيجة."""
+        creds = meta.get("creds") or {}
+        platform = meta.get("platform")
+        if platform == "telegram":
+            ok = self._auto_webhook_telegram(bot_id, creds.get("tgToken", ""))
+        elif platform == "whatsapp":
+            ok = self._auto_subscribe_whatsapp(creds.get("waPhoneId", ""), creds.get("waToken", ""))
+        elif platform == "instagram":
+            # نستخدم page_id + page access token (igAccess)
+            ok = self._auto_subscribe_instagram(creds.get("igPageId", ""), creds.get("igAccess", ""))
+        else:
+            return None
+        with self._bot_lock(bot_id):
+            # نتيجة قديمة لا تغطي على meta أحدث (تحديث حصل أثناء الطلب)
+            if _hook_key(self._snapshot.meta.get(bot_id)) == _hook_key(meta):
+                self.hook_status[bot_id] = {"ok": ok, "at": int(time.time())}
+        return ok
+
+    def _remove_webhook_telegram(self, bot_id: str, tg_token: str) -> bool:
+        """يلغي Webhook تيليجرام مباشرة (لا يحتاج كائن TeleBot)."""
+        if not tg_token:
+            return False
+        url = f"{TELEGRAM_API_BASE}/bot{tg_token}/deleteWebhook"
+        try:
+            r = http_client.post(url, json={})
+            logging.info("[TG remove-webhook] %s | status=%s", bot_id, r.status_code)
+            return r.ok
+        except Exception:
+            logging.exception("[TG remove-webhook] failed for %s", bot_id)
+            return False
+
+    def _retire(self, bot_id: str, old_meta: Optional[dict], bot=None):
+        """
+        إلغاء ويبهوك المعرّفات القديمة بدون أقفال. يعتمد على meta القديمة وليس على
+        الكائن: البوتات تُبنى عند الحاجة فقد لا يوجد كائن في هذا الـ worker.
+        """
+        if not old_meta:
+            return
+        if old_meta.get("platform") == "telegram":
+            self._remove_webhook_telegram(bot_id, (old_meta.get("creds") or {}).get("tgToken", ""))
+        elif bot and hasattr(bot, "stop"):
+            try:
+                bot.stop()
+            except Exception:
+                logging.exception("Error while stopping bot %s", bot_id)
+        logging.info("Bot stopped: %s", bot_id)
 
     # --------------- CRUD/إدارة عامة ---------------
 
     def list(self):
-        with self._lock:
-            out = []
-            for i, meta in self.bots_meta.items():
-                out.append({
-                    "id": i,
-                    "platform": meta.get("platform"),
-                    "active": bool(self.bots_obj.get(i)),
-                    "reply_mode": meta.get("reply_mode", "text"),
-                    "company": meta.get("company", {}),
-                })
-            return out
+        self.sync()
+        snap = self._snapshot
+        out = []
+        for i, meta in snap.meta.items():
+            out.append({
+                "id": i,
+                "platform": meta.get("platform"),
+                "active": bool(self.bots_obj.get(i, True)),  # غير المبني بعد يُعتبر فعالًا
+                "reply_mode": meta.get("reply_mode", "text"),
+                "company": meta.get("company", {}),
+                "webhook_ok": (self.hook_status.get(i) or {}).get("ok"),
+            })
+        return out
 
     def create(self, meta: dict) -> str:
-        with self._lock:
-            bot_id = meta.get("id") or self._gen_id()
-            meta["id"] = bot_id
-
-            platform = meta.get("platform")
-            if platform not in ("telegram", "whatsapp", "instagram"):
-                raise ValueError("Unsupported platform")
+        meta = dict(meta)
+        bot_id = meta.get("id") or self._gen_id()
+        meta["id"] = bot_id
 
-            if not self._has_all_creds(meta):
-                logging.warning("Missing required credentials for %s (bot_id=%s)", platform, bot_id)
+        platform = meta.get("platform")
+        if platform not in PLATFORMS:
+            raise ValueError("Unsupported platform")
 
-            self.bots_meta[bot_id] = meta
+        if not self._has_all_creds(meta):
+            logging.warning("Missing required credentials for %s (bot_id=%s)", platform, bot_id)
 
-            # تشغيل + تفعيل الويبهوك/الاشتراك
-            try:
-                self._start_unlocked(bot_id)
-
-                creds = meta.get("creds") or {}
-                if platform == "telegram":
-                    self._auto_webhook_telegram(bot_id, creds.get("tgToken", ""))
-                elif platform == "whatsapp":
-                    self._auto_subscribe_whatsapp(creds.get("waPhoneId",""), creds.get("waToken",""))
-                elif platform == "instagram":
-                    # نستخدم page_id + page access token (igAccess)
-                    self._auto_subscribe_instagram(creds.get("igPageId",""), creds.get("igAccess",""))
-            except Exception:
-                logging.exception("Start/auto-webhook failed for %s", bot_id)
-                self.bots_obj[bot_id] = None
+        with self._bot_lock(bot_id):
+            old_meta = self._snapshot.meta.get(bot_id)
+            old_bot = self.bots_obj.get(bot_id)
+            self._publish({bot_id: meta})
+            self._persist(bot_id, meta)
+            self.bots_obj[bot_id] = self._build_safe(bot_id, meta)
 
-            return bot_id
+        # تشغيل + تفعيل الويبهوك/الاشتراك (خارج الأقفال)
+        if _hook_key(old_meta) != _hook_key(meta):
+            self._retire(bot_id, old_meta, old_bot)
+        self._activate(bot_id, meta)
+        return bot_id
 
     def start(self, bot_id: str):
-        with self._lock:
-            self._start_unlocked(bot_id)
+        with self._bot_lock(bot_id):
+            meta = self._snapshot.meta.get(bot_id)
+            if not meta:
+                raise KeyError(f"Unknown bot_id: {bot_id}")
+            self.bots_obj[bot_id] = self._build(bot_id, meta)
 
-    def _start_unlocked(self, bot_id: str):
-        meta = self.bots_meta.get(bot_id)
-        if not meta:
-            raise KeyError(f"Unknown bot_id: {bot_id}")
+    def _build_safe(self, bot_id: str, meta: dict):
+        try:
+            return self._build(bot_id, meta)
+        except Exception:
+            logging.exception("Start failed for %s", bot_id)
+            return None
 
+    def _build(self, bot_id: str, meta: dict):
+        """يبني كائن البوت من meta (بدون شبكة). None إذا المنصة غير متاحة."""
         platform = meta.get("platform")
         creds = meta.get("creds") or {}
         profile = self._build_profile(meta)
 
-        # أوقف القديم
-        self._stop_unlocked(bot_id)
-
         if platform == "telegram":
             tg_token   = creds.get("tgToken", "")
             openai_key = creds.get("openai", "")
@@ -197,14 +533,13 @@ class BotManager:
             if hasattr(bot, "start"):
                 try: bot.start()
                 except Exception: pass
-            self.bots_obj[bot_id] = bot
             logging.info("Telegram bot started: %s", bot_id)
+            return bot
 
         elif platform == "whatsapp":
             if WhatsAppCloudBot is None:
                 logging.warning("WhatsAppCloudBot not available. Skipping start for %s", bot_id)
-                self.bots_obj[bot_id] = None
-                return
+                return None
             bot = WhatsAppCloudBot(
                 bot_id=bot_id,
                 wa_token=creds.get("waToken", ""),
@@ -215,14 +550,13 @@ class BotManager:
             if hasattr(bot, "start"):
                 try: bot.start()
                 except Exception: pass
-            self.bots_obj[bot_id] = bot
             logging.info("WhatsApp bot started: %s", bot_id)
+            return bot
 
         elif platform == "instagram":
             if InstagramDMClientBot is None:
                 logging.warning("InstagramDMClientBot not available. Skipping start for %s", bot_id)
-                self.bots_obj[bot_id] = None
-                return
+                return None
             bot = InstagramDMClientBot(
                 bot_id=bot_id,
                 page_id=creds.get("igPageId", ""),
@@ -234,118 +568,331 @@ class BotManager:
             if hasattr(bot, "start"):
                 try: bot.start()
                 except Exception: pass
-            self.bots_obj[bot_id] = bot
             logging.info("Instagram bot started: %s", bot_id)
+            return bot
 
         else:
             raise ValueError("Unsupported platform")
 
     def stop(self, bot_id: str):
-        with self._lock:
-            self._stop_unlocked(bot_id)
-
-    def _stop_unlocked(self, bot_id: str):
-        bot = self.bots_obj.get(bot_id)
-        if bot:
-            try:
-                if hasattr(bot, "stop"):
-                    bot.stop()
-            except Exception:
-                logging.exception("Error while stopping bot %s", bot_id)
-        self.bots_obj[bot_id] = None
-        logging.info("Bot stopped: %s", bot_id)
+        with self._bot_lock(bot_id):
+            meta = self._snapshot.meta.get(bot_id)
+            bot = self.bots_obj.get(bot_id)
+            self.bots_obj[bot_id] = None  # غير فعال: الأحداث تُحسب unroutable
+        self._retire(bot_id, meta, bot)
+
+    def delete(self, bot_id: str):
+        with self._bot_lock(bot_id):
+            meta = self._snapshot.meta.get(bot_id)
+            bot = self.bots_obj.pop(bot_id, None)
+            self._publish({bot_id: None})
+            self._persist(bot_id, None)
+            self.hook_status.pop(bot_id, None)
+        self._retire(bot_id, meta, bot)
+        history_store.drop_bot(bot_id)
+        reply_cache.drop_bot(bot_id)
 
     def restart(self, bot_id: str):
-        with self._lock:
-            self._stop_unlocked(bot_id)
-            self._start_unlocked(bot_id)
+        """كائن جديد من meta الحالية، ثم إعادة ضبط الويبهوك/الاشتراك (لا إلغاء: نفس المعرّفات)."""
+        with self._bot_lock(bot_id):
+            meta = self._snapshot.meta.get(bot_id)
+            if not meta:
+                raise KeyError(f"Unknown bot_id: {bot_id}")
+            self.bots_obj[bot_id] = self._build_safe(bot_id, meta)
+        self._activate(bot_id, meta)
 
     def update(self, bot_id: str, meta_update: dict):
-        with self._lock:
-            old = self.bots_meta.get(bot_id)
+        with self._bot_lock(bot_id):
+            old = self._snapshot.meta.get(bot_id)
             if not old:
                 return
 
-            merged = {**old}
-            for k, v in meta_update.items():
-                if k == "company" and isinstance(v, dict):
-                    merged.setdefault("company", {}).update(v)
-                elif k == "creds" and isinstance(v, dict):
-                    merged.setdefault("creds", {}).update(v)
-                else:
-                    merged[k] = v
-
-            need_restart = self._need_restart_after_update(old, merged)
-            self.bots_meta[bot_id] = merged
-
+            merged = self._merge_meta(old, meta_update)
+            self._publish({bot_id: merged})
+            self._persist(bot_id, merged)
             bot = self.bots_obj.get(bot_id)
-            if need_restart:
-                logging.info("Config changed (requires restart) for %s", bot_id)
-                self._stop_unlocked(bot_id)
-                try:
-                    self._start_unlocked(bot_id)
-                except Exception:
-                    logging.exception("Restart failed for %s", bot_id)
-            else:
-                if bot and hasattr(bot, "update_profile"):
-                    profile = self._build_profile(merged)
-                    new_openai = (merged.get("creds") or {}).get("openai")
-                    try:
-                        bot.update_profile(profile, new_openai)
-                        logging.info("Hot-updated bot %s", bot_id)
-                    except Exception:
-                        logging.exception("Hot update failed for %s", bot_id)
+            rehook = self._refresh_unlocked(bot_id, old, merged)
 
-    # --------------- التوجيه للوِبهُوك ---------------
+        # الشبكة بعد تحرير القفل: إلغاء ويبهوك المعرّفات القديمة وتفعيل الجديدة
+        if rehook:
+            self._retire(bot_id, old, bot)
+            self._activate(bot_id, merged)
 
-    def route_whatsapp(self, value: dict):
+    def _refresh_unlocked(self, bot_id: str, old: dict, merged: dict) -> bool:
         """
-        يستقبل value = payload['entry'][..]['changes'][..]['value'] من /webhooks/whatsapp
-        ونوجهه للبوت المناسب عبر phone_number_id، ولو ما قدرنا، نبعثه لكل بوتات واتساب.
+        (تحت قفل البوت) يعيد بناء الكائن أو يحدّث ملفه الحي حسب التغيير.
+        True إذا تغيّرت معرّفات الويبهوك/الاشتراك (يلزم إلغاء القديم وتفعيل الجديد).
         """
-        phone_id = (value.get("metadata") or {}).get("phone_number_id")
-        targets = []
-
-        with self._lock:
-            for bot_id, meta in self.bots_meta.items():
-                if meta.get("platform") != "whatsapp":
-                    continue
-                bot = self.bots_obj.get(bot_id)
-                if not bot:
-                    continue
-                creds = meta.get("creds") or {}
-                if phone_id and creds.get("waPhoneId") == phone_id:
-                    targets.append(bot)
-
-            if not targets:
-                for bot_id, meta in self.bots_meta.items():
-                    if meta.get("platform") == "whatsapp":
-                        bot = self.bots_obj.get(bot_id)
-                        if bot:
-                            targets.append(bot)
-
-        for bot in targets:
+        bot = self.bots_obj.get(bot_id)
+        if self._need_restart_after_update(old, merged):
+            logging.info("Config changed (requires restart) for %s", bot_id)
+            self.bots_obj[bot_id] = self._build_safe(bot_id, merged)
+            return _hook_key(old) != _hook_key(merged)
+
+        if bot and hasattr(bot, "update_profile"):
+            profile = self._build_profile(merged)
+            new_openai = (merged.get("creds") or {}).get("openai")
             try:
-                bot.handle_webhook(value)  # اسم الدالة في wa_bot.py
+                bot.update_profile(profile, new_openai)
+                logging.info("Hot-updated bot %s", bot_id)
             except Exception:
-                logging.exception("WhatsApp handle_webhook failed")
+                logging.exception("Hot update failed for %s", bot_id)
+        return False
+
+    # --------------- العمليات الجماعية ---------------
+    # نفس دلالات create/update/delete لكن: معاملة SQLite واحدة ثم لقطة واحدة
+    # (فشل السجل يرمي RegistryUnavailable قبل أي تغيير)، ثم طلبات المنصات على
+    # _bulk_executor بعد تحرير كل الأقفال — في الخلفية افتراضيًا (wait=False):
+    # النتيجة تظهر لاحقًا في list() كـ webhook_ok.
 
-    def route_instagram(self, value: dict):
+    def validate(self, meta: dict, seen: Optional[set] = None) -> Optional[str]:
         """
-        يستقبل value = payload['entry'][..]['changes'][..]['value'] من /webhooks/instagram
-        ما في page_id في value مباشرة، لذلك نوجّه لكل بوتات إنستغرام.
+        سبب رفض meta بوت جديد، أو None إذا صالحة.
+        seen: المعرّفات السابقة في نفس الدفعة (تُرفض المكررة، وتُضاف إليها الصالحة).
         """
-        targets = []
-        with self._lock:
-            for bot_id, meta in self.bots_meta.items():
-                if meta.get("platform") != "instagram":
+        platform = meta.get("platform")
+        if platform not in PLATFORMS:
+            return "unsupported platform"
+        if meta.get("id") is not None and (not isinstance(meta["id"], str) or not meta["id"].strip()):
+            return "invalid id"
+        if seen is not None and meta.get("id") is not None:
+            if meta["id"] in seen:
+                return "duplicate id"
+            seen.add(meta["id"])
+        creds = meta.get("creds") or {}
+        if not isinstance(creds, dict):
+            return "invalid creds"
+        missing = [k for k in self._required_creds(platform)
+                   if not isinstance(creds.get(k), str) or not creds[k].strip()]
+        if missing:
+            return "missing creds: " + ", ".join(missing)
+        return None
+
+    def _lock_bots(self, ids) -> ExitStack:
+        """أقفال عدة بوتات بترتيب ثابت (لا deadlock بين عمليتين جماعيتين)."""
+        stack = ExitStack()
+        for bot_id in sorted(set(ids)):
+            stack.enter_context(self._bot_lock(bot_id))
+        return stack
+
+    def _persist_many(self, items: List[Tuple[str, Optional[dict]]]):
+        """(تحت أقفال البوتات وقبل _publish) معاملة واحدة؛ الفشل يرمي RegistryUnavailable."""
+        if not self.registry or not items:
+            return
+        try:
+            self.registry.write_many(items)
+        except Exception as e:
+            logging.exception("Persisting %d bot(s) failed", len(items))
+            raise RegistryUnavailable(str(e)) from e
+
+    @staticmethod
+    def _fan_out(fn, items: list, wait: bool) -> list:
+        """
+        fn(item) لكل عنصر على _bulk_executor (BULK_CONCURRENCY للعملية كلها).
+        wait=True: النتائج بنفس ترتيب items. wait=False: يرجع فورًا و None لكل عنصر.
+        """
+        if not items:
+            return []
+        t0 = time.monotonic()
+        futures = [_bulk_executor().submit(fn, item) for item in items]
+        if not wait:
+            return [None] * len(items)
+        results = [f.result() for f in futures]
+        logging.info("Bulk registration of %d bot(s) took %.1fs", len(items), time.monotonic() - t0)
+        return results
+
+    def create_many(self, metas: List[dict], wait: bool = False) -> List[dict]:
+        """
+        ينشئ/يستبدل عدة بوتات (مُتحقق منها مسبقًا بـ validate). يرجع نتيجة لكل بوت بنفس الترتيب.
+        wait=False: الويبهوك/الاشتراك في الخلفية (webhook_ok=None حتى تظهر النتيجة في list()).
+        """
+        staged = []
+        for meta in metas:
+            meta = dict(meta)
+            meta["id"] = meta.get("id") or self._gen_id()
+            staged.append(meta)
+        if len({m["id"] for m in staged}) != len(staged):
+            raise ValueError("duplicate bot id in batch")
+
+        with self._lock_bots(m["id"] for m in staged):
+            snap = self._snapshot
+            previous = {m["id"]: (snap.meta.get(m["id"]), self.bots_obj.get(m["id"])) for m in staged}
+            self._persist_many([(m["id"], m) for m in staged])
+            self._publish({m["id"]: m for m in staged})
+            for meta in staged:
+                self.bots_obj[meta["id"]] = self._build_safe(meta["id"], meta)
+
+        def register(meta: dict) -> Optional[bool]:
+            old_meta, old_bot = previous[meta["id"]]
+            if _hook_key(old_meta) != _hook_key(meta):
+                self._retire(meta["id"], old_meta, old_bot)
+            return self._activate(meta["id"], meta)
+
+        hooks = self._fan_out(register, staged, wait)
+        return [
+            {"id": m["id"], "ok": True, "active": bool(self.bots_obj.get(m["id"])), "webhook_ok": ok}
+            for m, ok in zip(staged, hooks)
+        ]
+
+    def update_many(self, updates: List[Tuple[str, dict]], wait: bool = False) -> List[dict]:
+        """[(bot_id, meta_update)] → نتيجة لكل بوت (not found للمعرّفات غير المسجلة)."""
+        results: Dict[str, dict] = {}
+        rehook = []  # [(bot_id, old_meta, old_bot, merged)]
+        with self._lock_bots(bot_id for bot_id, _ in updates):
+            merged_all: Dict[str, dict] = {}
+            for bot_id, meta_update in updates:
+                old = merged_all.get(bot_id) or self._snapshot.meta.get(bot_id)
+                if not old:
+                    results[bot_id] = {"id": bot_id, "ok": False, "error": "not found"}
                     continue
+                merged_all[bot_id] = self._merge_meta(old, meta_update)
+
+            snap = self._snapshot
+            self._persist_many(list(merged_all.items()))
+            self._publish(merged_all)
+            for bot_id, merged in merged_all.items():
                 bot = self.bots_obj.get(bot_id)
-                if bot:
-                    targets.append(bot)
+                if self._refresh_unlocked(bot_id, snap.meta[bot_id], merged):
+                    rehook.append((bot_id, snap.meta[bot_id], bot, merged))
+                results[bot_id] = {"id": bot_id, "ok": True, "active": bool(self.bots_obj.get(bot_id, True))}
+
+        def register(item) -> Optional[bool]:
+            bot_id, old, bot, merged = item
+            self._retire(bot_id, old, bot)
+            return self._activate(bot_id, merged)
+
+        for (bot_id, _, _, _), ok in zip(rehook, self._fan_out(register, rehook, wait)):
+            results[bot_id]["webhook_ok"] = ok
+        return [results[bot_id] for bot_id in dict.fromkeys(bot_id for bot_id, _ in updates)]
+
+    def delete_many(self, ids: List[str], wait: bool = False) -> List[dict]:
+        ids = list(dict.fromkeys(ids))
+        with self._lock_bots(ids):
+            found = [bot_id for bot_id in ids if bot_id in self._snapshot.meta]
+            snap = self._snapshot
+            self._persist_many([(bot_id, None) for bot_id in found])
+            bots = [(bot_id, snap.meta[bot_id], self.bots_obj.pop(bot_id, None)) for bot_id in found]
+            self._publish({bot_id: None for bot_id in found})
+            for bot_id in found:
+                self.hook_status.pop(bot_id, None)
+
+        self._fan_out(lambda item: self._retire(*item), bots, wait)
+        for bot_id in found:
+            history_store.drop_bot(bot_id)
+            reply_cache.drop_bot(bot_id)
+        deleted = set(found)
+        return [
+            {"id": bot_id, "ok": True} if bot_id in deleted else {"id": bot_id, "ok": False, "error": "not found"}
+            for bot_id in ids
+        ]
+
+    # --------------- التوجيه للوِبهُوك ---------------
+    # قراءة اللقطة الحالية بدون قفل: التوجيه لا ينتظر create/update/restart أبدًا
+
+    def _count_unroutable(self, platform: str, n: int = 1):
+        with self._lock:
+            self.unroutable[platform] += n
+
+    def _resolve_whatsapp(self, value: dict):
+        """البوت المالك لـ phone_number_id في value، أو None (يُحسب كـ unroutable)."""
+        phone_id = (value.get("metadata") or {}).get("phone_number_id")
+        self.sync()
+        bot_id = self._snapshot.wa.get(phone_id) if phone_id else None
+        bot = self.get_bot(bot_id) if bot_id else None
+
+        if not bot:
+            self._count_unroutable("whatsapp")
+            metrics.inc("webhooks_dropped_total", platform="whatsapp", reason="unroutable")
+            logging.info("[WA route] dropped event for unknown phone_number_id=%s", phone_id)
+            return None
+        metrics.inc("webhooks_routed_total", platform="whatsapp", bot=bot_id)
+        return bot
+
+    def _resolve_instagram(self, value: dict, entry_id: Optional[str] = None) -> list:
+        """[(bot, events)] حسب recipient.id لكل event (أو entry_id إذا غاب)."""
+        grouped: Dict[str, list] = {}
+        bots: Dict[str, object] = {}
+        dropped = 0
+        self.sync()
+        index = self._snapshot.ig
+        for ev in (value.get("messaging") or []):
+            rid = (ev.get("recipient") or {}).get("id") or entry_id
+            bot_id = index.get(rid) if rid else None
+            if bot_id and bot_id not in bots:
+                bots[bot_id] = self.get_bot(bot_id)
+            if not bot_id or not bots[bot_id]:
+                dropped += 1
+                continue
+            grouped.setdefault(bot_id, []).append(ev)
+        targets = [(bots[b], evs) for b, evs in grouped.items()]
+        for b, evs in grouped.items():
+            metrics.inc("webhooks_routed_total", len(evs), platform="instagram", bot=b)
+
+        if dropped:
+            self._count_unroutable("instagram", dropped)
+            metrics.inc("webhooks_dropped_total", dropped, platform="instagram", reason="unroutable")
+            logging.info("[IG route] dropped %d event(s) with unknown recipient (entry=%s)", dropped, entry_id)
+        return targets
+
+    def route_whatsapp(self, value: dict):
+        """
+        يستقبل value = payload['entry'][..]['changes'][..]['value'] من /webhooks/whatsapp
+        ونوجهه للبوت المالك لـ phone_number_id عبر الفهرس. لا يوجد بث لكل البوتات:
+        الأحداث التي لا نعرف صاحبها تُحسب وتُهمل.
+        """
+        bot = self._resolve_whatsapp(value)
+        if not bot:
+            return
+        try:
+            bot.handle_webhook(value)  # اسم الدالة في wa_bot.py
+        except RetryLater:
+            raise
+        except Exception:
+            logging.exception("WhatsApp handle_webhook failed")
 
-        for bot in targets:
+    def route_instagram(self, value: dict, entry_id: Optional[str] = None):
+        """
+        يستقبل value = payload['entry'][..]['changes'][..]['value'] من /webhooks/instagram
+        كل event في value['messaging'] يُوجَّه حسب recipient.id (حساب IG/الصفحة المستلمة)،
+        وإذا غاب نستخدم entry_id. الأحداث التي لا نعرف صاحبها تُحسب وتُهمل.
+        """
+        for bot, events in self._resolve_instagram(value, entry_id):
             try:
-                bot.handle_webhook(value)  # اسم الدالة في ig_bot.py
+                bot.handle_webhook({**value, "messaging": events})  # اسم الدالة في ig_bot.py
+            except RetryLater:
+                raise
             except Exception:
                 logging.exception("Instagram handle_webhook failed")
+
+    # نسخ asyncio (asgi.py): البحث في الفهرس/السجل (SQLite) في ثريد، والمعالجة في الـ loop
+    async def aroute_whatsapp(self, value: dict):
+        bot = await asyncio.to_thread(self._resolve_whatsapp, value)
+        if not bot:
+            return
+        try:
+            await bot.ahandle_webhook(value)
+        except RetryLater:
+            raise
+        except Exception:
+            logging.exception("WhatsApp ahandle_webhook failed")
+
+    async def aroute_instagram(self, value: dict, entry_id: Optional[str] = None):
+        for bot, events in await asyncio.to_thread(self._resolve_instagram, value, entry_id):
+            try:
+                await bot.ahandle_webhook({**value, "messaging": events})
+            except RetryLater:
+                raise
+            except Exception:
+                logging.exception("Instagram ahandle_webhook failed")
+
+    def routing_stats(self) -> dict:
+        snap = self._snapshot
+        with self._lock:
+            unroutable = dict(self.unroutable)
+        return {
+            "whatsapp_keys": len(snap.wa),
+            "instagram_keys": len(snap.ig),
+            "unroutable": unroutable,
+            "registry_seq": self._seen_seq,
+            "snapshot_version": snap.version,
+        }
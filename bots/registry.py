@@ -0,0 +1,213 @@
+# bots/registry.py
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+except ImportError:  # مطلوبة فقط مع BOTS_CREDS_KEY
+    Fernet = InvalidToken = MultiFernet = None
+
+BOTS_DB_PATH = os.getenv("BOTS_DB_PATH", os.path.join("data", "bots.db"))
+# عدد سجلات التغيير التي نحتفظ بها (الـ worker المتأخر أكثر من ذلك يعيد التحميل كاملًا)
+CHANGES_KEEP = int(os.getenv("BOTS_CHANGES_KEEP", "10000"))
+# مفاتيح Fernet لتشفير creds (توكنات المنصات ومفاتيح OpenAI/ElevenLabs) داخل الملف.
+# عدة مفاتيح مفصولة بفواصل للتدوير: الأول يشفّر، وكلها تفك.
+BOTS_CREDS_KEY = os.getenv("BOTS_CREDS_KEY", "")
+DB_FILE_MODE = 0o600
+
+
+class BotRegistry:
+    """
+    سجل دائم لإعدادات البوتات (SQLite بوضع WAL) حتى لا تضيع بعد إعادة النشر أو الكراش.
+    يحفظ meta كما تأتي من الواجهة فقط؛ كائنات البوتات تُبنى في BotManager عند الحاجة.
+
+    كل كتابة تضيف سطرًا في جدول changes برقم تسلسلي (generation) مشترك بين كل
+    workers gunicorn، فيكفي كل worker أن يقرأ التغييرات بعد آخر رقم رآه.
+    """
+
+    def __init__(self, path: str = BOTS_DB_PATH, creds_key: str = BOTS_CREDS_KEY):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._fernet = None
+        keys = [k.strip() for k in (creds_key or "").split(",") if k.strip()]
+        if keys:
+            if MultiFernet is None:
+                raise RuntimeError("BOTS_CREDS_KEY is set but the cryptography package is not installed")
+            self._fernet = MultiFernet([Fernet(k) for k in keys])
+        else:
+            logging.warning("[registry] BOTS_CREDS_KEY not set: bot credentials are stored unencrypted in %s", path)
+
+    def _conn(self) -> sqlite3.Connection:
+        pid = os.getpid()
+        if self._db is None or self._pid != pid:
+            d = os.path.dirname(self.path)
+            if d:
+                os.makedirs(d, mode=0o700, exist_ok=True)
+            self._restrict_file()
+            db = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS bots ("
+                " id TEXT PRIMARY KEY, platform TEXT NOT NULL, meta TEXT NOT NULL, updated REAL NOT NULL)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS changes ("
+                " seq INTEGER PRIMARY KEY AUTOINCREMENT, bot_id TEXT NOT NULL, op TEXT NOT NULL, at REAL NOT NULL)"
+            )
+            self._db, self._pid = db, pid
+        return self._db
+
+    def _restrict_file(self):
+        """
+        الملف للمالك فقط (0600) قبل أن يفتحه SQLite: ملفات -wal و -shm تُنشأ
+        بنفس صلاحيات قاعدة البيانات.
+        """
+        try:
+            os.close(os.open(self.path, os.O_RDWR | os.O_CREAT, DB_FILE_MODE))
+            os.chmod(self.path, DB_FILE_MODE)
+            for suffix in ("-wal", "-shm"):
+                if os.path.exists(self.path + suffix):
+                    os.chmod(self.path + suffix, DB_FILE_MODE)
+        except OSError:
+            logging.warning("[registry] could not restrict permissions of %s", self.path)
+
+    # --------------- تسلسل meta (مع تشفير creds) ---------------
+
+    def _dump(self, meta: dict) -> str:
+        creds = meta.get("creds")
+        if self._fernet is not None and isinstance(creds, dict):
+            token = self._fernet.encrypt(json.dumps(creds, ensure_ascii=False).encode("utf-8"))
+            meta = {**meta, "creds": {"_enc": token.decode("ascii")}}
+        return json.dumps(meta, ensure_ascii=False)
+
+    def _load(self, bot_id: str, raw: str) -> Optional[dict]:
+        try:
+            meta = json.loads(raw)
+        except ValueError:
+            logging.warning("[registry] corrupt meta for %s, skipping", bot_id)
+            return None
+        enc = (meta.get("creds") or {}).get("_enc") if isinstance(meta.get("creds"), dict) else None
+        if enc is None:
+            return meta  # غير مشفّر (قبل ضبط BOTS_CREDS_KEY): يُشفَّر عند الكتابة التالية
+        if self._fernet is None:
+            logging.warning("[registry] encrypted creds for %s but BOTS_CREDS_KEY is not set, skipping", bot_id)
+            return None
+        try:
+            meta["creds"] = json.loads(self._fernet.decrypt(enc.encode("ascii")))
+        except (InvalidToken, ValueError):
+            logging.warning("[registry] cannot decrypt creds for %s (wrong BOTS_CREDS_KEY?), skipping", bot_id)
+            return None
+        return meta
+
+    def load_all(self) -> Dict[str, dict]:
+        out: Dict[str, dict] = {}
+        with self._lock:
+            rows = self._conn().execute("SELECT id, meta FROM bots").fetchall()
+        for bot_id, raw in rows:
+            meta = self._load(bot_id, raw)
+            if meta is not None:
+                out[bot_id] = meta
+        return out
+
+    def get(self, bot_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn().execute("SELECT meta FROM bots WHERE id = ?", (bot_id,)).fetchone()
+        if not row:
+            return None
+        return self._load(bot_id, row[0])
+
+    def _write(self, bot_id: str, op: str, sql: str, params: tuple) -> int:
+        """ينفّذ الكتابة وسطر التغيير في نفس المعاملة ويرجع رقم الـ generation الجديد."""
+        with self._lock:
+            db = self._conn()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.execute(sql, params)
+                cur = db.execute("INSERT INTO changes (bot_id, op, at) VALUES (?, ?, ?)", (bot_id, op, time.time()))
+                seq = cur.lastrowid
+                if seq % 500 == 0:
+                    db.execute("DELETE FROM changes WHERE seq <= ?", (seq - CHANGES_KEEP,))
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+        return seq
+
+    def put(self, bot_id: str, meta: dict) -> int:
+        return self._write(
+            bot_id, "put",
+            "INSERT OR REPLACE INTO bots (id, platform, meta, updated) VALUES (?, ?, ?, ?)",
+            (bot_id, meta.get("platform") or "", self._dump(meta), time.time()),
+        )
+
+    def delete(self, bot_id: str) -> int:
+        return self._write(bot_id, "delete", "DELETE FROM bots WHERE id = ?", (bot_id,))
+
+    def write_many(self, items: List[Tuple[str, Optional[dict]]]) -> int:
+        """
+        [(bot_id, meta أو None للحذف)] في معاملة واحدة (العمليات الجماعية):
+        fsync واحد بدل واحد لكل بوت، والـ workers الأخرى ترى الدفعة كاملة أو لا شيء.
+        """
+        if not items:
+            return self.last_seq()
+        now = time.time()
+        with self._lock:
+            db = self._conn()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                first = None
+                for bot_id, meta in items:
+                    if meta is None:
+                        db.execute("DELETE FROM bots WHERE id = ?", (bot_id,))
+                    else:
+                        db.execute(
+                            "INSERT OR REPLACE INTO bots (id, platform, meta, updated) VALUES (?, ?, ?, ?)",
+                            (bot_id, meta.get("platform") or "", self._dump(meta), now),
+                        )
+                    cur = db.execute(
+                        "INSERT INTO changes (bot_id, op, at) VALUES (?, ?, ?)",
+                        (bot_id, "delete" if meta is None else "put", now),
+                    )
+                    seq = cur.lastrowid
+                    first = first or seq
+                if seq // 500 != (first - 1) // 500:
+                    db.execute("DELETE FROM changes WHERE seq <= ?", (seq - CHANGES_KEEP,))
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+        return seq
+
+    # --------------- مزامنة بين الـ workers ---------------
+
+    def data_version(self) -> int:
+        """
+        PRAGMA data_version يتغير فقط عندما تكتب اتصالات أخرى (workers أخرى) —
+        فحص رخيص جدًا قبل قراءة جدول changes.
+        """
+        with self._lock:
+            return self._conn().execute("PRAGMA data_version").fetchone()[0]
+
+    def last_seq(self) -> int:
+        with self._lock:
+            row = self._conn().execute("SELECT MAX(seq) FROM changes").fetchone()
+        return row[0] or 0
+
+    def changes_since(self, seq: int, limit: int = 1000) -> Tuple[List[Tuple[int, str, str]], int]:
+        """يرجع (التغييرات بعد seq, أصغر seq ما زال محفوظًا)."""
+        with self._lock:
+            db = self._conn()
+            rows = db.execute(
+                "SELECT seq, bot_id, op FROM changes WHERE seq > ? ORDER BY seq LIMIT ?", (seq, limit)
+            ).fetchall()
+            oldest = db.execute("SELECT MIN(seq) FROM changes").fetchone()[0] or 0
+        return rows, oldest
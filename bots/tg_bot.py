@@ -1,17 +1,51 @@
 # bots/tg_bot.py
 # -*- coding: utf-8 -*-
 import io
-from typing import Dict, Optional, List
+import os
+import time
+import logging
+from typing import Dict, Optional, List, Tuple
 
-from telebot import TeleBot
-from telebot.types import Update, Message
+from telebot import TeleBot, apihelper
 
-from services.nlp import generate_reply
-from services.tts import synth_eleven
+from services.nlp import StreamInterrupted, agenerate_reply, generate_reply, generate_reply_stream, is_fallback
+from services.tts import (TTS_STREAM_UPLOAD, astream_eleven, asynth_chunks, split_sentences,
+                          stream_eleven, synth_chunks, synth_eleven)
+from services import async_http, http_client, metrics
+from services.history import BotHistory
+from services import reply_cache
+from services.resilience import RetryLater
+from services.outbox import outbox
 
 
 WELCOME = "مرحبًا {name}! أنا مساعد دعم {company}. أُجيبك فورًا وأرشدك لما تحتاجه."
 
+# الرد التدريجي (streaming) في وضع النص: رسالة أولى سريعة ثم تعديلات متباعدة
+STREAM_REPLIES       = os.getenv("TG_STREAM_REPLIES", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("TG_STREAM_EDIT_INTERVAL", "1.0"))
+STREAM_FIRST_CHARS   = int(os.getenv("TG_STREAM_FIRST_CHARS", "24"))
+TG_MAX_TEXT          = 4096
+# يُلحق بالرسالة إذا انقطع البث في منتصف الرد (الرد الناقص لا يُحفظ في الذاكرة ولا الكاش)
+STREAM_CUT_NOTICE    = "… (انقطع الرد، أعد إرسال سؤالك من فضلك)"
+
+# ما يعالجه البوت من التحديثات: رسائل نصية/صوتية، والأوامر /start و /help (تُفحص قبل الرسالة العادية)
+CONTENT_TYPES = ("text", "voice", "audio")
+COMMANDS      = ("/start", "/help")
+
+# قابل للتغيير للاختبار المحلي (bench/) أو Bot API server خاص
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org").rstrip("/")
+if TELEGRAM_API_BASE != "https://api.telegram.org":
+    apihelper.API_URL = TELEGRAM_API_BASE + "/bot{0}/{1}"
+    apihelper.FILE_URL = TELEGRAM_API_BASE + "/file/bot{0}/{1}"
+
+
+def use_shared_session():
+    """
+    تيليبوت يستخدم apihelper.session (متغير على مستوى العملية) إن وُجدت. تُستدعى مرة واحدة عند
+    بدء كل worker بجوار http_client.prewarm()، فيستخدم كل البوتات الـ pool المشترك لهذا الـ pid.
+    """
+    apihelper.session = http_client.session()
+
 
 def build_system_prompt(company: dict) -> str:
     """
@@ -51,94 +85,338 @@ class TelegramClientBot:
     def __init__(self, bot_id: str, tg_token: str, openai_key: str, profile: dict):
         self.id = bot_id
         self.tg_token = tg_token
-        self.tg = TeleBot(tg_token, parse_mode="HTML")
+        # threaded=False: المعالجة تتم داخل ثريد services.workers نفسه بدل pool تيليبوت الداخلي
+        self.tg = TeleBot(tg_token, parse_mode="HTML", threaded=False)
         self.openai_key = openai_key
         self.profile = profile or {}
-        self.history: Dict[int, List[dict]] = {}  # chat_id -> [{"role":...,"content":...}]
-        self._bind_handlers()
+        self.history = BotHistory(bot_id)  # chat_id -> [{"role":...,"content":...}] (services.history)
+        self.reply_cache = reply_cache.for_bot(bot_id)
 
-    # -------- Handlers --------
-    def _bind_handlers(self):
-        @self.tg.message_handler(content_types=["text", "voice", "audio"])
-        def _on_message(m: Message):
-            self._handle_message(m)
+    # -------- Dispatch --------
+    @staticmethod
+    def _incoming(data: dict) -> Optional[tuple]:
+        """
+        (chat_id, message_id, user_name, content_type, text, command) من الـ update كـ dict مباشرة،
+        بدون Update.de_json و handlers تيليبوت. None للتحديثات التي لا نعالجها.
+        """
+        msg = data.get("message")
+        if not isinstance(msg, dict):
+            return None
+        content_type = next((t for t in CONTENT_TYPES if t in msg), None)
+        if content_type is None:
+            return None
+        frm = msg.get("from") or {}
+        user_name = (frm.get("first_name") or frm.get("username") or "").strip()
+        text = msg.get("text") or ""
+        # "/start@MyBot arg" -> "/start"
+        command = text.split(maxsplit=1)[0].split("@", 1)[0] if text.startswith("/") else ""
+        return ((msg.get("chat") or {}).get("id"), msg.get("message_id"), user_name, content_type, text,
+                command if command in COMMANDS else "")
 
-        @self.tg.message_handler(commands=["start", "help"])
-        def _on_start(m: Message):
-            try:
-                name = (m.from_user.first_name or m.from_user.username or "صديقي").strip()
-                company = (self.profile.get("company") or {}).get("name", "الشركة")
-                self.tg.send_message(m.chat.id, WELCOME.format(name=name, company=company))
-            except Exception as e:
-                print(f"[TG:{self.id}] start/help error:", e)
+    def _welcome_text(self, user_name: str) -> str:
+        company = (self.profile.get("company") or {}).get("name", "الشركة")
+        return WELCOME.format(name=user_name or "صديقي", company=company)
 
-    def _handle_message(self, m: Message):
+    def _handle_message(self, chat_id: int, message_id: Optional[int], user_name: str,
+                        content_type: str, text: str):
         try:
-            chat_id = m.chat.id
-            # اسم المستخدم إن وُجد
-            user_name = ""
-            if getattr(m, "from_user", None):
-                user_name = (m.from_user.first_name or m.from_user.username or "").strip()
-
+            metrics.bind("telegram", self.id, conversation=chat_id)
             sys = build_system_prompt(self.profile.get("company", {}))
 
             # قراءة نص المستخدم (لا تحويل كلام-لنص الآن)
-            if m.content_type == "text":
-                user_text = (m.text or "").strip()
+            if content_type == "text":
+                user_text = text.strip()
             else:
                 user_text = "(أرسل المستخدم رسالة صوتية/ملفًا صوتيًا)"
 
+            # وضع الرد
+            mode = (self.profile.get("reply_mode") or "text").lower()
+            voice_cfg = self.profile.get("voice")  # {"ek": "...", "vid": "..."} أو None
+            streamed = False
+            cache_key = None
+
             # تحية بسيطة
             if user_text in {"مرحبا", "مرحبا.", "مرحبا!", "مرحبًا", "أهلا", "أهلًا", "السلام عليكم"}:
-                reply = WELCOME.format(
-                    name=user_name or "صديقي",
-                    company=self.profile.get("company", {}).get("name", "الشركة")
-                )
+                reply = self._welcome_text(user_name)
             else:
                 hist = self.history.get(chat_id, [])
-                reply = generate_reply(self.openai_key, sys, hist, user_text)
-
-            # تحديث الذاكرة (آخر 30 تبادل)
-            hist = self.history.get(chat_id, [])
-            hist += [{"role": "user", "content": user_text},
-                     {"role": "assistant", "content": reply}]
-            self.history[chat_id] = hist[-30:]
-
-            # وضع الرد
-            mode = (self.profile.get("reply_mode") or "text").lower()
-            voice_cfg = self.profile.get("voice")  # {"ek": "...", "vid": "..."} أو None
+                cache_key, reply = self.reply_cache.lookup(self.profile, hist, user_text)
+                if reply is None:
+                    if mode == "text" and STREAM_REPLIES:
+                        reply, complete = self._stream_reply(chat_id, sys, hist, user_text, reply_to=message_id)
+                        streamed = True
+                    else:
+                        reply = generate_reply(self.openai_key, sys, hist, user_text)
 
-            if mode == "text":
-                self._send_text(chat_id, reply, reply_to=m.message_id)
+            # الإرسال قبل الذاكرة والكاش: طابور ممتلئ يرمي RetryLater (تُعاد الرسالة ولم يُحفظ شيء)
+            if streamed:
+                # أُرسل تدريجيًا أثناء التوليد؛ الرد الناقص أو رسالة التعطّل لا تدخل الذاكرة
+                remember = complete and not is_fallback(reply)
+            elif mode == "text":
+                remember = self._send_text(chat_id, reply, reply_to=message_id)
             elif mode == "voice":
                 if self._can_voice(voice_cfg):
-                    self._send_voice(chat_id, reply, voice_cfg, reply_to=m.message_id)
+                    remember = self._send_voice(chat_id, self._start_voice(reply, voice_cfg), reply_to=message_id)
                 else:
-                    self._send_text(chat_id, reply, reply_to=m.message_id)
-            else:  # both
-                self._send_text(chat_id, reply)
-                if self._can_voice(voice_cfg):
-                    self._send_voice(chat_id, reply, voice_cfg)
+                    remember = self._send_text(chat_id, reply, reply_to=message_id)
+            else:  # both: الصوت يُولَّد بينما يُرسل النص (النص هو ما يقرر التسليم)
+                voice = self._start_voice(reply, voice_cfg) if self._can_voice(voice_cfg) else None
+                try:
+                    remember = self._send_text(chat_id, reply)
+                except RetryLater:
+                    if voice and voice[1] is not None:
+                        voice[1].close()  # الرسالة ستُعاد كاملة: لا نترك مقاطعها تُولَّد في الخلفية
+                    raise
+                if voice:
+                    self._send_voice(chat_id, voice, fallback_text=False)
 
-        except Exception as e:
-            print(f"[TG:{self.id}] handle_message error:", e)
+            # تحديث الكاش والذاكرة (آخر 30 تبادل) بعد قبول الإرسال فقط
+            if remember:
+                self.reply_cache.store(cache_key, reply)
+                hist = self.history.get(chat_id, [])
+                hist += [{"role": "user", "content": user_text},
+                         {"role": "assistant", "content": reply}]
+                self.history[chat_id] = hist[-30:]
+
+        except RetryLater:
+            raise  # services.workers يعيد الرسالة لاحقًا
+        except Exception:
+            logging.exception("[TG:%s] handle_message error", self.id)
             try:
-                self.tg.send_message(m.chat.id, "حدث خطأ بسيط. حاول مرة أخرى لاحقًا.")
+                self._send_text(chat_id, "حدث خطأ بسيط. حاول مرة أخرى لاحقًا.")
             except Exception:
                 pass
 
     # -------- Send helpers --------
-    def _send_text(self, chat_id: int, text: str, reply_to: Optional[int] = None):
-        self.tg.send_message(chat_id, text, reply_to_message_id=reply_to)
+    # الإرسال يمر عبر services.outbox (حدود تيليجرام لكل بوت/محادثة + إعادة المحاولة في الخلفية).
+    # primary = أول ما يُرسل من الرد: إن امتلأ الطابور تُعاد الرسالة كلها (send_or_retry)؛
+    # ما بعده يُرسل متزامنًا بدل الإسقاط (send_or_inline). يرجع هل قُبل الإرسال.
+    def _send(self, primary: bool, chat_id: int, fn, *args, **kwargs) -> bool:
+        send = outbox.send_or_retry if primary else outbox.send_or_inline
+        return send("telegram", self.id, chat_id, fn, *args, **kwargs)
+
+    def _send_text(self, chat_id: int, text: str, reply_to: Optional[int] = None, primary: bool = True) -> bool:
+        return self._send(primary, chat_id, self.tg.send_message, chat_id, text, reply_to_message_id=reply_to)
+
+    def _stream_reply(self, chat_id: int, sys: str, hist: list, user_text: str,
+                      reply_to: Optional[int] = None) -> Tuple[str, bool]:
+        """
+        يرسل الرد تدريجيًا أثناء توليده: رسالة أولى بعد أول بضعة أحرف،
+        ثم edit_message_text كل STREAM_EDIT_INTERVAL ثانية، ثم تعديل نهائي بالنص الكامل.
+        كل الإرسال يمر عبر outbox بنفس مفتاح المحادثة (الترتيب + الحدود): الرسالة الأولى والتعديل
+        النهائي وما زاد عن TG_MAX_TEXT مع إعادة المحاولة؛ التعديلات الوسيطة best-effort، تعديل واحد
+        معلّق على الأكثر، ولا يمكن أن تصل بعد التعديل النهائي (تُتخطى بعد وضعه في الطابور).
+        الطابور الممتلئ قبل ظهور أي شيء يرمي RetryLater (يُغلق البث)؛ بعدها يُكمل الإرسال متزامنًا.
+        يرجع (النص، complete): complete=False إذا انقطع البث في المنتصف — تُنهى الرسالة
+        بما وصل + STREAM_CUT_NOTICE ولا يُحفظ النص في الذاكرة ولا الكاش.
+        """
+        t0 = time.monotonic()
+        text = ""
+        # msg_id/shown يملؤها _stream_first داخل outbox؛ edit_pending/final لتنسيق التعديلات الوسيطة
+        state = {"msg_id": None, "shown": "", "edit_pending": False, "final": False}
+        started = False
+        last_edit = 0.0
+        complete = True
+
+        stream = generate_reply_stream(self.openai_key, sys, hist, user_text)
+        try:
+            while True:
+                try:
+                    delta = next(stream)
+                except StopIteration:
+                    break
+                except StreamInterrupted:
+                    complete = False
+                    break
+                text += delta
+                now = time.monotonic()
+                if not started:
+                    if len(text.strip()) < STREAM_FIRST_CHARS:
+                        continue
+                    self._send(True, chat_id, self._stream_first, chat_id, state, text[:TG_MAX_TEXT], reply_to)
+                    started, last_edit = True, now
+                    logging.info("[TG:%s] stream first message queued after %.0fms", self.id, (now - t0) * 1000)
+                elif (now - last_edit >= STREAM_EDIT_INTERVAL and state["msg_id"] is not None
+                      and not state["edit_pending"]
+                      and len(state["shown"]) < TG_MAX_TEXT and text[:TG_MAX_TEXT] != state["shown"]):
+                    last_edit = now
+                    state["edit_pending"] = True
+                    if not outbox.send("telegram", self.id, chat_id, self._stream_edit, chat_id, state,
+                                       text[:TG_MAX_TEXT]):
+                        state["edit_pending"] = False  # الطابور ممتلئ: نتخطى هذا التعديل الوسيط
+        finally:
+            stream.close()  # RetryLater قبل الرسالة الأولى: لا نترك اتصال OpenAI مفتوحًا
+
+        text = text.strip()
+        if not complete:
+            text = f"{text} {STREAM_CUT_NOTICE}"
+        head, rest = text[:TG_MAX_TEXT], text[TG_MAX_TEXT:]
+        if not started:
+            self._send_text(chat_id, head, reply_to=reply_to)
+        else:
+            state["final"] = True  # تعديل وسيط ما زال في الطابور يُتخطى
+            self._send(False, chat_id, self._stream_final, chat_id, state, head, reply_to)
+        while rest:
+            self._send_text(chat_id, rest[:TG_MAX_TEXT], primary=False)
+            rest = rest[TG_MAX_TEXT:]
+
+        logging.info("[TG:%s] stream total %.0fms (%d chars, complete=%s)",
+                     self.id, (time.monotonic() - t0) * 1000, len(text), complete)
+        return text, complete
+
+    def _stream_first(self, chat_id: int, state: dict, text: str, reply_to: Optional[int]):
+        # نص جزئي بدون parse_mode حتى لا يفشل HTML غير مكتمل
+        sent = self.tg.send_message(chat_id, text, reply_to_message_id=reply_to, parse_mode="")
+        state["shown"], state["msg_id"] = text, sent.message_id
+
+    def _stream_edit(self, chat_id: int, state: dict, text: str):
+        """تعديل وسيط داخل outbox: يُتخطى إن وُضع التعديل النهائي، ولا يُعاد عند الخطأ."""
+        try:
+            if state["final"] or state["msg_id"] is None:
+                return
+            self.tg.edit_message_text(text, chat_id, state["msg_id"], parse_mode="")
+            state["shown"] = text
+        except Exception as e:
+            logging.warning("[TG:%s] stream edit error: %s", self.id, e)
+        finally:
+            state["edit_pending"] = False
+
+    def _stream_final(self, chat_id: int, state: dict, head: str, reply_to: Optional[int]):
+        """
+        التعديل النهائي (داخل outbox بعد _stream_first على نفس المفتاح). الأخطاء المؤقتة تُرمى
+        ليعيدها outbox؛ إن فشلت الرسالة الأولى نهائيًا نرسل الرد كاملًا كرسالة جديدة.
+        """
+        msg_id = state["msg_id"]
+        if msg_id is None:
+            self.tg.send_message(chat_id, head, reply_to_message_id=reply_to)
+            return
+        try:
+            self.tg.edit_message_text(head, chat_id, msg_id)
+        except apihelper.ApiTelegramException as e:
+            if e.error_code == 429 or e.error_code >= 500:
+                raise
+            # HTML غير صالح أو النص لم يتغير: النسخة النصية إن اختلفت عما ظهر
+            if head != state["shown"]:
+                self.tg.edit_message_text(head, chat_id, msg_id, parse_mode="")
+        state["shown"] = head
 
     def _can_voice(self, voice_cfg: Optional[dict]) -> bool:
         return bool(voice_cfg and voice_cfg.get("ek") and voice_cfg.get("vid"))
 
-    def _send_voice(self, chat_id: int, text: str, voice_cfg: dict, reply_to: Optional[int] = None):
+    def _start_voice(self, text: str, voice_cfg: dict):
+        """
+        يبدأ توليد صوت OGG (مقاطع بحدود الجمل بالتوازي) ويرجع (المقاطع، مولّد الصوت، الإعداد).
+        في وضع البث لا يبدأ شيء هنا: كل مقطع يُولَّد ويُرفع داخل مهمة الإرسال.
+        """
+        parts = split_sentences(text)
+        clips = None if TTS_STREAM_UPLOAD else synth_chunks(voice_cfg["ek"], voice_cfg["vid"], parts)
+        return parts, clips, voice_cfg
+
+    def _send_voice(self, chat_id: int, voice: tuple, reply_to: Optional[int] = None,
+                    fallback_text: bool = True) -> bool:
+        """
+        يرسل كل مقطع كـ voice فور جاهزيته. لو فشل التوليد نرسل بقية الرد نصًا
+        (أو لا شيء في وضع both لأن النص أُرسل).
+        في الوضع الصوتي فقط (fallback_text) المقطع الأول هو أول ما يُرسل من الرد (primary).
+        يرجع هل قُبل إرسال المقطع الأول (أو بديله النصي).
+        """
+        parts, clips, voice_cfg = voice
+        if clips is None:
+            for i, part in enumerate(parts):
+                ok = self._send(fallback_text and i == 0, chat_id, self._stream_voice, chat_id, part, voice_cfg,
+                                reply_to if i == 0 else None, fallback_text)
+                if i == 0 and not ok:
+                    return False
+            return True
+        sent = 0
+        deferred = False
+        try:
+            while True:
+                try:
+                    audio_bytes = next(clips, None)
+                except RetryLater:
+                    deferred = True
+                    break
+                if audio_bytes is None:
+                    break
+                ok = self._send(fallback_text and sent == 0, chat_id, self._post_voice, chat_id, audio_bytes,
+                                reply_to if sent == 0 else None)
+                if sent == 0 and not ok:
+                    return False
+                sent += 1
+        except RetryLater:
+            raise  # الطابور ممتلئ قبل أول مقطع: تُعاد الرسالة كلها
+        except Exception:
+            logging.exception("[TG:%s] voice error", self.id)
+            if fallback_text and parts[sent:]:
+                return (self._send_text(chat_id, " ".join(parts[sent:]), reply_to=reply_to if sent == 0 else None,
+                                        primary=sent == 0) or sent > 0)
+            return True
+        finally:
+            clips.close()  # يلغي توليد المقاطع المتبقية إن خرجنا مبكرًا
+        if deferred:
+            # ElevenLabs طلب الانتظار: بقية المقاطع تُولَّد داخل outbox (إعادة مجدولة بدل النوم)
+            for i, part in enumerate(parts[sent:], sent):
+                ok = self._send(fallback_text and i == 0, chat_id, self._synth_voice, chat_id, part, voice_cfg,
+                                reply_to if i == 0 else None, fallback_text)
+                if i == 0 and not ok:
+                    return False
+        return True
+
+    def _synth_voice(self, chat_id: int, text: str, voice_cfg: dict, reply_to: Optional[int] = None,
+                     fallback_text: bool = True):
         """
-        يُنتج صوت OGG مناسب لإرساله كـ voice في تيليجرام.
+        مقطع مؤجل داخل outbox: synth_eleven يرمي RetryLater فيُعاد جدولة الإرسال،
+        وإن فشل نهائيًا يُرسل المقطع نصًا (إلا في وضع both).
         """
-        audio_bytes = synth_eleven(voice_cfg["ek"], voice_cfg["vid"], text)
+        try:
+            audio_bytes = synth_eleven(voice_cfg["ek"], voice_cfg["vid"], text)
+        except RetryLater:
+            raise
+        except Exception:
+            logging.exception("[TG:%s] voice error", self.id)
+            if fallback_text:
+                self.tg.send_message(chat_id, text, reply_to_message_id=reply_to)
+            return
+        self._post_voice(chat_id, audio_bytes, reply_to)
+
+    def _stream_voice(self, chat_id: int, text: str, voice_cfg: dict, reply_to: Optional[int] = None,
+                      fallback_text: bool = True):
+        """
+        وضع البث: الصوت من ElevenLabs يُمرَّر مباشرة لـ sendVoice كـ multipart بترميز chunked.
+        إعادة المحاولة (outbox) تطلب البث من جديد: الرفع المقطوع لا يُكمل تنزيله ولا يُحفظ في الكاش.
+        """
+        try:
+            audio = stream_eleven(voice_cfg["ek"], voice_cfg["vid"], text)
+        except Exception:
+            logging.exception("[TG:%s] voice error", self.id)
+            if fallback_text:
+                self.tg.send_message(chat_id, text, reply_to_message_id=reply_to)
+            return
+        fields = {"chat_id": chat_id}
+        if reply_to:
+            fields["reply_to_message_id"] = reply_to
+        ctype, body = http_client.multipart_stream(fields, "voice", "voice.ogg", "audio/ogg", audio)
+        try:
+            r = http_client.post(f"{TELEGRAM_API_BASE}/bot{self.tg_token}/sendVoice", data=body,
+                                 headers={"Content-Type": ctype}, timeout=60)
+        finally:
+            audio.close()  # يغلق رد ElevenLabs حتى لو فشل الرفع قبل قراءته
+        self._check(r, "sendVoice")
+
+    def _check(self, r, method: str) -> dict:
+        """رد Bot API: الأخطاء تُرمى كـ ApiTelegramException (نفس ما يفحصه services.outbox)."""
+        try:
+            body = r.json()
+        except ValueError:
+            r.raise_for_status()
+            raise
+        if not body.get("ok"):
+            raise apihelper.ApiTelegramException(method, r, body)
+        return body.get("result")
+
+    def _post_voice(self, chat_id: int, audio_bytes: bytes, reply_to: Optional[int] = None):
+        # BytesIO جديد لكل محاولة (إعادة الإرسال تقرأ الملف من البداية)
         self.tg.send_voice(chat_id, io.BytesIO(audio_bytes), reply_to_message_id=reply_to)
 
     # -------- Webhook integration --------
@@ -147,11 +425,173 @@ class TelegramClientBot:
         تُستدعى من مسار الويبهوك في Flask:
             bot.process_update(request.get_json())
         """
+        incoming = self._incoming(data)
+        if incoming is None:
+            return
+        chat_id, message_id, user_name, content_type, text, command = incoming
+        if command:
+            try:
+                self._send_text(chat_id, self._welcome_text(user_name))
+            except RetryLater:
+                raise
+            except Exception:
+                logging.exception("[TG:%s] start/help error", self.id)
+            return
+        self._handle_message(chat_id, message_id, user_name, content_type, text)
+
+    # -------- asyncio (asgi.py) --------
+    async def aprocess_update(self, data: dict):
+        """
+        نسخة asyncio من process_update: نفس _incoming، والإرسال عبر Bot API على services.async_http.
+        """
+        incoming = self._incoming(data)
+        if incoming is None:
+            return
+        chat_id, message_id, user_name, content_type, text, command = incoming
         try:
-            upd = Update.de_json(data)
-            self.tg.process_new_updates([upd])
-        except Exception as e:
-            print(f"[TG:{self.id}] process_update error:", e)
+            if command:
+                await self._asend_text(chat_id, self._welcome_text(user_name))
+                return
+            await self._ahandle_message(chat_id, message_id, user_name, content_type, text)
+        except RetryLater:
+            raise
+        except Exception:
+            logging.exception("[TG:%s] aprocess_update error", self.id)
+
+    async def _ahandle_message(self, chat_id: int, message_id: Optional[int], user_name: str,
+                               content_type: str, text: str):
+        """نسخة asyncio من _handle_message (بدون الرد التدريجي)."""
+        try:
+            metrics.bind("telegram", self.id, conversation=chat_id)
+            sys = build_system_prompt(self.profile.get("company", {}))
+            if content_type == "text":
+                user_text = text.strip()
+            else:
+                user_text = "(أرسل المستخدم رسالة صوتية/ملفًا صوتيًا)"
+
+            mode = (self.profile.get("reply_mode") or "text").lower()
+            voice_cfg = self.profile.get("voice")
+
+            # الذاكرة (SQLite) في ثريد: قراءة واحدة، والكتابة بعد قبول الإرسال فقط
+            hist = await self.history.aget(chat_id, [])
+            cache_key = None
+            if user_text in {"مرحبا", "مرحبا.", "مرحبا!", "مرحبًا", "أهلا", "أهلًا", "السلام عليكم"}:
+                reply = self._welcome_text(user_name)
+            else:
+                cache_key, reply = self.reply_cache.lookup(self.profile, hist, user_text)
+                if reply is None:
+                    reply = await agenerate_reply(self.openai_key, sys, hist, user_text)
+
+            if mode == "text":
+                remember = await self._asend_text(chat_id, reply, reply_to=message_id)
+            elif mode == "voice":
+                if self._can_voice(voice_cfg):
+                    remember = await self._asend_voice(chat_id, self._astart_voice(reply, voice_cfg),
+                                                       reply_to=message_id)
+                else:
+                    remember = await self._asend_text(chat_id, reply, reply_to=message_id)
+            else:  # both
+                voice = self._astart_voice(reply, voice_cfg) if self._can_voice(voice_cfg) else None
+                try:
+                    remember = await self._asend_text(chat_id, reply)
+                except BaseException:
+                    if voice and voice[1] is not None:
+                        await voice[1].aclose()
+                    raise
+                if voice:
+                    await self._asend_voice(chat_id, voice, fallback_text=False)
+
+            # مثل المسار المتزامن: الكاش والذاكرة بعد تسليم الرد فقط، ورسالة التعطّل لا تُحفظ
+            if remember and not is_fallback(reply):
+                self.reply_cache.store(cache_key, reply)
+                hist += [{"role": "user", "content": user_text},
+                         {"role": "assistant", "content": reply}]
+                await self.history.aset(chat_id, hist[-30:])
+
+        except RetryLater:
+            raise
+        except Exception:
+            logging.exception("[TG:%s] handle_message error", self.id)
+            try:
+                await self._asend_text(chat_id, "حدث خطأ بسيط. حاول مرة أخرى لاحقًا.")
+            except Exception:
+                pass
+
+    async def _asend_text(self, chat_id: int, text: str, reply_to: Optional[int] = None) -> bool:
+        data = {"chat_id": chat_id, "text": text, "parse_mode": "HTML"}
+        if reply_to:
+            data["reply_to_message_id"] = reply_to
+        return await outbox.asend("telegram", self.id, chat_id, self._acall, "sendMessage", data)
+
+    def _astart_voice(self, text: str, voice_cfg: dict):
+        parts = split_sentences(text)
+        clips = None if TTS_STREAM_UPLOAD else asynth_chunks(voice_cfg["ek"], voice_cfg["vid"], parts)
+        return parts, clips, voice_cfg
+
+    async def _asend_voice(self, chat_id: int, voice: tuple, reply_to: Optional[int] = None,
+                           fallback_text: bool = True) -> bool:
+        """يرجع هل سُلِّم المقطع الأول (أو بديله النصي)، كما في _send_voice."""
+        parts, clips, voice_cfg = voice
+        if clips is None:
+            for i, part in enumerate(parts):
+                ok = await outbox.asend("telegram", self.id, chat_id, self._astream_voice, chat_id, part, voice_cfg,
+                                        reply_to if i == 0 else None, fallback_text)
+                if i == 0 and not ok:
+                    return False
+            return True
+        sent = 0
+        try:
+            async for audio_bytes in clips:
+                data = {"chat_id": chat_id}
+                if reply_to and sent == 0:
+                    data["reply_to_message_id"] = reply_to
+                ok = await outbox.asend("telegram", self.id, chat_id, self._acall, "sendVoice", data,
+                                        {"voice": ("voice.ogg", audio_bytes, "audio/ogg")})
+                if sent == 0 and not ok:
+                    return False
+                sent += 1
+        except RetryLater:
+            raise
+        except Exception:
+            logging.exception("[TG:%s] voice error", self.id)
+            if fallback_text and parts[sent:]:
+                return (await self._asend_text(chat_id, " ".join(parts[sent:]),
+                                               reply_to=reply_to if sent == 0 else None) or sent > 0)
+        finally:
+            await clips.aclose()  # يلغي توليد المقاطع المتبقية إن خرجنا مبكرًا
+        return True
+
+    async def _astream_voice(self, chat_id: int, text: str, voice_cfg: dict, reply_to: Optional[int] = None,
+                             fallback_text: bool = True):
+        try:
+            audio = await astream_eleven(voice_cfg["ek"], voice_cfg["vid"], text)
+        except Exception:
+            logging.exception("[TG:%s] voice error", self.id)
+            if fallback_text:
+                data = {"chat_id": chat_id, "text": text, "parse_mode": "HTML"}
+                if reply_to:
+                    data["reply_to_message_id"] = reply_to
+                await self._acall("sendMessage", data)
+            return
+        fields = {"chat_id": chat_id}
+        if reply_to:
+            fields["reply_to_message_id"] = reply_to
+        ctype, body = http_client.multipart_stream(fields, "voice", "voice.ogg", "audio/ogg", audio)
+        try:
+            r = await async_http.post(f"{TELEGRAM_API_BASE}/bot{self.tg_token}/sendVoice", content=body,
+                                      headers={"Content-Type": ctype}, timeout=60)
+        finally:
+            await audio.aclose()
+        self._check(r, "sendVoice")
+
+    async def _acall(self, method: str, data: dict, files: Optional[dict] = None) -> dict:
+        """طلب Bot API. الأخطاء تُرمى كـ ApiTelegramException (نفس ما يفحصه services.outbox)."""
+        url = f"{TELEGRAM_API_BASE}/bot{self.tg_token}/{method}"
+        if files:
+            r = await async_http.post(url, data=data, files=files)
+        else:
+            r = await async_http.post(url, json=data)
+        return self._check(r, method)
 
     # -------- Lifecycle --------
     def start(self):
@@ -176,4 +616,5 @@ class TelegramClientBot:
         if new_openai:
             self.openai_key = new_openai
         self.profile = new_profile
+        self.reply_cache.clear()
 
@@ -1,14 +1,21 @@
 # bots/wa_bot.py
 # -*- coding: utf-8 -*-
 import io
-import json
-import time
-import requests
+import os
+import functools
 from typing import Dict, Any, Optional
-from services.nlp import generate_reply
-from services.tts import synth_eleven
+from services import async_http, http_client, metrics
+from services.aio import runner
+from services.nlp import agenerate_reply, generate_reply, is_fallback
+from services.tts import (TTS_STREAM_UPLOAD, astream_eleven, asynth_chunks, split_sentences,
+                          stream_eleven, synth_chunks, synth_eleven)
+from services.history import BotHistory
+from services import reply_cache
+from services.coalesce import coalescer
+from services.outbox import outbox
+from services.resilience import RetryLater
 
-GRAPH = "https://graph.facebook.com/v19.0"
+GRAPH = os.getenv("GRAPH_API_BASE", "https://graph.facebook.com/v19.0")
 
 class WhatsAppCloudBot:
     """
@@ -22,21 +29,53 @@ class WhatsAppCloudBot:
         self.phone_number_id = phone_number_id
         self.openai_key = openai_key
         self.profile = profile
-        self.history: Dict[str, list] = {}  # wa_user -> chat history
+        self.history = BotHistory(bot_id)  # wa_user -> chat history (services.history)
+        self.reply_cache = reply_cache.for_bot(bot_id)
 
     # ========= إرسال =========
     def _headers(self):
         return {"Authorization": f"Bearer {self.token}"}
 
-    def send_text(self, to: str, text: str):
-        url = f"{GRAPH}/{self.phone_number_id}/messages"
-        payload = {
+    # send_text / send_voice تضع الإرسال في services.outbox وترجع فورًا
+    # (حدود واتساب لكل رقم/مستخدم، ترتيب المحادثة، وإعادة المحاولة في الخلفية).
+    # primary = أول ما يُرسل من الرد: إن امتلأ الطابور تُعاد الرسالة كلها (send_or_retry)؛
+    # ما بعده يُرسل متزامنًا بدل الإسقاط (send_or_inline). يرجع هل قُبل الإرسال.
+    def _send(self, primary: bool, to: str, fn, *args) -> bool:
+        send = outbox.send_or_retry if primary else outbox.send_or_inline
+        return send("whatsapp", self.phone_number_id, to, fn, *args)
+
+    def send_text(self, to: str, text: str, primary: bool = True) -> bool:
+        return self._send(primary, to, self._post_text, to, text)
+
+    def send_voice(self, to: str, audio_bytes: bytes, primary: bool = True) -> bool:
+        return self._send(primary, to, self._post_voice, to, audio_bytes)
+
+    def _text_payload(self, to: str, text: str) -> dict:
+        return {
             "messaging_product": "whatsapp",
             "to": to,
             "type": "text",
             "text": {"preview_url": False, "body": text}
         }
-        r = requests.post(url, headers=self._headers(), json=payload, timeout=30)
+
+    def _audio_payload(self, to: str, media_id: str) -> dict:
+        return {
+            "messaging_product": "whatsapp",
+            "to": to,
+            "type": "audio",
+            "audio": {"id": media_id}
+        }
+
+    def _media_files(self, audio_bytes: bytes, filename: str) -> dict:
+        return {
+            "file": (filename, io.BytesIO(audio_bytes), "audio/ogg"),
+            "type": (None, "audio/ogg"),
+            "messaging_product": (None, "whatsapp")
+        }
+
+    def _post_text(self, to: str, text: str):
+        url = f"{GRAPH}/{self.phone_number_id}/messages"
+        r = http_client.post(url, headers=self._headers(), json=self._text_payload(to, text))
         r.raise_for_status()
         return r.json()
 
@@ -45,26 +84,183 @@ class WhatsAppCloudBot:
         يرفع ملف صوت إلى واتساب ويرجع media_id
         """
         url = f"{GRAPH}/{self.phone_number_id}/media"
-        files = {
-            "file": (filename, io.BytesIO(audio_bytes), "audio/ogg"),
-            "type": (None, "audio/ogg"),
-            "messaging_product": (None, "whatsapp")
-        }
-        r = requests.post(url, headers=self._headers(), files=files, timeout=60)
+        with metrics.timer("wa_upload"):
+            r = http_client.post(url, headers=self._headers(), files=self._media_files(audio_bytes, filename), timeout=60)
         r.raise_for_status()
         data = r.json()
         return data.get("id")
 
-    def send_voice(self, to: str, audio_bytes: bytes):
+    def _post_voice(self, to: str, audio_bytes: bytes):
         media_id = self._upload_audio(audio_bytes)
         url = f"{GRAPH}/{self.phone_number_id}/messages"
-        payload = {
-            "messaging_product": "whatsapp",
-            "to": to,
-            "type": "audio",
-            "audio": {"id": media_id}
-        }
-        r = requests.post(url, headers=self._headers(), json=payload, timeout=30)
+        r = http_client.post(url, headers=self._headers(), json=self._audio_payload(to, media_id))
+        r.raise_for_status()
+        return r.json()
+
+    # ========= الصوت =========
+    def _start_voice(self, text: str, voice_cfg: dict):
+        """
+        يبدأ توليد الصوت (مقاطع بحدود الجمل بالتوازي) ويرجع (المقاطع، مولّد الصوت، الإعداد).
+        في وضع البث لا يبدأ شيء هنا: كل مقطع يُولَّد ويُرفع داخل مهمة الإرسال.
+        """
+        parts = split_sentences(text)
+        clips = None if TTS_STREAM_UPLOAD else synth_chunks(voice_cfg["ek"], voice_cfg["vid"], parts)
+        return parts, clips, voice_cfg
+
+    def _deliver_voice(self, to: str, voice: tuple, fallback_text: bool = True) -> bool:
+        """
+        كل مقطع يُرفع ويُرسل فور جاهزيته؛ ما فشل توليده يُرسل نصًا (إلا في وضع both).
+        في الوضع الصوتي فقط (fallback_text) المقطع الأول هو أول ما يُرسل من الرد (primary).
+        يرجع هل قُبل إرسال المقطع الأول (أو بديله النصي).
+        """
+        parts, clips, voice_cfg = voice
+        if clips is None:
+            for i, part in enumerate(parts):
+                if not self._send(fallback_text and i == 0, to, self._stream_voice, to, part, voice_cfg,
+                                  fallback_text) and i == 0:
+                    return False
+            return True
+        sent = 0
+        deferred = False
+        try:
+            while True:
+                try:
+                    audio = next(clips, None)
+                except RetryLater:
+                    deferred = True
+                    break
+                if audio is None:
+                    break
+                if not self.send_voice(to, audio, primary=fallback_text and sent == 0) and sent == 0:
+                    return False
+                sent += 1
+        except RetryLater:
+            raise  # الطابور ممتلئ قبل أول مقطع: تُعاد الرسالة كلها
+        except Exception:
+            if fallback_text and parts[sent:]:
+                return self.send_text(to, " ".join(parts[sent:]), primary=sent == 0) or sent > 0
+            return True
+        finally:
+            clips.close()  # يلغي توليد المقاطع المتبقية إن خرجنا مبكرًا
+        if deferred:
+            # ElevenLabs طلب الانتظار: بقية المقاطع تُولَّد داخل outbox (إعادة مجدولة بدل النوم)
+            for i, part in enumerate(parts[sent:], sent):
+                if not self._send(fallback_text and i == 0, to, self._synth_voice, to, part, voice_cfg,
+                                  fallback_text) and i == 0:
+                    return False
+        return True
+
+    def _synth_voice(self, to: str, text: str, voice_cfg: dict, fallback_text: bool = True):
+        """مقطع مؤجل داخل outbox: RetryLater يعيد جدولة الإرسال، والفشل النهائي يُرسل المقطع نصًا."""
+        try:
+            audio = synth_eleven(voice_cfg["ek"], voice_cfg["vid"], text)
+        except RetryLater:
+            raise
+        except Exception:
+            if fallback_text:
+                self._post_text(to, text)
+            return
+        return self._post_voice(to, audio)
+
+    def _stream_voice(self, to: str, text: str, voice_cfg: dict, fallback_text: bool = True):
+        """وضع البث: الصوت من ElevenLabs يُمرَّر مباشرة لرفع /media (multipart بترميز chunked)."""
+        try:
+            audio = stream_eleven(voice_cfg["ek"], voice_cfg["vid"], text)
+        except Exception:
+            if fallback_text:
+                self._post_text(to, text)
+            return
+        ctype, body = http_client.multipart_stream(
+            {"type": "audio/ogg", "messaging_product": "whatsapp"}, "file", "voice.ogg", "audio/ogg", audio)
+        try:
+            with metrics.timer("wa_upload"):
+                r = http_client.post(f"{GRAPH}/{self.phone_number_id}/media", data=body,
+                                     headers={**self._headers(), "Content-Type": ctype}, timeout=60)
+        finally:
+            audio.close()  # يغلق رد ElevenLabs حتى لو فشل الرفع قبل قراءته
+        r.raise_for_status()
+        media_id = r.json().get("id")
+        r = http_client.post(f"{GRAPH}/{self.phone_number_id}/messages", headers=self._headers(),
+                             json=self._audio_payload(to, media_id))
+        r.raise_for_status()
+        return r.json()
+
+    # ========= إرسال (asyncio) =========
+    async def asend_text(self, to: str, text: str) -> bool:
+        return await outbox.asend("whatsapp", self.phone_number_id, to, self._apost_text, to, text)
+
+    async def asend_voice(self, to: str, audio_bytes: bytes) -> bool:
+        return await outbox.asend("whatsapp", self.phone_number_id, to, self._apost_voice, to, audio_bytes)
+
+    async def _apost_text(self, to: str, text: str):
+        url = f"{GRAPH}/{self.phone_number_id}/messages"
+        r = await async_http.post(url, headers=self._headers(), json=self._text_payload(to, text))
+        r.raise_for_status()
+        return r.json()
+
+    async def _aupload_audio(self, audio_bytes: bytes, filename: str = "voice.ogg") -> str:
+        url = f"{GRAPH}/{self.phone_number_id}/media"
+        with metrics.timer("wa_upload"):
+            r = await async_http.post(url, headers=self._headers(), files=self._media_files(audio_bytes, filename), timeout=60)
+        r.raise_for_status()
+        return r.json().get("id")
+
+    async def _apost_voice(self, to: str, audio_bytes: bytes):
+        media_id = await self._aupload_audio(audio_bytes)
+        url = f"{GRAPH}/{self.phone_number_id}/messages"
+        r = await async_http.post(url, headers=self._headers(), json=self._audio_payload(to, media_id))
+        r.raise_for_status()
+        return r.json()
+
+    def _astart_voice(self, text: str, voice_cfg: dict):
+        parts = split_sentences(text)
+        clips = None if TTS_STREAM_UPLOAD else asynth_chunks(voice_cfg["ek"], voice_cfg["vid"], parts)
+        return parts, clips, voice_cfg
+
+    async def _adeliver_voice(self, to: str, voice: tuple, fallback_text: bool = True) -> bool:
+        """نسخة asyncio من _deliver_voice: يرجع هل سُلِّم المقطع الأول (أو بديله النصي)."""
+        parts, clips, voice_cfg = voice
+        if clips is None:
+            for i, part in enumerate(parts):
+                ok = await outbox.asend("whatsapp", self.phone_number_id, to, self._astream_voice, to, part,
+                                        voice_cfg, fallback_text)
+                if i == 0 and not ok:
+                    return False
+            return True
+        sent = 0
+        try:
+            async for audio in clips:
+                if not await self.asend_voice(to, audio) and sent == 0:
+                    return False
+                sent += 1
+        except RetryLater:
+            raise
+        except Exception:
+            if fallback_text and parts[sent:]:
+                return await self.asend_text(to, " ".join(parts[sent:])) or sent > 0
+        finally:
+            await clips.aclose()  # يلغي توليد المقاطع المتبقية إن خرجنا مبكرًا
+        return True
+
+    async def _astream_voice(self, to: str, text: str, voice_cfg: dict, fallback_text: bool = True):
+        try:
+            audio = await astream_eleven(voice_cfg["ek"], voice_cfg["vid"], text)
+        except Exception:
+            if fallback_text:
+                await self._apost_text(to, text)
+            return
+        ctype, body = http_client.multipart_stream(
+            {"type": "audio/ogg", "messaging_product": "whatsapp"}, "file", "voice.ogg", "audio/ogg", audio)
+        try:
+            with metrics.timer("wa_upload"):
+                r = await async_http.post(f"{GRAPH}/{self.phone_number_id}/media", content=body,
+                                          headers={**self._headers(), "Content-Type": ctype}, timeout=60)
+        finally:
+            await audio.aclose()
+        r.raise_for_status()
+        media_id = r.json().get("id")
+        r = await async_http.post(f"{GRAPH}/{self.phone_number_id}/messages", headers=self._headers(),
+                                  json=self._audio_payload(to, media_id))
         r.raise_for_status()
         return r.json()
 
@@ -72,55 +268,101 @@ class WhatsAppCloudBot:
     def handle_webhook(self, value: Dict[str, Any]):
         """
         يستقبل value = payload['entry'][...]['changes'][...]['value']
-        ويعالج أول رسالة واردة.
+        ويعالج كل الرسائل الواردة فيه. الرسائل المتتالية من نفس المستخدم تُدمج
+        (services.coalesce) في طلب OpenAI واحد ورد واحد.
         """
+        for from_, user_text in self._incoming(value):
+            coalescer.add((self.id, from_), user_text, lambda text, to=from_: self._reply(to, text))
+
+    async def ahandle_webhook(self, value: Dict[str, Any]):
+        """نسخة asyncio: الرد المدمج يُنفَّذ كمهمة في services.aio بدل ثريد."""
+        for from_, user_text in self._incoming(value):
+            coalescer.add((self.id, from_), user_text, functools.partial(self._areply, from_),
+                          submit=runner.submit_threadsafe)
+
+    def _incoming(self, value: Dict[str, Any]):
+        """(from_, user_text) لكل رسالة في الـ value."""
         msgs = (value or {}).get("messages") or []
-        if not msgs:
-            return  # لا رسائل
-
-        msg = msgs[0]
-        from_ = msg.get("from")             # رقم المستخدم (MSISDN)
-        mtype = msg.get("type")
-        user_text = ""
-        if mtype == "text":
-            user_text = (msg.get("text", {}).get("body") or "").strip()
-        elif mtype in ("audio", "voice"):
-            user_text = "(المستخدم أرسل رسالة صوتية)"
-        else:
-            user_text = "(نوع رسالة غير نصية)"
+        for msg in msgs:
+            from_ = msg.get("from")             # رقم المستخدم (MSISDN)
+            if not from_:
+                continue
+            mtype = msg.get("type")
+            if mtype == "text":
+                user_text = (msg.get("text", {}).get("body") or "").strip()
+            elif mtype in ("audio", "voice"):
+                user_text = "(المستخدم أرسل رسالة صوتية)"
+            else:
+                user_text = "(نوع رسالة غير نصية)"
+            yield from_, user_text
 
+    def _reply(self, from_: str, user_text: str):
+        metrics.bind("whatsapp", self.id, conversation=from_)
         # نبني الـ system prompt من بروفايل الشركة
         sys = self._build_system_prompt(self.profile.get("company", {}))
 
         # الرد من OpenAI
         hist = self.history.get(from_, [])
-        reply = generate_reply(self.openai_key, sys, hist, user_text)
+        cache_key, reply = self.reply_cache.lookup(self.profile, hist, user_text)
+        if reply is None:
+            reply = generate_reply(self.openai_key, sys, hist, user_text)
 
-        # نحفظ آخر 30 تفاعل
-        hist += [{"role": "user", "content": user_text}, {"role": "assistant", "content": reply}]
-        self.history[from_] = hist[-30:]
-
-        # وضع الرد
+        # وضع الرد — الإرسال قبل الذاكرة والكاش: طابور ممتلئ يرمي RetryLater (تُعاد الرسالة ولم يُحفظ شيء)
         mode = self.profile.get("reply_mode", "text")
         voice_cfg = self.profile.get("voice")  # {"ek","vid"} أو None
 
         if mode == "text" or not voice_cfg:
-            self.send_text(from_, reply)
+            delivered = self.send_text(from_, reply)
         elif mode == "voice":
+            delivered = self._deliver_voice(from_, self._start_voice(reply, voice_cfg))
+        else:  # both: الصوت يُولَّد بينما يُرسل النص (النص هو ما يقرر التسليم)
+            voice = self._start_voice(reply, voice_cfg)
             try:
-                audio = synth_eleven(voice_cfg["ek"], voice_cfg["vid"], reply)
-                self.send_voice(from_, audio)
-            except Exception:
-                # fallback نصي
-                self.send_text(from_, reply)
+                delivered = self.send_text(from_, reply)
+            except RetryLater:
+                if voice[1] is not None:
+                    voice[1].close()  # الرسالة ستُعاد كاملة: لا نترك مقاطعها تُولَّد في الخلفية
+                raise
+            self._deliver_voice(from_, voice, fallback_text=False)
+
+        # نحفظ الكاش وآخر 30 تفاعل بعد قبول الإرسال فقط
+        if delivered:
+            self.reply_cache.store(cache_key, reply)
+            hist += [{"role": "user", "content": user_text}, {"role": "assistant", "content": reply}]
+            self.history[from_] = hist[-30:]
+
+    async def _areply(self, from_: str, user_text: str):
+        """نسخة asyncio من _reply (نفس الكاش والذاكرة ووضع الرد)."""
+        metrics.bind("whatsapp", self.id, conversation=from_)
+        sys = self._build_system_prompt(self.profile.get("company", {}))
+
+        hist = await self.history.aget(from_, [])  # SQLite في ثريد
+        cache_key, reply = self.reply_cache.lookup(self.profile, hist, user_text)
+        if reply is None:
+            reply = await agenerate_reply(self.openai_key, sys, hist, user_text)
+
+        mode = self.profile.get("reply_mode", "text")
+        voice_cfg = self.profile.get("voice")
+
+        if mode == "text" or not voice_cfg:
+            delivered = await self.asend_text(from_, reply)
+        elif mode == "voice":
+            delivered = await self._adeliver_voice(from_, self._astart_voice(reply, voice_cfg))
         else:  # both
-            self.send_text(from_, reply)
-            if voice_cfg:
-                try:
-                    audio = synth_eleven(voice_cfg["ek"], voice_cfg["vid"], reply)
-                    self.send_voice(from_, audio)
-                except Exception:
-                    pass
+            voice = self._astart_voice(reply, voice_cfg)
+            try:
+                delivered = await self.asend_text(from_, reply)
+            except BaseException:
+                if voice[1] is not None:
+                    await voice[1].aclose()
+                raise
+            await self._adeliver_voice(from_, voice, fallback_text=False)
+
+        # مثل _reply: الكاش والذاكرة بعد تسليم الرد فقط، ورسالة التعطّل لا تُحفظ
+        if delivered and not is_fallback(reply):
+            self.reply_cache.store(cache_key, reply)
+            hist += [{"role": "user", "content": user_text}, {"role": "assistant", "content": reply}]
+            await self.history.aset(from_, hist[-30:])
 
     # ========= أدوات =========
     def _build_system_prompt(self, company: dict) -> str:
@@ -143,3 +385,4 @@ class WhatsAppCloudBot:
         if new_openai:
             self.openai_key = new_openai
         self.profile = new_profile
+        self.reply_cache.clear()
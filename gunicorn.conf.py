@@ -0,0 +1,35 @@
+# gunicorn.conf.py
+# -*- coding: utf-8 -*-
+"""
+يُحمَّل تلقائيًا من gunicorn (./gunicorn.conf.py) مع:  gunicorn app:app
+
+التسخين (فتح اتصالات keep-alive مع المزوّدين) يجب أن يحدث في كل worker:
+services.http_client.session() لكل pid، فتسخين الـ master مع --preload يضيع بعد fork.
+
+عند خروج الـ worker (إعادة التدوير أو الإيقاف) الرسائل المقبولة — رُدّ عليها بـ 200 فلن
+يعيد المزوّد إرسالها — تُكمل قبل انتهاء graceful_timeout بدل إسقاطها.
+"""
+import time
+
+
+def post_fork(server, worker):
+    # قبل استيراد وحدات المشروع لأنها تقرأ os.getenv عند الاستيراد (كما في app.py)
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    from services import http_client
+    from bots import tg_bot
+    tg_bot.use_shared_session()
+    http_client.prewarm()
+
+
+def worker_exit(server, worker):
+    from services.coalesce import coalescer
+    from services.outbox import outbox
+    from services.workers import pool
+
+    # هامش ثانية قبل أن يقتل الـ master العملية بعد graceful_timeout
+    deadline = time.monotonic() + max(1.0, server.cfg.graceful_timeout - 1)
+    coalescer.flush_all()
+    pool.join(max(0.0, deadline - time.monotonic()))
+    outbox.join(max(0.0, deadline - time.monotonic()))
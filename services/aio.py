@@ -0,0 +1,160 @@
+# services/aio.py
+# -*- coding: utf-8 -*-
+"""
+منفّذ مهام asyncio لمسار ASGI (asgi.py)، بنفس دلالات services.workers:
+  - مهام نفس المفتاح (المحادثة) تُنفَّذ بالترتيب، والمفاتيح المختلفة بالتوازي
+  - حد أقصى للمهام المعلّقة والجارية (submit يرجع False عند الامتلاء → 503 للمزوّد)
+  - RetryLater: انتظار asyncio.sleep ثم إعادة المهمة (لا يُحجز ثريد)
+المهمة coroutine function؛ آلاف المحادثات المعلّقة على OpenAI/ElevenLabs تكلف
+مهمة asyncio لكل منها فقط بدل ثريد.
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Hashable, Optional, Set
+
+from services.resilience import RetryLater
+from services.workers import TASK_MAX_ATTEMPTS, TASK_MAX_DEFER_S
+from services import metrics
+
+AIO_QUEUE_MAX = int(os.getenv("AIO_QUEUE_MAX", "10000"))
+
+
+class AsyncRunner:
+    def __init__(self, maxsize: int = AIO_QUEUE_MAX, name: str = "aio"):
+        self.maxsize = maxsize
+        self.name = name
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._pending: Dict[Hashable, Deque[tuple]] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._depth = 0
+        self._running = 0
+        self._lock = threading.Lock()  # submit_threadsafe من ثريدات أخرى (coalescer)
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.retries = 0
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        """يُستدعى عند بدء التطبيق (lifespan startup)."""
+        self.loop = loop
+
+    def _admit(self) -> bool:
+        """يحجز مكانًا في الطابور (depth + running ≤ maxsize)."""
+        with self._lock:
+            if self._depth + self._running >= self.maxsize:
+                self.rejected += 1
+                return False
+            self._depth += 1
+            self.submitted += 1
+            return True
+
+    def _enqueue(self, fn: Callable[..., Awaitable], args: tuple, key: Optional[Hashable]):
+        with self._lock:
+            if key is None:
+                key = object()
+            start = key not in self._pending
+            if start:
+                self._pending[key] = deque()
+            self._pending[key].append((fn, args))
+        if start:
+            task = self.loop.create_task(self._drain(key))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def submit(self, fn: Callable[..., Awaitable], *args, key: Optional[Hashable] = None) -> bool:
+        """من داخل الـ event loop. يرجع False إذا الطابور ممتلئ."""
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        if not self._admit():
+            return False
+        self._enqueue(fn, args, key)
+        return True
+
+    def submit_threadsafe(self, fn: Callable[..., Awaitable], *args, key: Optional[Hashable] = None) -> bool:
+        """من ثريد آخر (مثل services.coalesce أو asyncio.to_thread). المكان يُحجز هنا، والإضافة في الـ loop."""
+        if self.loop is None or self.loop.is_closed():
+            logging.warning("[%s] event loop not running, dropping task for %s", self.name, key)
+            return False
+        if not self._admit():
+            return False
+        self.loop.call_soon_threadsafe(self._enqueue, fn, args, key)
+        return True
+
+    async def _drain(self, key: Hashable):
+        while True:
+            with self._lock:
+                q = self._pending.get(key)
+                if not q:
+                    self._pending.pop(key, None)
+                    return
+                fn, args = q.popleft()
+                self._depth -= 1
+                self._running += 1
+            try:
+                await self._run(fn, args, key)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self.processed += 1
+
+    async def _run(self, fn: Callable[..., Awaitable], args: tuple, key: Hashable):
+        attempt = 0
+        started = time.monotonic()
+        while True:
+            try:
+                await fn(*args)
+                return
+            except RetryLater as e:
+                if e.count_attempt:
+                    attempt += 1
+                if attempt >= TASK_MAX_ATTEMPTS or time.monotonic() - started >= TASK_MAX_DEFER_S:
+                    with self._lock:
+                        self.failed += 1
+                    logging.error("[%s] task gave up after %d attempts (key=%s): %s", self.name, attempt, key, e)
+                    return
+                with self._lock:
+                    self.retries += 1
+                metrics.inc("task_retries_total", pool=self.name)
+                await asyncio.sleep(e.delay)
+            except Exception:
+                with self._lock:
+                    self.failed += 1
+                logging.exception("[%s] task failed (key=%s)", self.name, key)
+                return
+            finally:
+                metrics.reset()
+
+    async def join(self, timeout: Optional[float] = None) -> bool:
+        """ينتظر (داخل الـ loop) انتهاء كل المهام أو انقضاء timeout؛ لإيقاف العملية. يرجع False إن بقيت مهام."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                left = self._depth + self._running
+            if not left:
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                logging.warning("[%s] join timed out with %d tasks left", self.name, left)
+                return False
+            await asyncio.sleep(0.05)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "running": self._running,
+                "queue_depth": self._depth,
+                "queue_max": self.maxsize,
+                "active_keys": len(self._pending),
+                "submitted": self.submitted,
+                "processed": self.processed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "retries": self.retries,
+            }
+
+
+runner = AsyncRunner()
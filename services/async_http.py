@@ -0,0 +1,69 @@
+# services/async_http.py
+# -*- coding: utf-8 -*-
+"""
+عميل HTTP غير متزامن مشترك (httpx.AsyncClient) لمسار asyncio (asgi.py):
+  - عميل واحد لكل event loop مع pool اتصالات keep-alive كبير
+    (آلاف الطلبات المعلّقة لا تحجز ثريدات)
+  - نفس مهلات كل host الموجودة في services.http_client
+httpx اعتمادية اختيارية: المسار المتزامن (gunicorn + requests) لا يحتاجها.
+"""
+import os
+import asyncio
+from typing import Optional
+
+from services.http_client import timeout_for
+
+try:
+    import httpx
+except ImportError:  # المسار المتزامن يعمل بدونها
+    httpx = None
+
+ASYNC_HTTP_MAX_CONNECTIONS = int(os.getenv("ASYNC_HTTP_MAX_CONNECTIONS", "1000"))
+ASYNC_HTTP_MAX_KEEPALIVE   = int(os.getenv("ASYNC_HTTP_MAX_KEEPALIVE", "200"))
+
+# أخطاء الشبكة المؤقتة (تُعاد المحاولة)
+TRANSPORT_ERRORS = (httpx.TransportError,) if httpx else ()
+HTTP_ERRORS = (httpx.HTTPError,) if httpx else ()
+
+_client: Optional["httpx.AsyncClient"] = None
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def available() -> bool:
+    return httpx is not None
+
+
+def client() -> "httpx.AsyncClient":
+    """العميل المشترك للـ event loop الحالي."""
+    global _client, _loop
+    if httpx is None:
+        raise RuntimeError("httpx is required for the asyncio path (pip install httpx)")
+    loop = asyncio.get_running_loop()
+    if _client is None or _loop is not loop:
+        _client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=ASYNC_HTTP_MAX_CONNECTIONS,
+                                max_keepalive_connections=ASYNC_HTTP_MAX_KEEPALIVE),
+            follow_redirects=False,
+        )
+        _loop = loop
+    return _client
+
+
+async def request(method: str, url: str, **kwargs) -> "httpx.Response":
+    kwargs.setdefault("timeout", timeout_for(url))
+    return await client().request(method, url, **kwargs)
+
+
+async def get(url: str, **kwargs) -> "httpx.Response":
+    return await request("GET", url, **kwargs)
+
+
+async def post(url: str, **kwargs) -> "httpx.Response":
+    return await request("POST", url, **kwargs)
+
+
+async def aclose():
+    global _client, _loop
+    if _client is not None:
+        await _client.aclose()
+    _client, _loop = None, None
@@ -0,0 +1,220 @@
+# services/auth.py
+# -*- coding: utf-8 -*-
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import jwt
+import requests
+
+from services import http_client
+
+SUPABASE_URL        = os.getenv("SUPABASE_URL", "")
+SUPABASE_ANON_KEY   = os.getenv("SUPABASE_ANON_KEY", "")
+# سرّ JWT الخاص بالمشروع (HS256). لو غير مضبوط نعتمد على JWKS (RS256/ES256).
+SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET", "")
+SUPABASE_JWT_AUD    = os.getenv("SUPABASE_JWT_AUD", "authenticated")
+JWKS_URL            = os.getenv("SUPABASE_JWKS_URL", f"{SUPABASE_URL}/auth/v1/.well-known/jwks.json")
+JWKS_CACHE_S        = int(os.getenv("SUPABASE_JWKS_CACHE", "3600"))
+# kid غير موجود في المفاتيح المخزنة يعيد جلب JWKS مرة واحدة على الأكثر كل هذه المدة
+JWKS_REFRESH_MIN_S  = float(os.getenv("SUPABASE_JWKS_REFRESH_MIN", "60"))
+# فحص /auth/v1/user اختياري (لاكتشاف التوكنات الملغاة) — مرة واحدة لكل توكن خلال مدة الكاش
+REMOTE_CHECK        = os.getenv("SUPABASE_AUTH_REMOTE_CHECK", "0") == "1"
+AUTH_CACHE_TTL      = float(os.getenv("AUTH_CACHE_TTL", "300"))
+AUTH_CACHE_MAX      = int(os.getenv("AUTH_CACHE_MAX", "5000"))
+LEEWAY_S            = int(os.getenv("AUTH_LEEWAY", "10"))
+
+
+class AuthUnavailable(Exception):
+    """لا يمكن التحقق الآن (سيرفر Supabase / JWKS غير متاح)."""
+
+
+class TokenCache:
+    """كاش محدود الحجم للتوكنات المتحقق منها، تنتهي صلاحية كل عنصر عند exp أو TTL أيهما أقرب."""
+
+    def __init__(self, maxsize: int = AUTH_CACHE_MAX, ttl: float = AUTH_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires_at, claims)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(token: str) -> str:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def get(self, token: str) -> Optional[dict]:
+        k = self.key(token)
+        now = time.time()
+        with self._lock:
+            item = self._data.get(k)
+            if item is None:
+                self.misses += 1
+                return None
+            expires_at, claims = item
+            if expires_at <= now:
+                del self._data[k]
+                self.misses += 1
+                return None
+            self._data.move_to_end(k)
+            self.hits += 1
+            return claims
+
+    def put(self, token: str, claims: dict):
+        now = time.time()
+        expires_at = now + self.ttl
+        exp = claims.get("exp")
+        if isinstance(exp, (int, float)):
+            expires_at = min(expires_at, float(exp))
+        if expires_at <= now:
+            return
+        k = self.key(token)
+        with self._lock:
+            self._data[k] = (expires_at, claims)
+            self._data.move_to_end(k)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            }
+
+
+_cache = TokenCache()
+_jwks_client: Optional[jwt.PyJWKClient] = None
+_jwks_lock = threading.Lock()
+_jwks_refresh_lock = threading.Lock()
+_jwks_refreshed = float("-inf")  # monotonic لآخر إعادة جلب بسبب kid غير معروف
+
+
+def _jwks() -> jwt.PyJWKClient:
+    global _jwks_client
+    if _jwks_client is None:
+        with _jwks_lock:
+            if _jwks_client is None:
+                headers = {"apikey": SUPABASE_ANON_KEY} if SUPABASE_ANON_KEY else {}
+                _jwks_client = jwt.PyJWKClient(JWKS_URL, cache_keys=True, lifespan=JWKS_CACHE_S, headers=headers)
+    return _jwks_client
+
+
+def _signing_key(kid: Optional[str]) -> Optional[jwt.PyJWK]:
+    """
+    مفتاح kid من مجموعة JWKS المخزنة. kid غير معروف (تدوير المفاتيح) يعيد الجلب مرة واحدة
+    على الأكثر كل JWKS_REFRESH_MIN_S: توكنات بـ kid عشوائي لا تصل لخادم JWKS.
+    None إذا لم يوجد المفتاح.
+    """
+    global _jwks_refreshed
+    if not kid:
+        return None
+    client = _jwks()
+    key = client.match_kid(client.get_signing_keys(), kid)
+    if key is not None:
+        return key
+    with _jwks_refresh_lock:
+        # طلب آخر ربما أعاد الجلب أثناء انتظارنا القفل
+        key = client.match_kid(client.get_signing_keys(), kid)
+        if key is not None or time.monotonic() - _jwks_refreshed < JWKS_REFRESH_MIN_S:
+            return key
+        _jwks_refreshed = time.monotonic()
+        return client.match_kid(client.get_signing_keys(refresh=True), kid)
+
+
+def _decode_local(token: str) -> Optional[dict]:
+    """
+    تحقق محلي من التوقيع و exp و aud.
+    يرجع claims، أو None إذا التوكن غير صالح، ويرمي AuthUnavailable إذا تعذّر جلب المفاتيح.
+    """
+    try:
+        header = jwt.get_unverified_header(token)
+    except jwt.InvalidTokenError:
+        return None
+
+    alg = header.get("alg", "")
+    options = {"require": ["exp", "sub"]}
+    try:
+        if alg == "HS256":
+            if not SUPABASE_JWT_SECRET:
+                raise AuthUnavailable("SUPABASE_JWT_SECRET not configured")
+            return jwt.decode(token, SUPABASE_JWT_SECRET, algorithms=["HS256"],
+                              audience=SUPABASE_JWT_AUD, leeway=LEEWAY_S, options=options)
+        if alg in ("RS256", "ES256"):
+            try:
+                signing_key = _signing_key(header.get("kid"))
+            except jwt.PyJWKClientConnectionError as e:
+                raise AuthUnavailable(str(e))  # تعذّر جلب JWKS
+            except jwt.PyJWKClientError:
+                return None  # JWKS بلا مفاتيح توقيع
+            if signing_key is None:
+                return None  # kid غير معروف: توكن مزوّر/قديم، بدون رحلة لـ /auth/v1/user
+            return jwt.decode(token, signing_key.key, algorithms=[alg],
+                              audience=SUPABASE_JWT_AUD, leeway=LEEWAY_S, options=options)
+    except jwt.InvalidTokenError:
+        return None
+    return None
+
+
+def _check_remote(token: str) -> Optional[dict]:
+    """الفحص القديم عبر /auth/v1/user (رحلة HTTP كاملة)."""
+    try:
+        resp = http_client.get(
+            f"{SUPABASE_URL}/auth/v1/user",
+            headers={"Authorization": f"Bearer {token}", "apikey": SUPABASE_ANON_KEY},
+            timeout=10
+        )
+    except requests.RequestException as e:
+        raise AuthUnavailable(str(e))
+    if resp.status_code != 200:
+        return None
+    try:
+        user = resp.json() or {}
+    except ValueError:
+        user = {}
+    claims = {"sub": user.get("id")}
+    try:
+        # نأخذ exp من الحمولة (بدون تحقق) فقط لتحديد مدة الكاش
+        exp = jwt.decode(token, options={"verify_signature": False}).get("exp")
+        if exp:
+            claims["exp"] = exp
+    except jwt.InvalidTokenError:
+        pass
+    return claims
+
+
+def verify_token(token: str) -> Optional[dict]:
+    """
+    يرجع claims إذا التوكن صالح، None إذا غير صالح/منتهي.
+    يرمي AuthUnavailable إذا لم نتمكن من التحقق إطلاقًا.
+    """
+    claims = _cache.get(token)
+    if claims is not None:
+        return claims
+
+    try:
+        claims = _decode_local(token)
+    except AuthUnavailable:
+        logging.warning("[auth] local verification unavailable, falling back to /auth/v1/user")
+        claims = _check_remote(token)
+    else:
+        if claims is not None and REMOTE_CHECK and _check_remote(token) is None:
+            claims = None  # توقيع صحيح لكن الجلسة ملغاة
+
+    if claims is not None:
+        _cache.put(token, claims)
+    return claims
+
+
+def stats() -> dict:
+    return {"cache": _cache.stats(), "remote_check": REMOTE_CHECK,
+            "mode": "hs256" if SUPABASE_JWT_SECRET else "jwks"}
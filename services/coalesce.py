@@ -0,0 +1,181 @@
+# services/coalesce.py
+# -*- coding: utf-8 -*-
+"""
+دمج الرسائل المتتالية القصيرة من نفس المحادثة في طلب LLM واحد ورد واحد.
+الرسائل تنتظر (debounce) قبل الإرسال، بنافذة متكيّفة:
+  - أول رسالة بعد سكوت المحادثة (لا شيء معلّق لها) تُرسل فورًا بدون أي انتظار.
+    COALESCE_IDLE_WINDOW_MS (اختياري، افتراضيًا 0) يجعلها تنتظر قليلًا لتُدمج مع ما يليها،
+    على حساب زمن الرد في كل محادثة عادية.
+  - كل رسالة تصل أثناء الانتظار (أو خلال النافذة بعد آخر رسالة) تمدّه بـ COALESCE_WINDOW_MS
+    (800ms)، بحد أقصى COALESCE_MAX_WAIT_MS من أول رسالة في الدفعة.
+ثم يُرسَل النص المدمج إلى services.workers بنفس مفتاح المحادثة. رسالة تصل بعد إرسال
+الدفعة (والرد قيد التوليد) تبدأ دفعة جديدة ورد جديد؛ لا نلغي الرد الجاري.
+إذا رفض الطابور (ممتلئ) تبقى الرسائل في المخزن وتُعاد المحاولة مع backoff:
+الويبهوك رُدّ عليه بـ 200 فلن يعيد المزوّد الإرسال — لذلك flush_all عند إيقاف العملية
+(gunicorn.conf.py / asgi.py) يرسل ما في المخزن قبل الخروج بدل إسقاطه.
+"""
+import os
+import time
+import inspect
+import logging
+import threading
+from typing import Callable, Dict, Hashable, Optional
+
+from services.workers import pool
+
+COALESCE_WINDOW_S   = float(os.getenv("COALESCE_WINDOW_MS", "800")) / 1000.0
+COALESCE_IDLE_WINDOW_S = float(os.getenv("COALESCE_IDLE_WINDOW_MS", "0")) / 1000.0
+COALESCE_MAX_WAIT_S = float(os.getenv("COALESCE_MAX_WAIT_MS", "5000")) / 1000.0
+COALESCE_RETRY_MAX_S = float(os.getenv("COALESCE_RETRY_MAX_MS", "2000")) / 1000.0
+
+_MAX_RECENT = 20000
+
+
+class Coalescer:
+    def __init__(self, window: float = COALESCE_WINDOW_S, max_wait: float = COALESCE_MAX_WAIT_S,
+                 idle_window: float = COALESCE_IDLE_WINDOW_S):
+        self.window = window
+        self.idle_window = min(window, max(0.0, idle_window))
+        self.max_wait = max(window, max_wait)
+        self._buffers: Dict[Hashable, dict] = {}  # key -> {"texts", "first", "deadline", "flush", "submit", "retries"}
+        self._recent: Dict[Hashable, float] = {}  # key -> وقت آخر رسالة (لمعرفة هل المحادثة في دفعة)
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self.messages = 0
+        self.calls = 0
+        self.requeued = 0
+
+    def _ensure_started(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        self._buffers.clear()
+        self._recent.clear()
+        self._thread = threading.Thread(target=self._run, name="coalescer", daemon=True)
+        self._thread.start()
+        self._pid = pid
+
+    def add(self, key: Hashable, text: str, flush: Callable[[str], None], submit: Optional[Callable] = None):
+        """
+        يضيف رسالة لمحادثة key. تُستدعى flush(النص المدمج) مرة واحدة لكل دفعة في ثريد
+        من services.workers عند انتهاء النافذة، أو فورًا إن كانت المحادثة ساكنة (idle_window=0).
+        submit: بديل pool.submit (مسار asyncio يمرر services.aio.runner.submit_threadsafe
+        و flush دالة async).
+        """
+        if self.window <= 0 and submit is None:
+            with self._cond:
+                self.messages += 1
+                self.calls += 1
+            flush(text)
+            return
+
+        now = time.monotonic()
+        submit = submit or pool.submit
+        with self._cond:
+            self._ensure_started()
+            self.messages += 1
+            last = self._recent.get(key)
+            if len(self._recent) >= _MAX_RECENT:
+                self._prune_recent(now)
+            self._recent[key] = now
+            buf = self._buffers.get(key)
+            idle = buf is None and (last is None or now - last > self.window)
+            if buf is None:
+                buf = self._buffers[key] = {"texts": [], "first": now, "retries": 0}
+            buf["texts"].append(text)
+            buf["flush"] = flush
+            buf["submit"] = submit
+            wait = self.idle_window if idle else self.window
+            direct = wait <= 0
+            if direct:
+                # لا شيء معلّق: بدون انتظار ولا قفزة لثريد الدمج
+                del self._buffers[key]
+                self.calls += 1
+            else:
+                buf["deadline"] = min(now + wait, buf["first"] + self.max_wait)
+                self._cond.notify()
+        if direct and not submit(flush, text, key=key):
+            self._rearm(key, buf)
+
+    def _prune_recent(self, now: float):
+        cutoff = now - self.window
+        for k in [k for k, t in self._recent.items() if t < cutoff]:
+            del self._recent[k]
+
+    def _rearm(self, key: Hashable, buf: dict):
+        """الطابور ممتلئ: نعيد الرسائل للمخزن (قبل أي رسائل أحدث) ونحاول بعد backoff قصير."""
+        with self._cond:
+            self.calls -= 1
+            self.requeued += 1
+            newer = self._buffers.get(key)
+            if newer is not None:
+                buf["texts"] += newer["texts"]
+                buf["flush"], buf["submit"] = newer["flush"], newer["submit"]
+            delay = min(COALESCE_RETRY_MAX_S, 0.1 * 2 ** buf["retries"])
+            buf["retries"] += 1
+            buf["deadline"] = time.monotonic() + delay
+            self._buffers[key] = buf
+            self._cond.notify()
+        logging.warning("[coalesce] worker queue full, retrying %s in %.1fs", key, delay)
+
+    def _run(self):
+        while True:
+            due = []
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    due = [k for k, b in self._buffers.items() if b["deadline"] <= now]
+                    if due:
+                        break
+                    nxt = min((b["deadline"] for b in self._buffers.values()), default=None)
+                    self._cond.wait(None if nxt is None else max(0.0, nxt - now))
+                ready = [(k, self._buffers.pop(k)) for k in due]
+                self.calls += len(ready)
+            for key, buf in ready:
+                text = "\n".join(t for t in buf["texts"] if t)
+                if len(buf["texts"]) > 1:
+                    logging.info("[coalesce] merged %d messages for %s", len(buf["texts"]), key)
+                if not buf["submit"](buf["flush"], text, key=key):
+                    self._rearm(key, buf)
+
+    def flush_all(self) -> int:
+        """
+        عند إيقاف العملية: يرسل كل الدفعات المعلّقة الآن (بدون انتظار نوافذها) ويرجع عددها.
+        إن رفض الطابور دفعة متزامنة تُنفَّذ في ثريد المستدعي بدل إسقاطها.
+        """
+        with self._cond:
+            if self._pid != os.getpid():
+                return 0
+            ready = list(self._buffers.items())
+            self._buffers.clear()
+            self.calls += len(ready)
+        for key, buf in ready:
+            text = "\n".join(t for t in buf["texts"] if t)
+            if buf["submit"](buf["flush"], text, key=key):
+                continue
+            if inspect.iscoroutinefunction(buf["flush"]):
+                logging.error("[coalesce] dropped %d messages for %s on shutdown", len(buf["texts"]), key)
+                continue
+            try:
+                buf["flush"](text)
+            except Exception:
+                logging.exception("[coalesce] flush failed on shutdown (key=%s)", key)
+        if ready:
+            logging.info("[coalesce] flushed %d pending conversations on shutdown", len(ready))
+        return len(ready)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "window_ms": int(self.window * 1000),
+                "idle_window_ms": int(self.idle_window * 1000),
+                "messages": self.messages,
+                "llm_calls": self.calls,
+                "requeued": self.requeued,
+                "merged_away": self.messages - self.calls - sum(len(b["texts"]) for b in self._buffers.values()),
+                "pending_conversations": len(self._buffers),
+            }
+
+
+coalescer = Coalescer()
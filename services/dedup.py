@@ -0,0 +1,167 @@
+# services/dedup.py
+# -*- coding: utf-8 -*-
+"""
+منع المعالجة المكررة عندما يعيد Telegram / Meta إرسال نفس الويبهوك:
+  - first_seen: طبقة ذاكرة (TTL + حد أقصى للعناصر) لكل worker — وحدها في مسار الـ ack
+  - claim: طبقة SQLite مشتركة بين كل workers gunicorn (فحص وتسجيل ذرّي بـ upsert)،
+    تُستدعى من ثريد المعالجة لكل مفاتيح المهمة في معاملة واحدة
+"""
+import os
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Set
+
+from services import metrics
+
+DEDUP_TTL_S   = float(os.getenv("DEDUP_TTL", str(24 * 3600)))
+DEDUP_MEM_MAX = int(os.getenv("DEDUP_MEM_MAX", "100000"))
+DEDUP_DB_PATH = os.getenv("DEDUP_DB_PATH", os.path.join("data", "dedup.db"))
+
+
+class DedupStore:
+    def __init__(self, ttl: float = DEDUP_TTL_S, mem_max: int = DEDUP_MEM_MAX, db_path: str = DEDUP_DB_PATH):
+        self.ttl = ttl
+        self.mem_max = mem_max
+        self.db_path = db_path
+        self._mem: "OrderedDict[str, float]" = OrderedDict()  # key -> expires_at (بترتيب الإضافة)
+        self._lock = threading.Lock()     # الذاكرة والعدادات فقط (بدون I/O)
+        self._db_lock = threading.Lock()  # اتصال SQLite
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_pid: Optional[int] = None
+        self._writes = 0
+        self.checked = 0
+        self.duplicates: Dict[str, int] = {}
+        self.fail_open = 0
+
+    # --------------- SQLite ---------------
+
+    def _conn(self) -> Optional[sqlite3.Connection]:
+        if not self.db_path:
+            return None
+        pid = os.getpid()
+        if self._db is None or self._db_pid != pid:
+            try:
+                d = os.path.dirname(self.db_path)
+                if d:
+                    os.makedirs(d, exist_ok=True)
+                db = sqlite3.connect(self.db_path, timeout=2, check_same_thread=False, isolation_level=None)
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("PRAGMA synchronous=NORMAL")
+                db.execute("CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY, expires REAL NOT NULL)")
+                self._db, self._db_pid = db, pid
+            except sqlite3.Error:
+                logging.exception("[dedup] cannot open %s; using per-worker memory only", self.db_path)
+                self.db_path = ""
+                return None
+        return self._db
+
+    def _fail_open(self, n: int, source: str):
+        # الأفضل معالجة مكررة على ضياع رسالة — لكن يجب أن يظهر ذلك
+        with self._lock:
+            self.fail_open += n
+        metrics.inc("dedup_fail_open_total", n, source=source)
+
+    def _dup(self, source: str, n: int = 1):
+        with self._lock:
+            self.duplicates[source] = self.duplicates.get(source, 0) + n
+
+    # --------------- واجهة ---------------
+
+    def first_seen(self, key: str, source: str = "other") -> bool:
+        """
+        فحص الذاكرة فقط (مسار الـ ack، بدون I/O): يسجّل المفتاح ويرجع False إذا رآه
+        هذا الـ worker خلال TTL. التكرار عبر الـ workers وبعد إعادة التشغيل يكشفه claim.
+        """
+        now = time.time()
+        with self._lock:
+            self.checked += 1
+            exp = self._mem.get(key)
+            if exp is not None and exp > now:
+                self.duplicates[source] = self.duplicates.get(source, 0) + 1
+                return False
+            self._mem[key] = now + self.ttl
+            self._mem.move_to_end(key)
+            while len(self._mem) > self.mem_max:
+                self._mem.popitem(last=False)
+            while self._mem:
+                # العناصر مرتبة بالإضافة وكلها بنفس TTL: الأقدم ينتهي أولًا
+                oldest_key, oldest_exp = next(iter(self._mem.items()))
+                if oldest_exp > now:
+                    break
+                del self._mem[oldest_key]
+            return True
+
+    def claim(self, keys: Iterable[str], source: str = "other") -> Set[str]:
+        """
+        يسجّل المفاتيح في SQLite المشتركة (معاملة واحدة) ويرجع ما لم يُرَ منها من قبل
+        عبر كل الـ workers. يُستدعى من ثريد المعالجة وليس من مسار الـ ack.
+        إن تعذّرت SQLite يرجعها كلها (fail-open) ويسجّل ذلك في السجل و dedup_fail_open_total.
+        """
+        keys = list(dict.fromkeys(k for k in keys if k))
+        if not keys:
+            return set()
+        now = time.time()
+        fresh: Set[str] = set()
+        with self._db_lock:
+            db = self._conn()
+            if db is None:
+                return set(keys)
+            try:
+                db.execute("BEGIN IMMEDIATE")
+                for key in keys:
+                    cur = db.execute(
+                        "INSERT INTO seen (key, expires) VALUES (?, ?) "
+                        "ON CONFLICT(key) DO UPDATE SET expires = excluded.expires WHERE seen.expires < ?",
+                        (key, now + self.ttl, now),
+                    )
+                    if cur.rowcount == 1:
+                        fresh.add(key)
+                before, self._writes = self._writes, self._writes + len(keys)
+                if self._writes // 1000 != before // 1000:
+                    db.execute("DELETE FROM seen WHERE expires < ?", (now,))
+                db.execute("COMMIT")
+            except sqlite3.Error as e:
+                try:
+                    db.execute("ROLLBACK")
+                except sqlite3.Error:
+                    pass
+                logging.error("[dedup] shared check failed for %d key(s), processing anyway: %s", len(keys), e)
+                self._fail_open(len(keys), source)
+                return set(keys)
+        if len(fresh) < len(keys):
+            self._dup(source, len(keys) - len(fresh))
+        return fresh
+
+    def forget(self, key: str, shared: bool = True):
+        """
+        يلغي التسجيل (مثلًا الطابور ممتلئ ونريد من المزوّد إعادة الإرسال).
+        shared=False: الذاكرة فقط، لمفتاح لم يمر بـ claim بعد.
+        """
+        with self._lock:
+            self._mem.pop(key, None)
+        if not shared:
+            return
+        with self._db_lock:
+            db = self._conn()
+            if db is not None:
+                try:
+                    db.execute("DELETE FROM seen WHERE key = ?", (key,))
+                except sqlite3.Error:
+                    logging.exception("[dedup] forget failed for %s", key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "checked": self.checked,
+                "duplicates": dict(self.duplicates),
+                "duplicates_total": sum(self.duplicates.values()),
+                "mem_keys": len(self._mem),
+                "fail_open": self.fail_open,
+                "shared": bool(self.db_path),
+            }
+
+
+dedup = DedupStore()
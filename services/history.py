@@ -0,0 +1,263 @@
+# services/history.py
+# -*- coding: utf-8 -*-
+"""
+مخزن مشترك لذاكرة المحادثات لكل البوتات:
+  - SQLite هو المصدر: كل set() يُكتب فيه مباشرة، فتتشارك عمّال gunicorn نفس المحادثات
+  - الذاكرة كاش فوقه بميزانية عامة (بايتات تقريبية) مع إخلاء LRU للمحادثات الخاملة
+  - نسخة الذاكرة تحفظ ختم آخر كتابة (عمود updated) وتُقارن به لكل محادثة (SELECT updated على المفتاح):
+    كتابة عامل آخر في محادثة أخرى لا تُسقط نسختها، وأي غياب في الذاكرة يُقرأ من SQLite
+  - الإخلاء (الميزانية والخمول) يجري مع كل get/set وعند الإحصائيات
+  - عمليات SQLite خارج قفل الذاكرة حتى لا تنتظر بقية المحادثات القرص
+  - حساب استهلاك الذاكرة لكل بوت
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+HISTORY_MEM_BYTES = int(os.getenv("HISTORY_MEM_BYTES", str(64 * 1024 * 1024)))
+HISTORY_IDLE_S    = float(os.getenv("HISTORY_IDLE_S", "1800"))
+HISTORY_MAX_MSGS  = int(os.getenv("HISTORY_MAX_MSGS", "30"))
+HISTORY_DB_PATH   = os.getenv("HISTORY_DB_PATH", os.path.join("data", "history.db"))
+
+_MSG_OVERHEAD = 200  # dict + role + مؤشرات القائمة (تقريبي)
+
+Key = Tuple[str, str]
+
+
+def _size_of(hist: List[dict]) -> int:
+    return sum(sys.getsizeof(m.get("content") or "") + _MSG_OVERHEAD for m in hist)
+
+
+class HistoryStore:
+    def __init__(self, mem_budget: int = HISTORY_MEM_BYTES, idle_s: float = HISTORY_IDLE_S,
+                 db_path: str = HISTORY_DB_PATH, max_msgs: int = HISTORY_MAX_MSGS):
+        self.mem_budget = mem_budget
+        self.idle_s = idle_s
+        self.db_path = db_path
+        self.max_msgs = max_msgs
+        self._mem: "OrderedDict[Key, list]" = OrderedDict()  # key -> [hist, size, last_used, updated]
+        self._mem_bytes = 0
+        self._bot_bytes: Dict[str, int] = {}
+        self._bot_convs: Dict[str, int] = {}
+        self._lock = threading.RLock()      # الذاكرة فقط
+        self._db_lock = threading.Lock()    # اتصال SQLite (مشترك بين ثريدات العامل)
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_pid: Optional[int] = None
+        self.spilled = 0
+        self.reloaded = 0
+
+    # --------------- SQLite (تحت _db_lock فقط) ---------------
+
+    def _conn(self) -> Optional[sqlite3.Connection]:
+        if not self.db_path:
+            return None
+        pid = os.getpid()
+        if self._db is None or self._db_pid != pid:
+            try:
+                d = os.path.dirname(self.db_path)
+                if d:
+                    os.makedirs(d, exist_ok=True)
+                db = sqlite3.connect(self.db_path, timeout=5, check_same_thread=False, isolation_level=None)
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("PRAGMA synchronous=NORMAL")
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS history ("
+                    " bot_id TEXT NOT NULL, chat_id TEXT NOT NULL, data TEXT NOT NULL, updated REAL NOT NULL,"
+                    " PRIMARY KEY (bot_id, chat_id))"
+                )
+                self._db, self._db_pid = db, pid
+            except sqlite3.Error:
+                logging.exception("[history] cannot open %s; conversations stay in this worker only", self.db_path)
+                self.db_path = ""
+                return None
+        return self._db
+
+    def _updated(self, key: Key, default: Optional[float]) -> Optional[float]:
+        """
+        ختم آخر كتابة للمحادثة (المفتاح الأساسي فقط، بلا data). None = لا صف (حذفها عامل آخر)؛
+        default = لا قاعدة أو خطأ قراءة، فتبقى نسخة الذاكرة.
+        """
+        with self._db_lock:
+            db = self._conn()
+            if db is None:
+                return default
+            try:
+                row = db.execute(
+                    "SELECT updated FROM history WHERE bot_id = ? AND chat_id = ?", key
+                ).fetchone()
+            except sqlite3.Error:
+                logging.exception("[history] stamp failed for %s", key)
+                return default
+        return row[0] if row else None
+
+    def _write(self, key: Key, hist: list) -> Optional[float]:
+        """يرجع ختم الكتابة (updated)، أو None إن لم تُكتب."""
+        data = json.dumps(hist, ensure_ascii=False)
+        updated = time.time()
+        with self._db_lock:
+            db = self._conn()
+            if db is None:
+                return None
+            try:
+                db.execute(
+                    "INSERT OR REPLACE INTO history (bot_id, chat_id, data, updated) VALUES (?, ?, ?, ?)",
+                    (key[0], key[1], data, updated),
+                )
+            except sqlite3.Error:
+                logging.exception("[history] write failed for %s", key)
+                return None
+        return updated
+
+    def _load(self, key: Key) -> Optional[Tuple[list, float]]:
+        with self._db_lock:
+            db = self._conn()
+            if db is None:
+                return None
+            try:
+                row = db.execute(
+                    "SELECT data, updated FROM history WHERE bot_id = ? AND chat_id = ?", key
+                ).fetchone()
+            except sqlite3.Error:
+                logging.exception("[history] load failed for %s", key)
+                return None
+        if not row:
+            return None
+        try:
+            return json.loads(row[0]), row[1]
+        except ValueError:
+            return None
+
+    # --------------- ذاكرة (تحت _lock) ---------------
+
+    def _account(self, bot_id: str, delta_bytes: int, delta_convs: int):
+        self._mem_bytes += delta_bytes
+        self._bot_bytes[bot_id] = self._bot_bytes.get(bot_id, 0) + delta_bytes
+        self._bot_convs[bot_id] = self._bot_convs.get(bot_id, 0) + delta_convs
+        if self._bot_convs[bot_id] <= 0:
+            self._bot_bytes.pop(bot_id, None)
+            self._bot_convs.pop(bot_id, None)
+
+    def _put_unlocked(self, key: Key, hist: list, updated: Optional[float]):
+        size = _size_of(hist)
+        old = self._mem.pop(key, None)
+        if old is not None:
+            self._account(key[0], size - old[1], 0)
+        else:
+            self._account(key[0], size, 1)
+        self._mem[key] = [hist, size, time.monotonic(), updated]
+        self._evict_unlocked()
+
+    def _evict_unlocked(self):
+        """يُخلي الأقدم استخدامًا ما دمنا فوق الميزانية، وكذلك المحادثات الخاملة (نسختها في SQLite أصلًا)."""
+        now = time.monotonic()
+        while self._mem:
+            key, (hist, size, last_used, _u) = next(iter(self._mem.items()))
+            if self._mem_bytes <= self.mem_budget and now - last_used < self.idle_s:
+                break
+            del self._mem[key]
+            self._account(key[0], -size, -1)
+            self.spilled += 1
+
+    @staticmethod
+    def _key(bot_id: str, chat_id) -> Key:
+        return (str(bot_id), str(chat_id))
+
+    def get(self, bot_id: str, chat_id) -> list:
+        key = self._key(bot_id, chat_id)
+        with self._lock:
+            self._evict_unlocked()
+            item = self._mem.get(key)
+        # نسخة الذاكرة صالحة ما دام ختمها هو آخر ما كُتب لهذه المحادثة (من أي عامل)
+        if item is not None and self._updated(key, item[3]) == item[3]:
+            with self._lock:
+                if self._mem.get(key) is item:  # لم تُستبدل أو تُخلَ بين القفلين
+                    item[2] = time.monotonic()
+                    self._mem.move_to_end(key)
+                    return list(item[0])
+        loaded = self._load(key)
+        with self._lock:
+            if loaded is None:
+                old = self._mem.pop(key, None)
+                if old is not None:
+                    self._account(key[0], -old[1], -1)
+                return []
+            hist, updated = loaded
+            self.reloaded += 1
+            self._put_unlocked(key, hist, updated)
+            return list(hist)
+
+    def set(self, bot_id: str, chat_id, hist: list):
+        key = self._key(bot_id, chat_id)
+        hist = list(hist[-self.max_msgs:])
+        updated = self._write(key, hist)
+        with self._lock:
+            self._put_unlocked(key, hist, updated)
+
+    def drop_bot(self, bot_id: str):
+        """يحذف كل محادثات البوت (عند حذف البوت نفسه)."""
+        bot_id = str(bot_id)
+        with self._lock:
+            for key in [k for k in self._mem if k[0] == bot_id]:
+                _hist, size, _, _u = self._mem.pop(key)
+                self._account(bot_id, -size, -1)
+        with self._db_lock:
+            db = self._conn()
+            if db is not None:
+                try:
+                    db.execute("DELETE FROM history WHERE bot_id = ?", (bot_id,))
+                except sqlite3.Error:
+                    logging.exception("[history] drop failed for %s", bot_id)
+
+    # --------------- إحصائيات ---------------
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._evict_unlocked()  # المحادثات الخاملة لا تبقى محسوبة حتى أول set
+            return {
+                "mem_bytes": self._mem_bytes,
+                "mem_budget": self.mem_budget,
+                "conversations": len(self._mem),
+                "spilled": self.spilled,
+                "reloaded": self.reloaded,
+                "per_bot": {
+                    b: {"bytes": n, "conversations": self._bot_convs.get(b, 0)}
+                    for b, n in self._bot_bytes.items()
+                },
+            }
+
+
+store = HistoryStore()
+
+
+class BotHistory:
+    """
+    واجهة شبيهة بالـ dict لكل بوت (history.get(chat_id, []) / history[chat_id] = hist)
+    حتى يبقى كود البوتات كما هو.
+    """
+
+    def __init__(self, bot_id: str, backend: HistoryStore = store):
+        self.bot_id = bot_id
+        self._backend = backend
+
+    def get(self, chat_id, default=None) -> list:
+        hist = self._backend.get(self.bot_id, chat_id)
+        if not hist and default is not None:
+            return list(default)
+        return hist
+
+    def __setitem__(self, chat_id, hist: list):
+        self._backend.set(self.bot_id, chat_id, hist)
+
+    # نسخ asyncio (asgi.py): عمليات SQLite في ثريد حتى لا يُحجب الـ loop بقفل القاعدة أو مهلتها
+    async def aget(self, chat_id, default=None) -> list:
+        return await asyncio.to_thread(self.get, chat_id, default)
+
+    async def aset(self, chat_id, hist: list):
+        await asyncio.to_thread(self.__setitem__, chat_id, hist)
@@ -0,0 +1,183 @@
+# services/http_client.py
+# -*- coding: utf-8 -*-
+"""
+عميل HTTP مشترك لكل الاتصالات الخارجية (OpenAI / ElevenLabs / Graph / Telegram):
+  - Session واحدة لكل عملية مع pool اتصالات keep-alive لكل host
+  - أحجام الـ pool و المهلات قابلة للضبط لكل host
+  - تسخين الاتصالات عند بدء الـ worker
+  - إحصائيات إعادة استخدام الاتصال (hit) مقابل فتح اتصال جديد (miss)
+"""
+import os
+import uuid
+import logging
+import threading
+from typing import AsyncIterable, Dict, Iterable, Optional, Tuple, Union
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_POOL_SIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "32"))
+DEFAULT_TIMEOUT   = float(os.getenv("HTTP_TIMEOUT", "30"))
+
+
+def _parse_host_map(raw: str, cast) -> Dict[str, float]:
+    """'api.openai.com=45,graph.facebook.com=30' -> dict"""
+    out = {}
+    for part in (raw or "").split(","):
+        if "=" not in part:
+            continue
+        host, val = part.split("=", 1)
+        try:
+            out[host.strip().lower()] = cast(val.strip())
+        except ValueError:
+            logging.warning("[http] bad host setting: %s", part)
+    return out
+
+
+HOST_TIMEOUTS: Dict[str, float] = {
+    "api.openai.com": 45.0,
+    "api.elevenlabs.io": 60.0,
+    "graph.facebook.com": 30.0,
+    "api.telegram.org": 15.0,
+}
+HOST_TIMEOUTS.update(_parse_host_map(os.getenv("HTTP_TIMEOUTS", ""), float))
+
+HOST_POOL_SIZES: Dict[str, int] = _parse_host_map(os.getenv("HTTP_POOL_SIZES", ""), int)
+
+PREWARM_HOSTS = [
+    h.strip() for h in os.getenv(
+        "HTTP_PREWARM", "api.openai.com,graph.facebook.com,api.elevenlabs.io,api.telegram.org"
+    ).split(",") if h.strip()
+]
+PREWARM_CONNECTIONS = int(os.getenv("HTTP_PREWARM_CONNECTIONS", "2"))
+
+
+_lock = threading.Lock()
+_session: Optional[requests.Session] = None
+_pid: Optional[int] = None
+
+
+def _new_session() -> requests.Session:
+    s = requests.Session()
+    default = HTTPAdapter(pool_connections=16, pool_maxsize=DEFAULT_POOL_SIZE)
+    s.mount("https://", default)
+    s.mount("http://", default)
+    for host, size in HOST_POOL_SIZES.items():
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size)
+        s.mount(f"https://{host}", adapter)
+        s.mount(f"http://{host}", adapter)
+    return s
+
+
+def session() -> requests.Session:
+    """Session مشتركة للعملية الحالية (تُنشأ من جديد بعد fork)."""
+    global _session, _pid
+    pid = os.getpid()
+    if _session is None or _pid != pid:
+        with _lock:
+            if _session is None or _pid != pid:
+                _session = _new_session()
+                _pid = pid
+    return _session
+
+
+def timeout_for(url: str) -> float:
+    host = (urlsplit(url).hostname or "").lower()
+    return HOST_TIMEOUTS.get(host, DEFAULT_TIMEOUT)
+
+
+def request(method: str, url: str, **kwargs) -> requests.Response:
+    kwargs.setdefault("timeout", timeout_for(url))
+    return session().request(method, url, **kwargs)
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request("GET", url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return request("POST", url, **kwargs)
+
+
+# --------------- رفع multipart بالبث ---------------
+
+def multipart_stream(fields: dict, name: str, filename: str, content_type: str,
+                     chunks: Union[Iterable[bytes], AsyncIterable[bytes]]) -> Tuple[str, object]:
+    """
+    (Content-Type, body) لرفع ملف multipart/form-data من مولّد بايتات بدون تجميعه في الذاكرة.
+    الـ body مولّد عادي أو async حسب chunks: requests / httpx يرسلانه بترميز chunked.
+    """
+    boundary = uuid.uuid4().hex
+    head = "".join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n'
+        for k, v in fields.items()
+    ) + (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+         f'Content-Type: {content_type}\r\n\r\n')
+    tail = f"\r\n--{boundary}--\r\n".encode()
+
+    if hasattr(chunks, "__aiter__"):
+        async def abody():
+            yield head.encode("utf-8")
+            async for chunk in chunks:
+                yield chunk
+            yield tail
+        return f"multipart/form-data; boundary={boundary}", abody()
+
+    def body():
+        yield head.encode("utf-8")
+        yield from chunks
+        yield tail
+    return f"multipart/form-data; boundary={boundary}", body()
+
+
+# --------------- تسخين ---------------
+
+def _warm_host(host: str):
+    url = host if "://" in host else f"https://{host}/"
+    try:
+        # أي رد (حتى 404) يكفي: المهم فتح TCP + TLS وإرجاع الاتصال للـ pool
+        request("HEAD", url, timeout=min(5.0, timeout_for(url)), allow_redirects=False).close()
+    except requests.RequestException as e:
+        logging.info("[http] prewarm %s failed: %s", host, e)
+
+
+def prewarm(hosts: Optional[Iterable[str]] = None, connections: int = PREWARM_CONNECTIONS, wait: bool = False):
+    """يفتح اتصالات مسبقًا لكل host بالتوازي (في الخلفية افتراضيًا)."""
+    threads = []
+    for host in (PREWARM_HOSTS if hosts is None else hosts):
+        for _ in range(max(1, connections)):
+            t = threading.Thread(target=_warm_host, args=(host,), name=f"http-prewarm-{host}", daemon=True)
+            t.start()
+            threads.append(t)
+    if wait:
+        for t in threads:
+            t.join()
+
+
+# --------------- إحصائيات ---------------
+
+def stats() -> dict:
+    """
+    لكل host: requests = كل الطلبات، misses = اتصالات جديدة، hits = طلبات أعادت استخدام اتصال مفتوح.
+    """
+    s = session()
+    out: Dict[str, dict] = {}
+    seen = set()
+    for adapter in s.adapters.values():
+        if id(adapter) in seen:
+            continue
+        seen.add(id(adapter))
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host = f"{pool.scheme}://{pool.host}"
+            row = out.setdefault(host, {"requests": 0, "hits": 0, "misses": 0, "maxsize": pool.pool.maxsize if pool.pool else 0})
+            row["requests"] += pool.num_requests
+            row["misses"] += pool.num_connections
+            row["hits"] += max(0, pool.num_requests - pool.num_connections)
+    for row in out.values():
+        row["hit_rate"] = round(row["hits"] / row["requests"], 3) if row["requests"] else 0.0
+    return out
@@ -0,0 +1,258 @@
+# services/metrics.py
+# -*- coding: utf-8 -*-
+"""
+مقاييس بصيغة Prometheus (text exposition) لـ /metrics:
+  - histogram لزمن كل مرحلة (openai / eleven / wa_upload / send) حسب المنصة والبوت
+  - counters للويبهوكس والتوجيه وإعادة المحاولات والردود الاحتياطية
+  - gauges تُحسب عند القراءة فقط (المحادثات النشطة، عمق الطوابير...)
+
+المسار الساخن بدون أقفال: كل ثريد يجمع في قاموسه الخاص (threading.local)،
+والتجميع بين الثريدات يحدث فقط عند طلب /metrics.
+التسميات platform/bot تُربط بسياق التنفيذ عبر bind() في بداية معالجة الرسالة
+(contextvars: لكل ثريد سياقه، ولكل مهمة asyncio نسختها الخاصة).
+"""
+import os
+import time
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Tuple
+
+METRICS_PREFIX     = os.getenv("METRICS_PREFIX", "piaaz_")
+METRICS_ACTIVE_S   = float(os.getenv("METRICS_ACTIVE_WINDOW", "300"))
+LATENCY_BUCKETS    = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+HELP = {
+    "stage_seconds": "Latency of each pipeline stage (openai, eleven, eleven_first_audio, wa_upload, send)",
+    "webhooks_received_total": "Webhook events received, per platform",
+    "webhook_events_total": "Webhook events after triage, per platform and type (message, status, echo, ...)",
+    "webhooks_routed_total": "Webhook events handed to a bot",
+    "webhooks_dropped_total": "Webhook events dropped before reaching a bot, per reason",
+    "task_retries_total": "Tasks rescheduled with RetryLater, per pool",
+    "fallback_replies_total": "Fallback replies returned instead of a model reply, per reason",
+    "dedup_fail_open_total": "Webhook keys processed without the shared dedup check (SQLite unavailable)",
+    "active_conversations": f"Conversations with activity in the last {int(METRICS_ACTIVE_S)}s",
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+_MAX_SHARDS = 256
+_MAX_CONVERSATIONS = int(os.getenv("METRICS_MAX_CONVERSATIONS", "50000"))
+
+_local = threading.local()
+_context: ContextVar[Optional[dict]] = ContextVar("metrics_labels", default=None)
+_shards: List[dict] = []          # shard لكل ثريد: {"c": counters, "h": histograms, "t": thread}
+_retired = {"c": {}, "h": {}}     # مجموع shards الثريدات المنتهية (ثريدات الطلبات قصيرة العمر)
+_shards_lock = threading.Lock()   # عند إنشاء shard جديد وعند القراءة فقط
+_gauges: Dict[str, Callable[[], Dict[Labels, float]]] = {}
+_conversations: Dict[tuple, float] = {}  # (platform, bot, conv) -> آخر نشاط
+_conversations_lock = threading.Lock()   # عند التنظيف فقط
+
+
+def _new_hist_row() -> list:
+    return [[0] * len(LATENCY_BUCKETS), 0.0, 0]
+
+
+def _merge(dst: dict, src: dict):
+    for k, v in src["c"].copy().items():
+        dst["c"][k] = dst["c"].get(k, 0) + v
+    for k, (buckets, total, count) in src["h"].copy().items():
+        row = dst["h"].get(k)
+        if row is None:
+            row = dst["h"][k] = _new_hist_row()
+        row[0] = [a + b for a, b in zip(row[0], list(buckets))]
+        row[1] += total
+        row[2] += count
+
+
+def _retire_dead_unlocked():
+    alive = []
+    for s in _shards:
+        if s["t"].is_alive():
+            alive.append(s)
+        else:
+            _merge(_retired, s)
+    _shards[:] = alive
+
+
+def _shard() -> dict:
+    s = getattr(_local, "shard", None)
+    if s is None:
+        s = _local.shard = {"c": {}, "h": {}, "t": threading.current_thread()}
+        with _shards_lock:
+            if len(_shards) >= _MAX_SHARDS:
+                _retire_dead_unlocked()
+            _shards.append(s)
+    return s
+
+
+def _labels_plain(**labels) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+def _labels(labels: dict) -> Labels:
+    ctx = _context.get()
+    if ctx:
+        labels = {**ctx, **labels}
+    return _labels_plain(**labels)
+
+
+# --------------- سياق التنفيذ ---------------
+
+def bind(platform: Optional[str] = None, bot: Optional[str] = None, conversation=None):
+    """يربط platform/bot بالسياق الحالي (حتى reset) ويسجّل نشاط المحادثة."""
+    _context.set({"platform": platform, "bot": bot})
+    if conversation is not None:
+        _conversations[(platform, bot, conversation)] = time.monotonic()
+        if len(_conversations) > _MAX_CONVERSATIONS:
+            _prune_conversations()
+
+
+def _prune_conversations():
+    """
+    يحذف المحادثات الأقدم من نافذة النشاط (بدون /metrics لا أحد غيره ينظف القاموس).
+    إن بقي فوق الحد (نشاط حقيقي أكبر منه) يحذف الأقدم حتى النصف.
+    """
+    if not _conversations_lock.acquire(blocking=False):
+        return  # ثريد آخر ينظف الآن
+    try:
+        cutoff = time.monotonic() - METRICS_ACTIVE_S
+        items = list(_conversations.items())
+        for key, seen in items:
+            if seen < cutoff:
+                _conversations.pop(key, None)
+        if len(_conversations) > _MAX_CONVERSATIONS:
+            oldest = sorted(_conversations.items(), key=lambda kv: kv[1])
+            for key, _ in oldest[:len(oldest) - _MAX_CONVERSATIONS // 2]:
+                _conversations.pop(key, None)
+    finally:
+        _conversations_lock.release()
+
+
+def current() -> dict:
+    return dict(_context.get() or {})
+
+
+def reset():
+    _context.set(None)
+
+
+# --------------- التسجيل ---------------
+
+def inc(name: str, value: float = 1, **labels):
+    c = _shard()["c"]
+    k = (name, _labels(labels))
+    c[k] = c.get(k, 0) + value
+
+
+def observe(name: str, seconds: float, **labels):
+    h = _shard()["h"]
+    k = (name, _labels(labels))
+    row = h.get(k)
+    if row is None:
+        row = h[k] = _new_hist_row()
+    for i, b in enumerate(LATENCY_BUCKETS):
+        if seconds <= b:
+            row[0][i] += 1
+            break
+    row[1] += seconds
+    row[2] += 1
+
+
+@contextmanager
+def timer(stage: str, **labels):
+    """with metrics.timer("openai"): ...  → stage_seconds{stage="openai",platform,bot}"""
+    t0 = time.monotonic()
+    try:
+        yield
+    finally:
+        observe("stage_seconds", time.monotonic() - t0, stage=stage, **labels)
+
+
+def register_gauge(name: str, fn: Callable[[], Dict[Labels, float]], help_text: str = ""):
+    """fn تُستدعى عند القراءة فقط وترجع {labels: value}."""
+    _gauges[name] = fn
+    if help_text:
+        HELP.setdefault(name, help_text)
+
+
+def _active_conversations() -> Dict[Labels, float]:
+    cutoff = time.monotonic() - METRICS_ACTIVE_S
+    out: Dict[Labels, float] = {}
+    for key, seen in list(_conversations.items()):
+        if seen < cutoff:
+            _conversations.pop(key, None)
+            continue
+        lab = _labels_plain(platform=key[0], bot=key[1])
+        out[lab] = out.get(lab, 0) + 1
+    return out
+
+
+register_gauge("active_conversations", _active_conversations)
+
+
+# --------------- التصدير ---------------
+
+def _fmt(labels: Labels, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    items = labels + extra
+    if not items:
+        return ""
+    esc = lambda v: v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+
+def _num(v: float) -> str:
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+
+def collect() -> Tuple[Dict[tuple, float], Dict[tuple, list]]:
+    """يجمع shards كل الثريدات (نسخ القواميس ذرّي تحت GIL)."""
+    total = {"c": {}, "h": {}}
+    with _shards_lock:
+        _retire_dead_unlocked()
+        _merge(total, _retired)
+        for s in _shards:
+            _merge(total, s)
+    return total["c"], total["h"]
+
+
+def render() -> str:
+    counters, hists = collect()
+    lines: List[str] = []
+
+    def header(name: str, kind: str):
+        full = METRICS_PREFIX + name
+        if name in HELP:
+            lines.append(f"# HELP {full} {HELP[name]}")
+        lines.append(f"# TYPE {full} {kind}")
+        return full
+
+    for name in sorted({n for n, _ in counters}):
+        full = header(name, "counter")
+        for (n, labels), v in sorted(counters.items()):
+            if n == name:
+                lines.append(f"{full}{_fmt(labels)} {_num(v)}")
+
+    for name in sorted({n for n, _ in hists}):
+        full = header(name, "histogram")
+        for (n, labels), (buckets, total, count) in sorted(hists.items()):
+            if n != name:
+                continue
+            acc = 0
+            for b, c in zip(LATENCY_BUCKETS, buckets):
+                acc += c
+                lines.append(f"{full}_bucket{_fmt(labels, (('le', _num(b)),))} {acc}")
+            lines.append(f"{full}_bucket{_fmt(labels, (('le', '+Inf'),))} {count}")
+            lines.append(f"{full}_sum{_fmt(labels)} {total:.6f}")
+            lines.append(f"{full}_count{_fmt(labels)} {count}")
+
+    for name, fn in sorted(_gauges.items()):
+        full = header(name, "gauge")
+        try:
+            values = fn()
+        except Exception:
+            continue
+        for labels, v in sorted(values.items()):
+            lines.append(f"{full}{_fmt(labels)} {_num(v)}")
+
+    return "\n".join(lines) + "\n"
@@ -1,73 +1,344 @@
 # services/nlp.py
 # -*- coding: utf-8 -*-
+import os
 import time
+import asyncio
+import json
+import logging
+from functools import lru_cache
+from typing import Iterator, List
+
 import requests
 
-OPENAI_BASE  = "https://api.openai.com/v1/chat/completions"
+from services import async_http, http_client, metrics
+from services.resilience import RetryLater, backoff_delay, breaker, parse_retry_after
+from services.workers import current_attempt, final_attempt
+
+OPENAI_BASE  = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1/chat/completions")
 OPENAI_MODEL = "gpt-4o-mini"   # غيّره هنا لو أردت موديل آخر من OpenAI
+# ميزانية التوكنز للسياق المرسل (system + history + رسالة المستخدم)
+CONTEXT_TOKENS = int(os.getenv("OPENAI_CONTEXT_TOKENS", "3000"))
+MSG_OVERHEAD_TOKENS = 4  # role + فواصل لكل رسالة في صيغة chat
+
+try:
+    import tiktoken  # اختياري: عدّ دقيق
+    _enc = tiktoken.get_encoding("o200k_base")
+except Exception:
+    _enc = None
 
-def _post_openai(openai_key: str, data: dict) -> requests.Response:
-    headers = {
-        "Authorization": f"Bearer {openai_key}",
-        "Content-Type": "application/json"
-    }
-    return requests.post(OPENAI_BASE, json=data, headers=headers, timeout=45)
 
-def generate_reply(openai_key: str, system_prompt: str, history: list, user_text: str) -> str:
+@lru_cache(maxsize=512)
+def count_tokens(text: str) -> int:
     """
-    يولّد رد باستخدام OpenAI مع 4 محاولات تلقائية عند 429/5xx
-    - يقلّص السياق ويطلب ردًا أقصر إذا رجعنا نحاول
+    عدد التوكنز لنص. مع tiktoken العدّ دقيق؛ بدونه تقدير بحسب بايتات UTF-8
+    (~4 بايت/توكن للاتينية، والعربية حرفين تقريبًا لكل توكن).
+    """
+    if not text:
+        return 0
+    if _enc is not None:
+        return len(_enc.encode(text))
+    return max(1, len(text.encode("utf-8")) // 4)
+
+
+def _msg_tokens(m: dict) -> int:
+    """
+    العدد يُحسب مرة واحدة ويُخزَّن مع الرسالة نفسها (m["tokens"]) فيبقى في services.history.
+    """
+    n = m.get("tokens")
+    if not isinstance(n, int):
+        n = count_tokens(m.get("content") or "") + MSG_OVERHEAD_TOKENS
+        m["tokens"] = n
+    return n
+
+
+def build_context(system_prompt: str, history: List[dict], user_text: str, budget: int = CONTEXT_TOKENS):
+    """
+    يبني رسائل الطلب ضمن ميزانية توكنز:
+      - system + رسالة المستخدم دائمًا موجودتان
+      - نملأ الباقي من الأحدث إلى الأقدم حتى تنتهي الميزانية
+    يرجع (messages, tokens_used, history_used)
     """
-    # الرسالة الأساسية
-    base_messages = [{"role": "system", "content": system_prompt}] + history + [
+    used = count_tokens(system_prompt) + count_tokens(user_text) + 2 * MSG_OVERHEAD_TOKENS
+    picked = []
+    for m in reversed(history or []):
+        n = _msg_tokens(m)
+        if used + n > budget:
+            break
+        used += n
+        picked.append({"role": m.get("role"), "content": m.get("content") or ""})
+    picked.reverse()
+    # لا نبدأ السياق برد مساعد بلا سؤاله
+    while picked and picked[0]["role"] == "assistant":
+        used -= _msg_tokens(history[len(history) - len(picked)])
+        picked.pop(0)
+    messages = [{"role": "system", "content": system_prompt}] + picked + [
         {"role": "user", "content": user_text}
     ]
+    return messages, used, len(picked)
 
-    # إعدادات أساسية
-    base_payload = {
-        "model": OPENAI_MODEL,
-        "messages": base_messages,
-        "temperature": 0.7,
+
+def _openai_headers(openai_key: str) -> dict:
+    return {
+        "Authorization": f"Bearer {openai_key}",
+        "Content-Type": "application/json"
     }
 
-    # محاولات مع backoff تصاعدي
-    backoffs = [0.6, 1.2, 2.5, 5.0]  # ثواني
-    for attempt in range(len(backoffs)):
-        payload = dict(base_payload)  # نسخة لكل محاولة
-
-        # عند إعادة المحاولة: قصّر الرد و السياق
-        if attempt > 0:
-            # قلل الميموري: خذ آخر 8 تبادلات فقط
-            trimmed_hist = history[-16:] if history else []
-            payload["messages"] = [{"role": "system", "content": system_prompt}] + trimmed_hist + [
-                {"role": "user", "content": user_text + "\n\n(رجاءً رد موجز ومباشر بحد 3 أسطر.)"}
-            ]
-            payload["temperature"] = 0.5
-            payload["max_tokens"] = 180  # رد أقصر لتقليل التوكنز
 
+def _post_openai(openai_key: str, data: dict, stream: bool = False) -> requests.Response:
+    return http_client.post(OPENAI_BASE, json=data, headers=_openai_headers(openai_key), stream=stream)
+
+TRANSIENT_STATUS = (429, 500, 502, 503, 504)
+MAX_ATTEMPTS = 4
+FALLBACK_UNAVAILABLE = "تعذّر توليد الرد الآن. الرجاء المحاولة بعد قليل."
+FALLBACK_NETWORK     = "صار تعذّر مؤقت أثناء توليد الرد، جرّب كمان شوي."
+FALLBACK_ERROR       = "حدث خطأ غير متوقع، حاول مرة أخرى."
+
+
+class StreamInterrupted(Exception):
+    """انقطع البث بعد وصول جزء من الرد: ما استُلم حتى الآن ناقص ولا يُحفظ كرد."""
+
+
+def is_fallback(reply: str) -> bool:
+    """هل الرد رسالة احتياطية (خطأ/تعطّل) وليس ردًا فعليًا من النموذج؟"""
+    return (reply or "").startswith((FALLBACK_UNAVAILABLE, FALLBACK_NETWORK, FALLBACK_ERROR))
+
+
+def _attempt_payload(system_prompt: str, history: list, user_text: str, attempt: int) -> dict:
+    if attempt == 0:
+        messages, tokens, hist_used = build_context(system_prompt, history, user_text)
+        payload = {"model": OPENAI_MODEL, "messages": messages, "temperature": 0.7}
+    else:
+        # عند إعادة المحاولة: قصّر الرد و السياق (نصف الميزانية فقط)
+        messages, tokens, hist_used = build_context(
+            system_prompt, history, user_text + "\n\n(رجاءً رد موجز ومباشر بحد 3 أسطر.)",
+            budget=CONTEXT_TOKENS // 2,
+        )
+        payload = {
+            "model": OPENAI_MODEL,
+            "messages": messages,
+            "temperature": 0.5,
+            "max_tokens": 180,  # رد أقصر لتقليل التوكنز
+        }
+    logging.info("[nlp] attempt=%d prompt_tokens~%d history=%d/%d msgs",
+                 attempt, tokens, hist_used, len(history or []))
+    return payload
+
+
+def generate_reply(openai_key: str, system_prompt: str, history: list, user_text: str,
+                   first_attempt: int = 0) -> str:
+    """
+    يولّد رد باستخدام OpenAI مع 4 محاولات تلقائية عند 429/5xx/أخطاء الشبكة
+    - داخل ثريدات services.workers لا ننام بين المحاولات: نرمي RetryLater
+      فتُعاد المهمة لاحقًا (backoff عشوائي يحترم Retry-After) والثريد يخدم غيرها
+    - circuit breaker لكل مفتاح API: إذا كان مفتوحًا نرجع الرد الاحتياطي فورًا
+    - يقلّص السياق ويطلب ردًا أقصر إذا رجعنا نحاول
+    first_attempt: خارج الـ pool، عدد المحاولات المستهلكة مسبقًا (بعد فشل generate_reply_stream)
+    """
+    br = breaker("openai", openai_key)
+    scheduled = current_attempt()  # None خارج ثريدات الـ pool
+    attempt = scheduled or first_attempt
+
+    while True:
+        if not br.allow():
+            logging.warning("[nlp] openai breaker open, returning fallback")
+            metrics.inc("fallback_replies_total", reason="breaker_open")
+            return FALLBACK_UNAVAILABLE
+
+        payload = _attempt_payload(system_prompt, history, user_text, attempt)
+        # final_attempt: الـ pool لن يعيد المهمة بعد الآن (آخر محاولة أو انتهت مهلة إعادة الجدولة)
+        last = attempt >= MAX_ATTEMPTS - 1 or final_attempt()
+        retry_after = None
+        t0 = time.monotonic()
         try:
-            r = _post_openai(openai_key, payload)
+            with metrics.timer("openai"):
+                r = _post_openai(openai_key, payload)
+        except requests.RequestException as e:
+            # لو مشكلة شبكة/مهلة: أعد المحاولة، وإلا أرجع رسالة لطيفة
+            br.record(False, time.monotonic() - t0)
+            if last:
+                metrics.inc("fallback_replies_total", reason="network")
+                return FALLBACK_NETWORK
+            reason = str(e)
+        else:
+            latency = time.monotonic() - t0
             # 429/5xx → جرّب مرة ثانية
-            if r.status_code in (429, 500, 502, 503, 504):
+            if r.status_code in TRANSIENT_STATUS:
+                br.record(False, latency)
                 # آخر محاولة؟ ارجع برسالة مفهومة
-                if attempt == len(backoffs) - 1:
+                if last:
                     try:
                         detail = r.json()
                     except Exception:
                         detail = {"status": r.status_code}
-                    return f"تعذّر توليد الرد الآن. الرجاء المحاولة بعد قليل. (تفاصيل: {detail})"
-                time.sleep(backoffs[attempt])
+                    metrics.inc("fallback_replies_total", reason=f"status_{r.status_code}")
+                    return f"{FALLBACK_UNAVAILABLE} (تفاصيل: {detail})"
+                retry_after = parse_retry_after(r.headers.get("Retry-After"))
+                reason = f"status {r.status_code}"
+            else:
+                try:
+                    r.raise_for_status()
+                    data = r.json()
+                    content = (data["choices"][0]["message"]["content"] or "").strip()
+                except (requests.RequestException, ValueError, KeyError, IndexError) as e:
+                    # 4xx (مفتاح خاطئ، طلب مرفوض...) لا فائدة من إعادته
+                    br.record(False, latency)
+                    logging.error("[nlp] non-retryable OpenAI error: %s", e)
+                    metrics.inc("fallback_replies_total", reason="error")
+                    return FALLBACK_ERROR
+                br.record(True, latency)
+                return content
+
+        delay = backoff_delay(attempt, retry_after)
+        if scheduled is not None:
+            raise RetryLater(delay, f"openai {reason}")
+        time.sleep(delay)  # استدعاء متزامن خارج الـ pool
+        attempt += 1
+
+
+def generate_reply_stream(openai_key: str, system_prompt: str, history: list, user_text: str) -> Iterator[str]:
+    """
+    نسخة streaming (stream=True): تُرجع أجزاء النص فور وصولها من OpenAI.
+    طلب البث هو المحاولة الأولى من نفس ميزانية generate_reply: إذا فشل قبل وصول أي جزء
+    يُسجَّل الفشل في القاطع مرة واحدة، ثم RetryLater داخل الـ pool (الإعادة تذهب مباشرة
+    للمسار العادي بالمحاولة التالية)، أو انتظار ثم generate_reply من المحاولة 1 خارجه.
+    يسجّل زمن أول توكن (TTFB) منفصلًا عن الزمن الكلي.
+    إذا انقطع البث بعد أول جزء (أو انتهى بدون [DONE]) يرمي StreamInterrupted بدل إنهاء
+    النص الناقص كأنه رد كامل.
+    """
+    scheduled = current_attempt()  # None خارج ثريدات الـ pool
+    if scheduled or final_attempt():
+        # إعادة بعد فشل البث (أو لا إعادة بعد الآن): رد كامل كما في generate_reply
+        yield generate_reply(openai_key, system_prompt, history, user_text)
+        return
+
+    messages, tokens, hist_used = build_context(system_prompt, history, user_text)
+    payload = {
+        "model": OPENAI_MODEL,
+        "messages": messages,
+        "temperature": 0.7,
+        "stream": True,
+    }
+    logging.info("[nlp] stream prompt_tokens~%d history=%d/%d msgs", tokens, hist_used, len(history or []))
+
+    br = breaker("openai", openai_key)
+    if not br.allow():
+        metrics.inc("fallback_replies_total", reason="breaker_open")
+        yield FALLBACK_UNAVAILABLE
+        return
+
+    t0 = time.monotonic()
+    ttfb = None
+    chunks = 0
+    done = False
+    retry_after = None
+    try:
+        r = _post_openai(openai_key, payload, stream=True)
+    except requests.RequestException as e:
+        r, reason = None, str(e)
+    br.record(r is not None and r.status_code == 200, time.monotonic() - t0)
+    if r is None or r.status_code != 200:
+        if r is not None:
+            r.close()
+            if r.status_code not in TRANSIENT_STATUS:
+                logging.error("[nlp] non-retryable OpenAI stream error: status %s", r.status_code)
+                metrics.inc("fallback_replies_total", reason="error")
+                yield FALLBACK_ERROR
+                return
+            retry_after = parse_retry_after(r.headers.get("Retry-After"))
+            reason = f"status {r.status_code}"
+        delay = backoff_delay(0, retry_after)
+        if scheduled is not None:
+            raise RetryLater(delay, f"openai stream {reason}")
+        time.sleep(delay)  # استدعاء متزامن خارج الـ pool
+        yield generate_reply(openai_key, system_prompt, history, user_text, first_attempt=1)
+        return
+
+    try:
+        for line in r.iter_lines(decode_unicode=False):
+            if not line or not line.startswith(b"data:"):
+                continue
+            data = line[5:].strip()
+            if data == b"[DONE]":
+                done = True
+                break
+            try:
+                delta = json.loads(data)["choices"][0].get("delta", {}).get("content")
+            except (ValueError, KeyError, IndexError):
                 continue
+            if not delta:
+                continue
+            if ttfb is None:
+                ttfb = time.monotonic() - t0
+            chunks += 1
+            yield delta
+    except requests.RequestException as e:
+        logging.error("[nlp] stream interrupted after %d chunks: %s", chunks, e)
+        if ttfb is not None:
+            metrics.inc("fallback_replies_total", reason="stream_interrupted")
+            raise StreamInterrupted(f"after {chunks} chunks: {e}") from e
+        metrics.inc("fallback_replies_total", reason="network")
+        yield FALLBACK_NETWORK
+    else:
+        if not done and ttfb is not None:
+            logging.error("[nlp] stream ended without [DONE] after %d chunks", chunks)
+            metrics.inc("fallback_replies_total", reason="stream_interrupted")
+            raise StreamInterrupted(f"no [DONE] after {chunks} chunks")
+    finally:
+        r.close()
+        metrics.observe("stage_seconds", time.monotonic() - t0, stage="openai_stream")
+        if ttfb is not None:
+            metrics.observe("stage_seconds", ttfb, stage="openai_ttfb")
+        logging.info("[nlp] stream ttfb=%.0fms total=%.0fms chunks=%d",
+                     (ttfb or 0) * 1000, (time.monotonic() - t0) * 1000, chunks)
 
-            r.raise_for_status()
-            data = r.json()
-            return (data["choices"][0]["message"]["content"] or "").strip()
 
-        except requests.RequestException as e:
-            # لو مشكلة شبكة/مهلة: أعد المحاولة، وإلا أرجع رسالة لطيفة
-            if attempt == len(backoffs) - 1:
-                return "صار تعذّر مؤقت أثناء توليد الرد، جرّب كمان شوي."
-            time.sleep(backoffs[attempt])
+async def agenerate_reply(openai_key: str, system_prompt: str, history: list, user_text: str) -> str:
+    """
+    نسخة asyncio من generate_reply (نفس المحاولات والقاطع والردود الاحتياطية)
+    على العميل المشترك services.async_http: الانتظار بين المحاولات لا يحجز أي ثريد.
+    """
+    br = breaker("openai", openai_key)
+    for attempt in range(MAX_ATTEMPTS):
+        if not br.allow():
+            logging.warning("[nlp] openai breaker open, returning fallback")
+            metrics.inc("fallback_replies_total", reason="breaker_open")
+            return FALLBACK_UNAVAILABLE
+
+        payload = _attempt_payload(system_prompt, history, user_text, attempt)
+        last = attempt >= MAX_ATTEMPTS - 1
+        retry_after = None
+        t0 = time.monotonic()
+        try:
+            with metrics.timer("openai"):
+                r = await async_http.post(OPENAI_BASE, json=payload, headers=_openai_headers(openai_key))
+        except async_http.HTTP_ERRORS:
+            br.record(False, time.monotonic() - t0)
+            if last:
+                metrics.inc("fallback_replies_total", reason="network")
+                return FALLBACK_NETWORK
+        else:
+            latency = time.monotonic() - t0
+            if r.status_code in TRANSIENT_STATUS:
+                br.record(False, latency)
+                if last:
+                    try:
+                        detail = r.json()
+                    except ValueError:
+                        detail = {"status": r.status_code}
+                    metrics.inc("fallback_replies_total", reason=f"status_{r.status_code}")
+                    return f"{FALLBACK_UNAVAILABLE} (تفاصيل: {detail})"
+                retry_after = parse_retry_after(r.headers.get("Retry-After"))
+            else:
+                try:
+                    r.raise_for_status()
+                    content = (r.json()["choices"][0]["message"]["content"] or "").strip()
+                except (async_http.HTTP_ERRORS + (ValueError, KeyError, IndexError)) as e:
+                    br.record(False, latency)
+                    logging.error("[nlp] non-retryable OpenAI error: %s", e)
+                    metrics.inc("fallback_replies_total", reason="error")
+                    return FALLBACK_ERROR
+                br.record(True, latency)
+                return content
 
-    # احتياط (ما لازم نوصلها)
-    return "حدث خطأ غير متوقع، حاول مرة أخرى."
+        await asyncio.sleep(backoff_delay(attempt, retry_after))
+    return FALLBACK_UNAVAILABLE
@@ -0,0 +1,252 @@
+# services/outbox.py
+# -*- coding: utf-8 -*-
+"""
+طابور الإرسال الصادر لكل المنصات:
+  - token bucket لكل بوت (الحد العام للمنصة) ولكل مستلم
+  - الترتيب محفوظ لكل محادثة (مفتاح services.workers = (platform, bot, recipient))
+  - الأخطاء المؤقتة (429/5xx/الشبكة) تُعاد في الخلفية مع backoff يحترم Retry-After
+  - انتظار الحدود أو إعادة المحاولة لا يشغل أي ثريد (RetryLater)
+  - طابور ممتلئ لا يُسقط الرد: send_or_retry يعيد معالجة الرسالة لاحقًا، و send_or_inline
+    يرسل متزامنًا مرة واحدة (انظر كل منهما)
+  - asend: نفس الحدود وإعادة المحاولة لمسار asyncio (asgi.py) بـ asyncio.sleep
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+import requests
+
+from services.resilience import RetryLater, backoff_delay, parse_retry_after
+from services.workers import TASK_MAX_ATTEMPTS, WorkerPool, current_attempt, final_attempt
+from services import async_http, metrics
+
+OUTBOX_WORKERS   = int(os.getenv("OUTBOX_WORKERS", "4"))
+OUTBOX_QUEUE_MAX = int(os.getenv("OUTBOX_QUEUE_MAX", "5000"))
+# بعد كم ثانية تُعاد معالجة رسالة رُفض ردها لأن الطابور ممتلئ
+OUTBOX_FULL_RETRY_S = float(os.getenv("OUTBOX_FULL_RETRY", "1.0"))
+
+
+def _rate(name: str, default: str) -> float:
+    return float(os.getenv(name, default))
+
+
+# (rate/sec, burst) حسب الحدود المنشورة لكل منصة
+LIMITS: Dict[str, Dict[str, Tuple[float, float]]] = {
+    # Telegram: ~30 رسالة/ث لكل بوت، ولا أكثر من رسالة/ث تقريبًا لنفس المحادثة
+    "telegram": {
+        "bot": (_rate("TG_RATE_BOT", "30"), _rate("TG_BURST_BOT", "30")),
+        "recipient": (_rate("TG_RATE_CHAT", "1"), _rate("TG_BURST_CHAT", "3")),
+    },
+    # WhatsApp Cloud: 80 رسالة/ث لكل رقم، و pair limit: رسالة كل 6 ث لنفس المستخدم مع burst
+    "whatsapp": {
+        "bot": (_rate("WA_RATE_PHONE", "80"), _rate("WA_BURST_PHONE", "80")),
+        "recipient": (_rate("WA_RATE_USER", str(1 / 6)), _rate("WA_BURST_USER", "10")),
+    },
+    # Instagram Send API: ~100 طلب/ث لكل حساب
+    "instagram": {
+        "bot": (_rate("IG_RATE_ACCOUNT", "100"), _rate("IG_BURST_ACCOUNT", "100")),
+        "recipient": (_rate("IG_RATE_USER", "1"), _rate("IG_BURST_USER", "5")),
+    },
+}
+
+_MAX_BUCKETS = 20000
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        self._refill(now)
+        if self.tokens >= 1.0:
+            return 0.0
+        return (1.0 - self.tokens) / self.rate if self.rate > 0 else 1.0
+
+    def consume(self):
+        self.tokens -= 1.0
+
+
+def _retry_hint(e: Exception) -> Tuple[bool, Optional[float]]:
+    """(هل الخطأ مؤقت؟, Retry-After بالثواني)"""
+    # telebot ApiTelegramException
+    code = getattr(e, "error_code", None)
+    if code is not None:
+        params = (getattr(e, "result_json", None) or {}).get("parameters") or {}
+        return code == 429 or code >= 500, params.get("retry_after")
+    if isinstance(e, (requests.HTTPError,) + async_http.HTTP_ERRORS):
+        resp = getattr(e, "response", None)
+        if resp is not None:
+            status = resp.status_code
+            return status == 429 or status >= 500, parse_retry_after(resp.headers.get("Retry-After"))
+    if isinstance(e, (requests.ConnectionError, requests.Timeout) + async_http.TRANSPORT_ERRORS):
+        return True, None
+    return False, None
+
+
+class Outbox:
+    def __init__(self, workers: int = OUTBOX_WORKERS, maxsize: int = OUTBOX_QUEUE_MAX):
+        self._pool = WorkerPool(size=workers, maxsize=maxsize, name="outbox")
+        self._buckets: Dict[Hashable, TokenBucket] = {}
+        self._lock = threading.Lock()
+        self.counters: Dict[str, Dict[str, int]] = {}
+
+    def _count(self, platform: str, what: str):
+        with self._lock:
+            row = self.counters.setdefault(platform, {"queued": 0, "sent": 0, "failed": 0, "retried": 0,
+                                                     "throttled": 0, "rejected": 0, "inline": 0})
+            row[what] += 1
+
+    def _bucket(self, platform: str, scope: str, ident: Hashable) -> TokenBucket:
+        key = (platform, scope, ident)
+        b = self._buckets.get(key)
+        if b is None:
+            if len(self._buckets) >= _MAX_BUCKETS:
+                self._prune()
+            rate, burst = LIMITS.get(platform, {}).get(scope, (10.0, 10.0))
+            b = self._buckets[key] = TokenBucket(rate, burst)
+        return b
+
+    def _prune(self):
+        """يحذف الدلاء الممتلئة (غير المستخدمة مؤخرًا) حتى لا يكبر القاموس بلا حد."""
+        now = time.monotonic()
+        for k in [k for k, b in self._buckets.items() if b.wait_time(now) == 0.0 and b.tokens >= b.burst]:
+            del self._buckets[k]
+
+    def _acquire(self, platform: str, bot_key: str, recipient: Hashable) -> float:
+        """يأخذ توكن من دلو البوت ودلو المستلم معًا، أو يرجع مدة الانتظار اللازمة."""
+        now = time.monotonic()
+        with self._lock:
+            b_bot = self._bucket(platform, "bot", bot_key)
+            b_rcp = self._bucket(platform, "recipient", (bot_key, recipient))
+            wait = max(b_bot.wait_time(now), b_rcp.wait_time(now))
+            if wait > 0:
+                return wait
+            b_bot.consume()
+            b_rcp.consume()
+            return 0.0
+
+    def _deliver(self, platform: str, bot_key: str, recipient: Hashable, fn: Callable, args: tuple, kwargs: dict,
+                 labels: Optional[dict] = None):
+        metrics.bind(**(labels or {"platform": platform}))
+        final = final_attempt()  # لن يعيدها الـ pool بعد الآن
+        wait = self._acquire(platform, bot_key, recipient)
+        if wait > 0 and not final:
+            self._count(platform, "throttled")
+            raise RetryLater(wait, "rate limit", count_attempt=False)
+        try:
+            with metrics.timer("send"):
+                fn(*args, **kwargs)
+        except RetryLater:
+            # المهمة نفسها طلبت الانتظار (مثل توليد صوت أُجّل إلى outbox)
+            self._count(platform, "failed" if final else "retried")
+            raise
+        except Exception as e:
+            transient, retry_after = _retry_hint(e)
+            if transient and not final:
+                self._count(platform, "retried")
+                raise RetryLater(backoff_delay(current_attempt() or 0, retry_after), f"{platform} send: {e}")
+            self._count(platform, "failed")
+            logging.error("[outbox] %s send to %s failed%s: %s", platform, recipient,
+                          " after the last attempt" if transient else "", e)
+            return
+        self._count(platform, "sent")
+
+    def _send_inline(self, platform: str, recipient: Hashable, fn: Callable, args: tuple, kwargs: dict) -> bool:
+        """إرسال متزامن محدود: محاولة واحدة في ثريد المستدعي (بدون حدود المعدل ولا إعادة)."""
+        self._count(platform, "inline")
+        try:
+            with metrics.timer("send"):
+                fn(*args, **kwargs)
+        except Exception as e:
+            self._count(platform, "failed")
+            logging.error("[outbox] %s inline send to %s failed: %s", platform, recipient, e)
+            return False
+        self._count(platform, "sent")
+        return True
+
+    def send(self, platform: str, bot_key: str, recipient: Hashable, fn: Callable, *args, **kwargs) -> bool:
+        """
+        يضع الإرسال في الطابور ويرجع فورًا. bot_key = معرّف البوت/الرقم الذي تُحسب عليه حدود المنصة (لا نمرر التوكن حتى لا يظهر في السجلات).
+        الرسائل لنفس (platform, bot_key, recipient) تُرسل بالترتيب.
+        يرجع False إذا الطابور ممتلئ (لم يُرسل شيء): ردود المستخدم تمر عبر send_or_retry / send_or_inline.
+        """
+        # تسميات المقاييس (platform/bot) من ثريد المعالجة تنتقل مع الإرسال
+        ok = self._pool.submit(self._deliver, platform, bot_key, recipient, fn, args, kwargs, metrics.current() or None,
+                               key=(platform, bot_key, recipient))
+        self._count(platform, "queued" if ok else "rejected")
+        return ok
+
+    def send_or_retry(self, platform: str, bot_key: str, recipient: Hashable, fn: Callable, *args, **kwargs) -> bool:
+        """
+        send لأول ما يُرسل من رد (لم يصل المستخدم منه شيء بعد). إذا امتلأ الطابور داخل
+        services.workers يرمي RetryLater فتُعاد معالجة الرسالة لاحقًا — لذلك يحفظ المستدعي
+        الذاكرة والكاش بعد قبول الإرسال فقط. في آخر محاولة أو خارج الـ pool يرسل متزامنًا.
+        يرجع هل قُبل الإرسال (أو نجح متزامنًا).
+        """
+        if self.send(platform, bot_key, recipient, fn, *args, **kwargs):
+            return True
+        if current_attempt() is not None and not final_attempt():
+            raise RetryLater(OUTBOX_FULL_RETRY_S, f"{platform} outbox full", count_attempt=False)
+        return self._send_inline(platform, recipient, fn, args, kwargs)
+
+    def send_or_inline(self, platform: str, bot_key: str, recipient: Hashable, fn: Callable, *args, **kwargs) -> bool:
+        """
+        send لبقية رد بدأ تسليمه (المقاطع التالية، التعديل النهائي): إعادة الرسالة كلها
+        تكرر ما وصل، فإذا امتلأ الطابور نرسل متزامنًا مرة واحدة بدل الإسقاط.
+        """
+        return (self.send(platform, bot_key, recipient, fn, *args, **kwargs)
+                or self._send_inline(platform, recipient, fn, args, kwargs))
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """ينتظر إرسال كل ما في الطابور (عند إيقاف العملية). يرجع False إن بقي شيء."""
+        return self._pool.join(timeout)
+
+    async def asend(self, platform: str, bot_key: str, recipient, fn: Callable[..., Awaitable], *args, **kwargs) -> bool:
+        """
+        نسخة asyncio من send: تنتظر حدود المعدل وتعيد المحاولة للأخطاء المؤقتة بـ asyncio.sleep.
+        الترتيب لكل محادثة يحفظه المستدعي (services.aio ينفّذ مهام نفس المحادثة بالتتابع).
+        """
+        self._count(platform, "queued")
+        attempt = 0
+        while True:
+            wait = self._acquire(platform, bot_key, recipient)
+            if wait > 0:
+                self._count(platform, "throttled")
+                await asyncio.sleep(wait)
+                continue
+            try:
+                with metrics.timer("send"):
+                    await fn(*args, **kwargs)
+            except Exception as e:
+                transient, retry_after = _retry_hint(e)
+                attempt += 1
+                if transient and attempt < TASK_MAX_ATTEMPTS:
+                    self._count(platform, "retried")
+                    await asyncio.sleep(backoff_delay(attempt - 1, retry_after))
+                    continue
+                self._count(platform, "failed")
+                logging.error("[outbox] %s send to %s failed: %s", platform, recipient, e)
+                return False
+            self._count(platform, "sent")
+            return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = {p: dict(c) for p, c in self.counters.items()}
+            buckets = len(self._buckets)
+        return {"pool": self._pool.stats(), "platforms": counters, "buckets": buckets}
+
+
+outbox = Outbox()
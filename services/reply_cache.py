@@ -0,0 +1,128 @@
+# services/reply_cache.py
+# -*- coding: utf-8 -*-
+"""
+كاش ردود اختياري لكل بوت للأسئلة المتكررة ("كم السعر"، "وين موقعكم"...):
+  - المفتاح = hash بروفايل الشركة + نص المستخدم بعد تطبيع عربي
+  - فقط لأول رسالة في المحادثة (بدون سياق سابق يغيّر معنى السؤال)
+  - TTL + LRU، ويُمسح تلقائيًا عند update_profile
+"""
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from services.nlp import is_fallback
+
+REPLY_CACHE_TTL     = float(os.getenv("REPLY_CACHE_TTL", "3600"))
+REPLY_CACHE_MAX     = int(os.getenv("REPLY_CACHE_MAX", "500"))
+REPLY_CACHE_DEFAULT = os.getenv("REPLY_CACHE_DEFAULT", "0") == "1"
+REPLY_CACHE_MAX_LEN = int(os.getenv("REPLY_CACHE_MAX_LEN", "120"))  # أسئلة قصيرة فقط
+
+_TASHKEEL = re.compile("[ؐ-ًؚ-ٰٟۖ-ۭـ]")  # حركات + تطويل
+_FOLD = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+    "ى": "ي",
+    "ة": "ه",
+    "٠": "0", "١": "1", "٢": "2", "٣": "3", "٤": "4",
+    "٥": "5", "٦": "6", "٧": "7", "٨": "8", "٩": "9",
+})
+
+
+def normalize_ar(text: str) -> str:
+    """
+    يوحّد الصيغ: يحذف التشكيل والتطويل، يوحّد الألف والياء والتاء المربوطة،
+    ويحذف علامات الترقيم والرموز ("كم السعر؟" == "كم السّعر").
+    """
+    t = unicodedata.normalize("NFKC", text or "")
+    t = _TASHKEEL.sub("", t).translate(_FOLD).lower()
+    t = "".join(" " if unicodedata.category(ch)[0] in "PS" else ch for ch in t)
+    return " ".join(t.split())
+
+
+def profile_hash(profile: dict) -> str:
+    raw = json.dumps((profile or {}).get("company") or {}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+class ReplyCache:
+    def __init__(self, ttl: float = REPLY_CACHE_TTL, maxsize: int = REPLY_CACHE_MAX):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, profile: dict, history: list, user_text: str) -> Tuple[Optional[str], Optional[str]]:
+        """
+        يرجع (key, reply). key=None يعني أن الرسالة غير قابلة للكاش (الكاش غير مفعّل،
+        أو في المحادثة سياق سابق، أو نص طويل). reply=None يعني عدم وجود رد محفوظ.
+        """
+        if not (profile or {}).get("reply_cache", REPLY_CACHE_DEFAULT) or history:
+            return None, None
+        norm = normalize_ar(user_text)
+        if not norm or len(norm) > REPLY_CACHE_MAX_LEN:
+            return None, None
+        key = f"{profile_hash(profile)}:{norm}"
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return key, item[1]
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+        return key, None
+
+    def store(self, key: Optional[str], reply: str):
+        if not key or not reply or is_fallback(reply):
+            return  # لا نحفظ رسائل التعطّل
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, reply)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            }
+
+
+_caches: Dict[str, ReplyCache] = {}
+_caches_lock = threading.Lock()
+
+
+def for_bot(bot_id: str) -> ReplyCache:
+    with _caches_lock:
+        c = _caches.get(bot_id)
+        if c is None:
+            c = _caches[bot_id] = ReplyCache()
+        return c
+
+
+def drop_bot(bot_id: str):
+    with _caches_lock:
+        _caches.pop(bot_id, None)
+
+
+def stats() -> dict:
+    with _caches_lock:
+        items = list(_caches.items())
+    return {bot_id: c.stats() for bot_id, c in items}
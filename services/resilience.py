@@ -0,0 +1,176 @@
+# services/resilience.py
+# -*- coding: utf-8 -*-
+"""
+أدوات التعامل مع مزوّد متعطّل (OpenAI / ElevenLabs ...):
+  - CircuitBreaker لكل (مزوّد، مفتاح API): يفتح عند ارتفاع نسبة الأخطاء أو البطء
+    فنرجع الرد الاحتياطي فورًا بدل انتظار مهلات متكررة
+  - backoff_delay: انتظار عشوائي (full jitter) يحترم Retry-After
+  - RetryLater: يطلب من services.workers إعادة المهمة لاحقًا بدل النوم داخل الثريد
+"""
+import os
+import time
+import random
+import hashlib
+import logging
+import threading
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional, Tuple
+
+BREAKER_WINDOW_S     = float(os.getenv("BREAKER_WINDOW", "60"))
+BREAKER_MIN_CALLS    = int(os.getenv("BREAKER_MIN_CALLS", "8"))
+BREAKER_ERROR_RATE   = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_SLOW_RATE    = float(os.getenv("BREAKER_SLOW_RATE", "0.8"))
+BREAKER_OPEN_S       = float(os.getenv("BREAKER_OPEN", "30"))
+BACKOFF_BASE_S       = float(os.getenv("RETRY_BACKOFF_BASE", "0.6"))
+BACKOFF_CAP_S        = float(os.getenv("RETRY_BACKOFF_CAP", "30"))
+# زمن الاستجابة الذي يُعتبر بطيئًا لكل مزوّد
+SLOW_CALL_S = {
+    "openai": float(os.getenv("BREAKER_SLOW_OPENAI", "20")),
+    "elevenlabs": float(os.getenv("BREAKER_SLOW_ELEVEN", "20")),
+}
+
+
+class RetryLater(Exception):
+    """
+    تُرمى داخل مهمة في services.workers: تُعاد المهمة نفسها بعد delay ثانية
+    (بنفس ترتيب المحادثة) دون إشغال ثريد بالنوم.
+    count_attempt=False للانتظار الذي ليس فشلًا (مثل حدود المعدل) فلا يُحسب من المحاولات.
+    """
+
+    def __init__(self, delay: float, reason: str = "", count_attempt: bool = True):
+        super().__init__(f"retry in {delay:.2f}s: {reason}")
+        self.delay = delay
+        self.reason = reason
+        self.count_attempt = count_attempt
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After بالثواني أو كتاريخ HTTP."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None,
+                  base: float = BACKOFF_BASE_S, cap: float = BACKOFF_CAP_S) -> float:
+    """full jitter: عشوائي بين 0 و base*2^attempt، ولا يقل عن Retry-After إن وُجد."""
+    delay = random.uniform(0, min(cap, base * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, min(cap, retry_after))
+    return delay
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str, slow_call_s: float = 20.0):
+        self.name = name
+        self.slow_call_s = slow_call_s
+        self.state = self.CLOSED
+        self._calls: deque = deque()  # (t, ok, slow)
+        self._opened_at = 0.0
+        self._probe = False
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self.transitions: deque = deque(maxlen=20)  # (t, from, to, reason)
+
+    def _set_state(self, new: str, reason: str):
+        if new == self.state:
+            return
+        self.transitions.append((time.time(), self.state, new, reason))
+        logging.warning("[breaker] %s: %s -> %s (%s)", self.name, self.state, new, reason)
+        self.state = new
+        if new == self.OPEN:
+            self._opened_at = time.monotonic()
+        if new == self.CLOSED:
+            self._calls.clear()
+        self._probe = False
+
+    def _trim(self, now: float):
+        while self._calls and now - self._calls[0][0] > BREAKER_WINDOW_S:
+            self._calls.popleft()
+
+    def allow(self) -> bool:
+        """هل نرسل الطلب؟ في half_open نسمح بطلب تجريبي واحد فقط."""
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at >= BREAKER_OPEN_S:
+                    self._set_state(self.HALF_OPEN, "cool-down elapsed")
+                else:
+                    self.rejected += 1
+                    return False
+            if self.state == self.HALF_OPEN:
+                if self._probe:
+                    self.rejected += 1
+                    return False
+                self._probe = True
+            return True
+
+    def record(self, ok: bool, latency: float = 0.0):
+        now = time.monotonic()
+        slow = latency >= self.slow_call_s
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                if ok and not slow:
+                    self._set_state(self.CLOSED, "probe succeeded")
+                else:
+                    self._set_state(self.OPEN, "probe failed")
+                return
+            self._calls.append((now, ok, slow))
+            self._trim(now)
+            n = len(self._calls)
+            if self.state != self.CLOSED or n < BREAKER_MIN_CALLS:
+                return
+            errors = sum(1 for _, good, _s in self._calls if not good)
+            slows = sum(1 for _, _g, s in self._calls if s)
+            if errors / n >= BREAKER_ERROR_RATE:
+                self._set_state(self.OPEN, f"error rate {errors}/{n}")
+            elif slows / n >= BREAKER_SLOW_RATE:
+                self._set_state(self.OPEN, f"slow calls {slows}/{n}")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            self._trim(time.monotonic())
+            n = len(self._calls)
+            return {
+                "state": self.state,
+                "window_calls": n,
+                "window_errors": sum(1 for _, good, _s in self._calls if not good),
+                "window_slow": sum(1 for _, _g, s in self._calls if s),
+                "rejected": self.rejected,
+                "transitions": [
+                    {"at": round(t, 3), "from": a, "to": b, "reason": r} for t, a, b, r in self.transitions
+                ],
+            }
+
+
+_breakers: Dict[Tuple[str, str], CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker(provider: str, api_key: str = "") -> CircuitBreaker:
+    """قاطع لكل (مزوّد، مفتاح API) — مفتاح عميل معطّل لا يوقف بقية العملاء."""
+    key_id = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:10]
+    k = (provider, key_id)
+    b = _breakers.get(k)
+    if b is None:
+        with _breakers_lock:
+            b = _breakers.get(k)
+            if b is None:
+                b = _breakers[k] = CircuitBreaker(f"{provider}:{key_id}", SLOW_CALL_S.get(provider, 20.0))
+    return b
+
+
+def snapshot() -> dict:
+    with _breakers_lock:
+        items = list(_breakers.items())
+    return {f"{p}:{k}": b.snapshot() for (p, k), b in items}
@@ -1,15 +1,56 @@
 # services/tts.py
 # -*- coding: utf-8 -*-
+import io
 import os
+import re
 import time
+import asyncio
+import json
+import hashlib
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import copy_context
+from typing import Any, AsyncIterator, BinaryIO, Callable, Iterator, List, Optional
+
 import requests
 
+from services import async_http, http_client, metrics
+from services.resilience import RetryLater, backoff_delay, breaker, parse_retry_after
+from services.workers import current_attempt, final_attempt
+
 ELEVEN_BASE   = os.getenv("ELEVEN_API_BASE", "https://api.elevenlabs.io/v1/text-to-speech")
 TIMEOUT_S     = float(os.getenv("ELEVEN_TIMEOUT", "60"))
 MAX_RETRIES   = int(os.getenv("ELEVEN_RETRIES", "3"))
 BACKOFF_S     = float(os.getenv("ELEVEN_BACKOFF", "1.5"))
+# أقصى انتظار داخل الثريد قبل إعادة المحاولة خارج services.workers (داخله نرمي RetryLater)؛
+# أطول من ذلك نفشل فورًا ويرسل المستدعي نصًا بدل الصوت
+MAX_INLINE_WAIT_S = float(os.getenv("ELEVEN_MAX_INLINE_WAIT", "1.0"))
+MAX_ASYNC_WAIT_S  = float(os.getenv("ELEVEN_MAX_ASYNC_WAIT", "10.0"))  # نفس الحد لمسار asyncio
 # حدود آمنة للنص (ElevenLabs عادةً يتحمل ~5000 حرف). نخليها قابلة للتغيير:
 MAX_TTS_CHARS = int(os.getenv("ELEVEN_MAX_CHARS", "4500"))
+VOICE_SETTINGS = {"stability": 0.5, "similarity_boost": 0.7}
+
+# الردود الطويلة تُقسَّم عند حدود الجمل وتُولَّد مقاطعها بالتوازي (كل مقطع رسالة صوتية)؛
+# المقطع الأول أقصر حتى يصل أول صوت بسرعة. ELEVEN_CHUNK_CHARS=0 يعطّل التقسيم.
+TTS_CHUNK_CHARS       = int(os.getenv("ELEVEN_CHUNK_CHARS", "400"))
+TTS_FIRST_CHUNK_CHARS = int(os.getenv("ELEVEN_FIRST_CHUNK_CHARS", "160"))
+TTS_PARALLEL          = int(os.getenv("ELEVEN_PARALLEL", "3"))        # مقاطع قيد التوليد لكل رد
+TTS_POOL_SIZE         = int(os.getenv("ELEVEN_POOL_SIZE", "16"))      # ثريدات التوليد المشتركة (المسار المتزامن)
+
+# وضع البث: الصوت يُقرأ من endpoint البث في ElevenLabs ويُمرَّر مباشرة لرفع المنصة
+# (multipart بترميز chunked)، فذاكرة كل رد صوتي محدودة بـ ELEVEN_STREAM_CHUNK بدل طول الملف.
+# المقاطع تُولَّد بالترتيب داخل الإرسال (بدون توازي ELEVEN_PARALLEL)، لذلك الوضع اختياري.
+TTS_STREAM_UPLOAD = os.getenv("ELEVEN_STREAM_UPLOAD", "0") == "1"
+TTS_STREAM_CHUNK  = int(os.getenv("ELEVEN_STREAM_CHUNK", str(16 * 1024)))
+
+# كاش الصوت: ذاكرة (LRU بميزانية بايتات) + قرص (حذف الأقدم عند تجاوز الحجم)
+TTS_CACHE_MEM_BYTES  = int(os.getenv("TTS_CACHE_MEM_BYTES", str(32 * 1024 * 1024)))
+TTS_CACHE_DIR        = os.getenv("TTS_CACHE_DIR", os.path.join("data", "tts_cache"))
+TTS_CACHE_DISK_BYTES = int(os.getenv("TTS_CACHE_DISK_BYTES", str(512 * 1024 * 1024)))
 
 def _clean_text(text: str, limit: int) -> str:
     t = (text or "").strip()
@@ -17,7 +58,232 @@ def _clean_text(text: str, limit: int) -> str:
         return t
     return t[: limit - 3] + "..."
 
-def synth_eleven(api_key: str, voice_id: str, text: str) -> bytes:
+class AudioCache:
+    """
+    كاش صوت بمفتاح = hash(voice_id, voice_settings, النص بعد التطبيع).
+      - الطبقة الأولى: ذاكرة LRU محدودة بعدد البايتات.
+      - الطبقة الثانية: ملفات على القرص (مشتركة بين الـ workers) مع حذف الأقدم استخدامًا.
+    """
+
+    def __init__(self, mem_budget: int = TTS_CACHE_MEM_BYTES, disk_dir: str = TTS_CACHE_DIR,
+                 disk_budget: int = TTS_CACHE_DISK_BYTES):
+        self.mem_budget = mem_budget
+        self.disk_dir = disk_dir
+        self.disk_budget = disk_budget
+        self._mem: "OrderedDict[str, bytes]" = OrderedDict()
+        self._mem_bytes = 0
+        self._disk_bytes: Optional[int] = None  # يُحسب عند أول استخدام
+        self._lock = threading.Lock()
+        self.hits_mem = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    @staticmethod
+    def key(voice_id: str, voice_settings: dict, text: str) -> str:
+        norm = " ".join(unicodedata.normalize("NFC", text or "").split())
+        raw = json.dumps([voice_id, voice_settings, norm], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], key + ".ogg")
+
+    # ---------- ذاكرة ----------
+    def _mem_put(self, key: str, data: bytes):
+        if len(data) > self.mem_budget:
+            return
+        with self._lock:
+            old = self._mem.pop(key, None)
+            if old is not None:
+                self._mem_bytes -= len(old)
+            self._mem[key] = data
+            self._mem_bytes += len(data)
+            while self._mem_bytes > self.mem_budget and self._mem:
+                _, evicted = self._mem.popitem(last=False)
+                self._mem_bytes -= len(evicted)
+
+    # ---------- قرص ----------
+    def _disk_get(self, key: str) -> Optional[bytes]:
+        if not self.disk_budget:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as fh:
+                data = fh.read()
+            os.utime(path)  # نحدّث وقت الاستخدام لترتيب الحذف
+            return data
+        except OSError:
+            return None
+
+    def _disk_put(self, key: str, data: bytes):
+        if not self.disk_budget or len(data) > self.disk_budget:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as fh:
+                fh.write(data)
+            os.replace(tmp, path)  # كتابة ذرّية حتى لا يقرأ worker آخر ملفًا ناقصًا
+        except OSError:
+            logging.exception("[tts-cache] disk write failed")
+            return
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self._scan_disk()[1]
+            else:
+                self._disk_bytes += len(data)
+            over = self._disk_bytes > self.disk_budget
+        if over:
+            self._evict_disk()
+
+    def _scan_disk(self):
+        files, total = [], 0
+        for root, _dirs, names in os.walk(self.disk_dir):
+            for name in names:
+                if not name.endswith(".ogg"):
+                    continue
+                p = os.path.join(root, name)
+                try:
+                    st = os.stat(p)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, p))
+                total += st.st_size
+        return files, total
+
+    def _evict_disk(self):
+        files, total = self._scan_disk()
+        files.sort()  # الأقدم استخدامًا أولًا
+        # ننزل إلى 90% من الميزانية حتى لا نعيد المسح مع كل كتابة
+        target = int(self.disk_budget * 0.9)
+        for _mtime, size, p in files:
+            if total <= target:
+                break
+            try:
+                os.remove(p)
+                total -= size
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_bytes = total
+
+    # ---------- واجهة ----------
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._mem.get(key)
+            if data is not None:
+                self._mem.move_to_end(key)
+                self.hits_mem += 1
+                self.bytes_saved += len(data)
+                return data
+        data = self._disk_get(key)
+        if data is not None:
+            self._mem_put(key, data)
+            with self._lock:
+                self.hits_disk += 1
+                self.bytes_saved += len(data)
+            return data
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, data: bytes):
+        if not data:
+            return
+        self._mem_put(key, data)
+        self._disk_put(key, data)
+
+    # ---------- بث (بدون تحميل الملف كاملًا) ----------
+    def open(self, key: str) -> Optional[BinaryIO]:
+        """ملف للقراءة التدريجية: من الذاكرة إن وُجد، وإلا من القرص (بدون نسخه للذاكرة)."""
+        with self._lock:
+            data = self._mem.get(key)
+            if data is not None:
+                self._mem.move_to_end(key)
+                self.hits_mem += 1
+                self.bytes_saved += len(data)
+                return io.BytesIO(data)
+        if self.disk_budget:
+            path = self._path(key)
+            try:
+                fh = open(path, "rb")
+                os.utime(path)
+                size = os.fstat(fh.fileno()).st_size
+            except OSError:
+                pass
+            else:
+                with self._lock:
+                    self.hits_disk += 1
+                    self.bytes_saved += size
+                return fh
+        with self._lock:
+            self.misses += 1
+        return None
+
+    @contextmanager
+    def writer(self, key: str):
+        """
+        يكتب الصوت على القرص أثناء بثه (ملف مؤقت ثم os.replace عند الاكتمال فقط)؛
+        البث المقطوع لا يترك ملفًا ناقصًا في الكاش.
+        """
+        if not self.disk_budget:
+            yield None
+            return
+        path = self._path(key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fh = open(tmp, "wb")
+        except OSError:
+            logging.exception("[tts-cache] disk write failed")
+            yield None
+            return
+        try:
+            with fh:
+                yield fh
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+        try:
+            size = os.path.getsize(tmp)
+            os.replace(tmp, path)
+        except OSError:
+            logging.exception("[tts-cache] disk write failed")
+            return
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self._scan_disk()[1]
+            else:
+                self._disk_bytes += size
+            over = self._disk_bytes > self.disk_budget
+        if over:
+            self._evict_disk()
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = self.hits_mem + self.hits_disk
+            total = hits + self.misses
+            return {
+                "hits_mem": self.hits_mem,
+                "hits_disk": self.hits_disk,
+                "misses": self.misses,
+                "hit_rate": round(hits / total, 3) if total else 0.0,
+                "bytes_saved": self.bytes_saved,
+                "mem_bytes": self._mem_bytes,
+                "mem_items": len(self._mem),
+                "disk_bytes": self._disk_bytes,
+            }
+
+
+audio_cache = AudioCache()
+
+
+def _eleven_request(api_key: str, voice_id: str, text: str):
+    """(url, headers, payload, cache_key) مشتركة بين النسختين المتزامنة و asyncio."""
     if not api_key or not voice_id:
         # نعيد مقطع ogg بسيط جدًا فارغ لتجنّب الكراش — أو بإمكانك ترجيع None و التعامل من caller
         # هنا بنرجّع رسالة نصية في TG بدل الصوت عندما يكون config ناقص (شوف tg_bot.py).
@@ -31,21 +297,443 @@ def synth_eleven(api_key: str, voice_id: str, text: str) -> bytes:
     }
     payload = {
         "text": _clean_text(text, MAX_TTS_CHARS),
-        "voice_settings": {"stability": 0.5, "similarity_boost": 0.7},
+        "voice_settings": VOICE_SETTINGS,
     }
+    # نفس الصوت + نفس النص = نفس الملف: لا داعي لطلب ElevenLabs مرة ثانية
+    cache_key = AudioCache.key(voice_id, VOICE_SETTINGS, payload["text"])
+    return url, headers, payload, cache_key
 
+
+def synth_eleven(api_key: str, voice_id: str, text: str, defer: bool = False) -> bytes:
+    """
+    داخل ثريدات services.workers (أو defer=True من synth_chunks) لا ننام بين المحاولات:
+    نرمي RetryLater كما في generate_reply، فيُعاد جدولة التوليد والثريد يخدم غيره.
+    في آخر محاولة (أو القاطع مفتوح) نرمي RuntimeError ويرسل المستدعي نصًا بدل الصوت.
+    خارج الـ pool الانتظار محدود بـ ELEVEN_MAX_INLINE_WAIT.
+    """
+    url, headers, payload, cache_key = _eleven_request(api_key, voice_id, text)
+    cached = audio_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    scheduled = current_attempt()  # None خارج ثريدات الـ pool
+    defer = defer or scheduled is not None
+    attempt = scheduled or 0
+    br = breaker("elevenlabs", api_key)
     last_err = None
-    for attempt in range(1, MAX_RETRIES + 1):
+    while True:
+        if not br.allow():
+            last_err = "circuit open"
+            break
+        retry_after = None
+        t0 = time.monotonic()
         try:
-            r = requests.post(url, json=payload, headers=headers, timeout=TIMEOUT_S)
+            with metrics.timer("eleven"):
+                r = http_client.post(url, json=payload, headers=headers, timeout=TIMEOUT_S)
             if r.status_code in (429, 500, 502, 503, 504):
+                br.record(False, time.monotonic() - t0)
                 last_err = f"{r.status_code} {r.text[:200]}"
-                time.sleep(BACKOFF_S * attempt)
-                continue
-            r.raise_for_status()
-            return r.content
+                retry_after = parse_retry_after(r.headers.get("Retry-After"))
+            else:
+                r.raise_for_status()
+                br.record(True, time.monotonic() - t0)
+                audio_cache.put(cache_key, r.content)
+                return r.content
         except requests.RequestException as e:
+            br.record(False, time.monotonic() - t0)
+            last_err = str(e)
+
+        if attempt >= MAX_RETRIES - 1 or final_attempt():
+            break
+        delay = backoff_delay(attempt, retry_after, base=BACKOFF_S)
+        if defer:
+            raise RetryLater(delay, f"elevenlabs {last_err}")
+        if delay > MAX_INLINE_WAIT_S:
+            last_err = f"{last_err} (retry in {delay:.1f}s skipped)"
+            break
+        time.sleep(delay)  # استدعاء متزامن خارج الـ pool
+        attempt += 1
+
+    raise RuntimeError(f"تعذّر توليد الصوت حاليًا. (تفاصيل: {last_err})")
+
+
+async def asynth_eleven(api_key: str, voice_id: str, text: str) -> bytes:
+    """
+    نسخة asyncio من synth_eleven على services.async_http. الانتظار بين المحاولات
+    لا يحجز ثريدًا، لكنه يبقى محدودًا بـ ELEVEN_MAX_ASYNC_WAIT حتى لا يتأخر الرد الصوتي كثيرًا.
+    """
+    url, headers, payload, cache_key = _eleven_request(api_key, voice_id, text)
+    cached = await asyncio.to_thread(audio_cache.get, cache_key)
+    if cached is not None:
+        return cached
+
+    br = breaker("elevenlabs", api_key)
+    last_err = None
+    for attempt in range(MAX_RETRIES):
+        if not br.allow():
+            last_err = "circuit open"
+            break
+        retry_after = None
+        t0 = time.monotonic()
+        try:
+            with metrics.timer("eleven"):
+                r = await async_http.post(url, json=payload, headers=headers, timeout=TIMEOUT_S)
+            if r.status_code in (429, 500, 502, 503, 504):
+                br.record(False, time.monotonic() - t0)
+                last_err = f"{r.status_code} {r.text[:200]}"
+                retry_after = parse_retry_after(r.headers.get("Retry-After"))
+            else:
+                r.raise_for_status()
+                br.record(True, time.monotonic() - t0)
+                await asyncio.to_thread(audio_cache.put, cache_key, r.content)
+                return r.content
+        except async_http.HTTP_ERRORS as e:
+            br.record(False, time.monotonic() - t0)
             last_err = str(e)
-            time.sleep(BACKOFF_S * attempt)
+
+        if attempt == MAX_RETRIES - 1:
+            break
+        delay = backoff_delay(attempt, retry_after, base=BACKOFF_S)
+        if delay > MAX_ASYNC_WAIT_S:
+            last_err = f"{last_err} (retry in {delay:.1f}s skipped)"
+            break
+        await asyncio.sleep(delay)
 
     raise RuntimeError(f"تعذّر توليد الصوت حاليًا. (تفاصيل: {last_err})")
+
+
+# --------------- التقسيم والتوليد المتوازي ---------------
+
+_SENTENCE_END = re.compile(r"(?<=[.!?؟۔…])\s+|\s*\n+\s*")
+
+
+def _hard_split(sentence: str, size: int) -> List[str]:
+    """جملة أطول من size تُقسَّم عند آخر مسافة قبل الحد."""
+    out = []
+    while len(sentence) > size:
+        cut = sentence.rfind(" ", 0, size)
+        if cut <= 0:
+            cut = size
+        out.append(sentence[:cut].strip())
+        sentence = sentence[cut:].strip()
+    if sentence:
+        out.append(sentence)
+    return out
+
+
+def split_sentences(text: str, first: int = TTS_FIRST_CHUNK_CHARS, size: int = TTS_CHUNK_CHARS) -> List[str]:
+    """
+    يقسم الرد إلى مقاطع عند حدود الجمل: الأول ≤ first والبقية ≤ size.
+    الرد الذي لا يتجاوز size يبقى مقطعًا واحدًا (رسالة صوتية واحدة كما كان).
+    """
+    t = _clean_text(text, MAX_TTS_CHARS)
+    if not size or len(t) <= size:
+        return [t] if t else []
+    sentences = []
+    for sent in _SENTENCE_END.split(t):
+        if sent.strip():
+            sentences.extend(_hard_split(sent.strip(), size))
+
+    chunks: List[str] = []
+    cur = ""
+    for sent in sentences:
+        limit = first if not chunks else size
+        if cur and len(cur) + 1 + len(sent) > limit:
+            chunks.append(cur)
+            cur = sent
+        else:
+            cur = f"{cur} {sent}" if cur else sent
+    if cur:
+        chunks.append(cur)
+    return chunks
+
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _pool() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=TTS_POOL_SIZE, thread_name_prefix="tts")
+    return _executor
+
+
+class _Clips:
+    """
+    مقاطع synth_chunks بالترتيب. close() يلغي المقاطع التي لم يبدأ توليدها حتى لو لم تبدأ
+    القراءة بعد (الرسالة ستُعاد بـ RetryLater قبل أول next)؛ ما بدأ فعلًا يكمل ويُحفظ في الكاش.
+    """
+
+    def __init__(self, submit: Callable[[str], Any], parts: List[str]):
+        self._submit = submit
+        self._todo = deque(parts)
+        self._pending = deque()
+        self._t0 = time.monotonic()
+        self._first = True
+        self._fill()
+
+    def _fill(self):
+        while self._todo and len(self._pending) < TTS_PARALLEL:
+            self._pending.append(self._submit(self._todo.popleft()))
+
+    def _took(self):
+        if self._first:
+            metrics.observe("stage_seconds", time.monotonic() - self._t0, stage="eleven_first_audio")
+            self._first = False
+
+    def __iter__(self) -> "_Clips":
+        return self
+
+    def __next__(self) -> bytes:
+        if not self._pending:
+            raise StopIteration
+        fut = self._pending.popleft()
+        self._fill()
+        try:
+            audio = fut.result()
+        except BaseException:
+            self.close()  # خطأ المقطع يُرمى للمستدعي، والبقية لا داعي لتوليدها
+            raise
+        self._took()
+        return audio
+
+    def close(self):
+        self._todo.clear()
+        while self._pending:
+            self._pending.popleft().cancel()
+
+
+class _AClips(_Clips):
+    """نسخة asyncio من _Clips: مهام في الـ loop الحالي، و aclose() تلغيها."""
+
+    def __aiter__(self) -> "_AClips":
+        return self
+
+    async def __anext__(self) -> bytes:
+        if not self._pending:
+            raise StopAsyncIteration
+        task = self._pending.popleft()
+        self._fill()
+        try:
+            audio = await task
+        except BaseException:
+            self.close()
+            raise
+        self._took()
+        return audio
+
+    async def aclose(self):
+        self.close()
+
+
+def synth_chunks(api_key: str, voice_id: str, parts: List[str]) -> _Clips:
+    """
+    يبدأ توليد أول TTS_PARALLEL مقاطع فورًا (قبل أول next) ويرجع الصوت بالترتيب:
+    المستدعي يرسل النص أو المقطع الأول بينما البقية قيد التوليد، ويستدعي close() في finally.
+    خطأ أي مقطع يُرمى عند الوصول إليه، والمقاطع السابقة تكون قد أُرسلت.
+    داخل services.workers مقطع يحتاج الانتظار يُرمى كـ RetryLater (بدل النوم في ثريد التوليد)،
+    والمستدعي يؤجل بقية المقاطع إلى outbox.
+    """
+    defer = current_attempt() is not None
+    # copy_context: تسميات metrics (platform/bot) تنتقل لثريد التوليد
+    return _Clips(lambda part: _pool().submit(copy_context().run, synth_eleven, api_key, voice_id, part, defer),
+                  parts)
+
+
+def asynth_chunks(api_key: str, voice_id: str, parts: List[str]) -> _AClips:
+    """نسخة asyncio من synth_chunks (مهام في الـ loop الحالي بدل الثريدات)؛ المستدعي يستدعي aclose()."""
+    return _AClips(lambda part: asyncio.ensure_future(asynth_eleven(api_key, voice_id, part)), parts)
+
+
+# --------------- البث ---------------
+
+class _FileStream:
+    """مقاطع ملف من الكاش؛ close() يغلق الملف حتى لو لم تبدأ القراءة."""
+
+    def __init__(self, fh: BinaryIO):
+        self._fh = fh
+
+    def __iter__(self) -> Iterator[bytes]:
+        with self._fh:
+            while True:
+                chunk = self._fh.read(TTS_STREAM_CHUNK)
+                if not chunk:
+                    return
+                yield chunk
+
+    def close(self):
+        self._fh.close()
+
+
+class _Tee:
+    """
+    مقاطع بث ElevenLabs مع نسخة على القرص (تُعتمد في الكاش عند اكتمال البث فقط).
+    close() — يستدعيها المستدعي في finally — تغلق الرد فورًا حتى لو فشل الرفع قبل بدء
+    القراءة أو في منتصفها. لا نكمل تنزيل الباقي هنا: ذلك يحجز ثريد outbox طوال مدة
+    التوليد، وإعادة الإرسال تطلب البث من جديد (أو تقرأ الكاش إن اكتمل بث آخر لنفس النص).
+    """
+
+    def __init__(self, r: requests.Response, cache_key: str):
+        self._r = r
+        self._chunks = r.iter_content(TTS_STREAM_CHUNK)
+        self._writer = audio_cache.writer(cache_key)
+        self._out = None
+        self._opened = False
+        self._complete = False
+        self._closed = False
+
+    def _open(self):
+        if not self._opened:
+            self._opened = True
+            self._out = self._writer.__enter__()
+
+    def __iter__(self) -> Iterator[bytes]:
+        self._open()
+        for chunk in self._chunks:
+            if not chunk:
+                continue
+            if self._out is not None:
+                self._out.write(chunk)
+            yield chunk
+        self._complete = True
+        self.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if self._opened:
+                if self._complete:
+                    self._writer.__exit__(None, None, None)
+                else:
+                    # البث الناقص لا يدخل الكاش (writer يحذف الملف المؤقت)
+                    err = RuntimeError("incomplete stream")
+                    self._writer.__exit__(RuntimeError, err, None)
+        finally:
+            self._r.close()
+
+
+def stream_eleven(api_key: str, voice_id: str, text: str) -> Iterator[bytes]:
+    """
+    صوت OGG كمقاطع بايتات من endpoint البث في ElevenLabs، بدون تجميع الملف في الذاكرة.
+    الطلب يبدأ عند الاستدعاء وأخطاؤه تُرمى هنا (قبل أن يفتح المستدعي الرفع)، فيمكنه
+    الرجوع للنص. نسخة تُكتب على القرص أثناء البث، فالطلبات التالية لنفس النص تقرأ من الكاش
+    (البث المقطوع لا يُحفظ).
+    المستدعي يغلق الناتج بـ close() في finally (انظر _Tee).
+    """
+    url, headers, payload, cache_key = _eleven_request(api_key, voice_id, text)
+    cached = audio_cache.open(cache_key)
+    if cached is not None:
+        return _FileStream(cached)
+
+    # محاولة واحدة: outbox يعيد الإرسال كاملًا عند الأخطاء المؤقتة
+    br = breaker("elevenlabs", api_key)
+    if not br.allow():
+        raise RuntimeError("تعذّر توليد الصوت حاليًا. (تفاصيل: circuit open)")
+    t0 = time.monotonic()
+    try:
+        with metrics.timer("eleven"):
+            r = http_client.post(f"{url}/stream", json=payload, headers=headers, timeout=TIMEOUT_S, stream=True)
+    except requests.RequestException as e:
+        br.record(False, time.monotonic() - t0)
+        raise RuntimeError(f"تعذّر توليد الصوت حاليًا. (تفاصيل: {e})")
+    if r.status_code >= 400:
+        br.record(False, time.monotonic() - t0)  # مثل synth_eleven: كل 4xx/5xx فشل (مفتاح خاطئ يفتح الدائرة)
+        detail = f"{r.status_code} {r.text[:200]}"
+        r.close()
+        raise RuntimeError(f"تعذّر توليد الصوت حاليًا. (تفاصيل: {detail})")
+    br.record(True, time.monotonic() - t0)
+    return _Tee(r, cache_key)
+
+
+class _AFileStream:
+    """نسخة asyncio من _FileStream: القراءة والإغلاق في ثريد (asyncio.to_thread) حتى لا يُحجز الـ loop."""
+
+    def __init__(self, fh: BinaryIO):
+        self._fh = fh
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        while True:
+            chunk = await asyncio.to_thread(self._fh.read, TTS_STREAM_CHUNK)
+            if not chunk:
+                break
+            yield chunk
+        await self.aclose()
+
+    async def aclose(self):
+        if not self._fh.closed:
+            await asyncio.to_thread(self._fh.close)
+
+
+class _ATee:
+    """نسخة asyncio من _Tee (httpx): aclose() في finally عند المستدعي. الكتابة على القرص في ثريد."""
+
+    def __init__(self, r, cache_key: str):
+        self._r = r
+        self._chunks = r.aiter_bytes(TTS_STREAM_CHUNK)
+        self._writer = audio_cache.writer(cache_key)
+        self._out = None
+        self._opened = False
+        self._complete = False
+        self._closed = False
+
+    async def _open(self):
+        if not self._opened:
+            self._opened = True
+            self._out = await asyncio.to_thread(self._writer.__enter__)
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        await self._open()
+        async for chunk in self._chunks:
+            if self._out is not None:
+                await asyncio.to_thread(self._out.write, chunk)
+            yield chunk
+        self._complete = True
+        await self.aclose()
+
+    async def aclose(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if self._opened:
+                if self._complete:
+                    await asyncio.to_thread(self._writer.__exit__, None, None, None)
+                else:
+                    err = RuntimeError("incomplete stream")
+                    await asyncio.to_thread(self._writer.__exit__, RuntimeError, err, None)
+        finally:
+            await self._r.aclose()
+
+
+async def astream_eleven(api_key: str, voice_id: str, text: str) -> AsyncIterator[bytes]:
+    """نسخة asyncio من stream_eleven (httpx): المستدعي يغلق الناتج بـ aclose() في finally."""
+    url, headers, payload, cache_key = _eleven_request(api_key, voice_id, text)
+    cached = await asyncio.to_thread(audio_cache.open, cache_key)
+    if cached is not None:
+        return _AFileStream(cached)
+
+    br = breaker("elevenlabs", api_key)
+    if not br.allow():
+        raise RuntimeError("تعذّر توليد الصوت حاليًا. (تفاصيل: circuit open)")
+    t0 = time.monotonic()
+    client = async_http.client()
+    try:
+        with metrics.timer("eleven"):
+            req = client.build_request("POST", f"{url}/stream", json=payload, headers=headers, timeout=TIMEOUT_S)
+            r = await client.send(req, stream=True)
+    except async_http.HTTP_ERRORS as e:
+        br.record(False, time.monotonic() - t0)
+        raise RuntimeError(f"تعذّر توليد الصوت حاليًا. (تفاصيل: {e})")
+    if r.status_code >= 400:
+        br.record(False, time.monotonic() - t0)  # مثل synth_eleven: كل 4xx/5xx فشل (مفتاح خاطئ يفتح الدائرة)
+        await r.aread()
+        detail = f"{r.status_code} {r.text[:200]}"
+        await r.aclose()
+        raise RuntimeError(f"تعذّر توليد الصوت حاليًا. (تفاصيل: {detail})")
+    br.record(True, time.monotonic() - t0)
+    return _ATee(r, cache_key)
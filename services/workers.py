@@ -0,0 +1,242 @@
+# services/workers.py
+# -*- coding: utf-8 -*-
+import os
+import time
+import queue
+import logging
+import heapq
+import threading
+import itertools
+from collections import deque
+from typing import Callable, Dict, Hashable, Optional
+
+from services.resilience import RetryLater
+from services import metrics
+
+WEBHOOK_WORKERS   = int(os.getenv("WEBHOOK_WORKERS", "8"))
+WEBHOOK_QUEUE_MAX = int(os.getenv("WEBHOOK_QUEUE_MAX", "1000"))
+TASK_MAX_ATTEMPTS = int(os.getenv("TASK_MAX_ATTEMPTS", "6"))
+# أقصى مدة لإعادة جدولة مهمة منذ أول تشغيل لها، حتى للانتظار الذي لا يُحسب محاولة
+# (429 مع Retry-After متكرر): بعدها تُشغَّل مرة أخيرة (final_attempt) ثم تُترك
+TASK_MAX_DEFER_S  = float(os.getenv("TASK_MAX_DEFER", "120"))
+
+_local = threading.local()
+
+
+def current_attempt() -> Optional[int]:
+    """رقم المحاولة للمهمة الجارية (0 = الأولى)، أو None خارج ثريدات الـ pool."""
+    return getattr(_local, "attempt", None)
+
+
+def final_attempt() -> bool:
+    """
+    True في آخر تشغيل مسموح للمهمة الجارية (آخر محاولة أو انتهت TASK_MAX_DEFER):
+    RetryLater بعدها يُسقط المهمة، فالمستدعي يرجع الرد الاحتياطي بدل رميها.
+    """
+    return getattr(_local, "final", False)
+
+
+class WorkerPool:
+    """
+    طابور أحداث + مجموعة ثريدات خلفية تفرّغه:
+      - مسار الويبهوك يضع الحدث في الطابور ويرجع 200 فورًا.
+      - الثريدات تنفّذ المعالجة الثقيلة (OpenAI / ElevenLabs / الإرسال).
+    الثريدات تُشغَّل عند أول submit (وبعد fork في gunicorn) وليس عند الاستيراد.
+
+    تنفيذ حسب المفتاح (actor لكل محادثة): المهام بنفس key (مثل (bot_id, chat_id))
+    تُنفّذ واحدة تلو الأخرى بالترتيب، والمفاتيح المختلفة تتوزع على الثريدات بالتوازي.
+
+    إعادة المحاولة المجدولة: مهمة ترمي RetryLater(delay) تعود لرأس طابور مفتاحها،
+    ويُوقف المفتاح delay ثانية (بدون إشغال أي ثريد) ثم يُعاد جدولته.
+    الإعادة محدودة بـ TASK_MAX_ATTEMPTS محاولة وبـ TASK_MAX_DEFER ثانية منذ أول تشغيل.
+    """
+
+    def __init__(self, size: int = WEBHOOK_WORKERS, maxsize: int = WEBHOOK_QUEUE_MAX, name: str = "webhook"):
+        self.size = max(1, size)
+        self.name = name
+        self.maxsize = max(0, maxsize)
+        self._ready: "queue.Queue" = queue.Queue()      # مفاتيح جاهزة للتنفيذ (كل مفتاح مرة واحدة)
+        self._pending: Dict[Hashable, deque] = {}        # key -> مهام تنتظر (الموجود هنا مجدول أو قيد التنفيذ)
+        self._depth = 0                                   # مجموع المهام المنتظرة
+        self._anon = itertools.count()
+        self._lock = threading.Lock()
+        self._timers: list = []                           # heap: (due, seq, key) مفاتيح موقوفة مؤقتًا
+        self._timers_cond = threading.Condition(self._lock)
+        self._idle_cond = threading.Condition(self._lock)  # join: لا مهام منتظرة ولا جارية
+        self._threads = []
+        self._pid = None
+        self._busy = 0
+        self._busy_time = 0.0
+        self._started_at = time.monotonic()
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.retries = 0
+
+    # --------------- تشغيل ---------------
+
+    def _ensure_started(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            # بعد fork الثريدات القديمة غير موجودة في هذه العملية
+            self._threads = []
+            self._busy = 0
+            self._busy_time = 0.0
+            self._started_at = time.monotonic()
+            for i in range(self.size):
+                t = threading.Thread(target=self._run, name=f"{self.name}-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+            self._timers = []
+            threading.Thread(target=self._run_timers, name=f"{self.name}-timers", daemon=True).start()
+            self._pid = pid
+            logging.info("[%s] started %d workers (pid=%s)", self.name, self.size, pid)
+
+    def submit(self, fn: Callable, *args, key: Optional[Hashable] = None, **kwargs) -> bool:
+        """
+        يضيف مهمة للطابور بدون انتظار. يرجع False إذا الطابور ممتلئ.
+        key=None: مهمة مستقلة بلا ترتيب مع غيرها.
+        """
+        self._ensure_started()
+        if key is None:
+            key = ("_anon", next(self._anon))
+        with self._lock:
+            if self.maxsize and self._depth >= self.maxsize:
+                self.rejected += 1
+                logging.warning("[%s] queue full, rejecting task", self.name)
+                return False
+            q = self._pending.get(key)
+            schedule = q is None
+            if schedule:
+                q = self._pending[key] = deque()
+            q.append((fn, args, kwargs, 0, None))
+            self._depth += 1
+            self.submitted += 1
+        if schedule:
+            self._ready.put(key)
+        return True
+
+    def _run(self):
+        while True:
+            key = self._ready.get()
+            with self._lock:
+                task = self._pending[key].popleft()
+                self._depth -= 1
+                self._busy += 1
+            fn, args, kwargs, attempt, started = task
+            t0 = time.monotonic()
+            if started is None:
+                started = t0
+            expired = t0 - started >= TASK_MAX_DEFER_S
+            ok, retry = True, None
+            _local.attempt = attempt
+            _local.final = expired or attempt + 1 >= TASK_MAX_ATTEMPTS
+            try:
+                fn(*args, **kwargs)
+            except RetryLater as e:
+                if not expired and (not e.count_attempt or attempt + 1 < TASK_MAX_ATTEMPTS):
+                    retry = e
+                    metrics.inc("task_retries_total", pool=self.name)
+                else:
+                    ok = False
+                    logging.error("[%s] task gave up after %d attempts in %.0fs (key=%s): %s",
+                                  self.name, attempt + 1, t0 - started, key, e)
+            except Exception:
+                ok = False
+                logging.exception("[%s] task failed (key=%s)", self.name, key)
+            finally:
+                _local.attempt = None
+                _local.final = False
+                metrics.reset()  # تسميات platform/bot لا تنتقل للمهمة التالية
+                with self._lock:
+                    self._busy -= 1
+                    self._busy_time += time.monotonic() - t0
+                    if retry is not None:
+                        # نفس المهمة تعود لرأس طابور المحادثة ويبقى المفتاح موقوفًا حتى موعدها
+                        next_attempt = attempt + 1 if retry.count_attempt else attempt
+                        self._pending[key].appendleft((fn, args, kwargs, next_attempt, started))
+                        self._depth += 1
+                        self.retries += 1
+                        heapq.heappush(self._timers, (time.monotonic() + retry.delay, next(self._anon), key))
+                        self._timers_cond.notify()
+                        more = False
+                    else:
+                        self.processed += 1
+                        if not ok:
+                            self.failed += 1
+                        # المهمة التالية لنفس المفتاح تعود لآخر الطابور (عدالة بين المحادثات)
+                        more = bool(self._pending[key])
+                        if not more:
+                            del self._pending[key]
+                    if not self._depth and not self._busy:
+                        self._idle_cond.notify_all()
+                if more:
+                    self._ready.put(key)
+
+    def _run_timers(self):
+        """يعيد جدولة المفاتيح الموقوفة عند حلول موعدها."""
+        while True:
+            with self._lock:
+                while not self._timers or self._timers[0][0] > time.monotonic():
+                    wait = self._timers[0][0] - time.monotonic() if self._timers else None
+                    self._timers_cond.wait(wait)
+                _due, _seq, key = heapq.heappop(self._timers)
+            self._ready.put(key)
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """
+        ينتظر حتى تُنفَّذ كل المهام (بما فيها المؤجلة بـ RetryLater) أو تنقضي timeout.
+        لإيقاف العملية بدون إسقاط ما قُبل. يرجع False إن بقيت مهام.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            if self._pid != os.getpid():
+                return True  # لم يبدأ في هذه العملية
+            while self._depth or self._busy:
+                left = None if deadline is None else deadline - time.monotonic()
+                if left is not None and left <= 0:
+                    logging.warning("[%s] join timed out with %d queued and %d running tasks",
+                                    self.name, self._depth, self._busy)
+                    return False
+                self._idle_cond.wait(left)
+            return True
+
+    # --------------- إحصائيات ---------------
+
+    def queue_lengths(self, top: int = 20) -> Dict[str, int]:
+        """أطول طوابير المفاتيح (المنتظرة فقط، بدون المهمة قيد التنفيذ)."""
+        with self._lock:
+            items = [(k, len(q)) for k, q in self._pending.items() if len(q)]
+        items.sort(key=lambda kv: kv[1], reverse=True)
+        return {str(k): n for k, n in items[:top]}
+
+    def stats(self) -> dict:
+        with self._lock:
+            elapsed = max(1e-6, time.monotonic() - self._started_at)
+            lengths = [len(q) for q in self._pending.values()]
+            return {
+                "workers": self.size,
+                "alive": sum(1 for t in self._threads if t.is_alive()),
+                "busy": self._busy,
+                "utilization": round(self._busy / self.size, 3),
+                "avg_utilization": round(min(1.0, self._busy_time / (elapsed * self.size)), 3),
+                "queue_depth": self._depth,
+                "queue_max": self.maxsize,
+                "active_keys": len(self._pending),
+                "max_key_depth": max(lengths) if lengths else 0,
+                "submitted": self.submitted,
+                "processed": self.processed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "retries": self.retries,
+                "parked_keys": len(self._timers),
+            }
+
+
+# مجموعة مشتركة لكل الويبهوكس داخل العملية
+pool = WorkerPool()
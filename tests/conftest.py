@@ -0,0 +1,10 @@
+# tests/conftest.py
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+
+# قواعد SQLite والكاش الافتراضية (تُقرأ عند الاستيراد) في مجلد مؤقت بدل data/
+_tmp = tempfile.mkdtemp(prefix="piaaz-tests-")
+for _name, _file in (("BOTS_DB_PATH", "bots.db"), ("HISTORY_DB_PATH", "history.db"),
+                     ("DEDUP_DB_PATH", "dedup.db"), ("TTS_CACHE_DIR", "tts_cache")):
+    os.environ.setdefault(_name, os.path.join(_tmp, _file))
@@ -0,0 +1,64 @@
+# tests/test_asgi.py
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import threading
+
+import asgi
+import app as app_module
+from services.aio import runner
+
+
+class _AsyncBot:
+    def __init__(self):
+        self.handled = []
+
+    async def aprocess_update(self, payload):
+        await asyncio.sleep(0)
+        self.handled.append((payload["update_id"], threading.get_ident()))
+
+
+async def _request(path: str, body: bytes):
+    sent = []
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "POST", "path": path, "headers": [(b"content-type", b"application/json")]}
+    await asgi.app(scope, receive, send)
+    return sent[0]["status"], json.loads(sent[1]["body"])
+
+
+def test_telegram_webhook_is_handled_on_the_event_loop(monkeypatch):
+    bot = _AsyncBot()
+    monkeypatch.setattr(app_module.manager, "get_bot", lambda bot_id: bot)
+    monkeypatch.setattr(asgi.http_client, "prewarm", lambda: None)
+    monkeypatch.setattr(runner, "loop", None)
+
+    async def run():
+        lifespan = asyncio.Queue()
+        for kind in ("startup", "shutdown"):
+            lifespan.put_nowait({"type": f"lifespan.{kind}"})
+        replies = []
+
+        async def receive():
+            if len(replies) == 1:  # الطلب يُرسل بعد اكتمال الإقلاع
+                replies.append(await _request("/webhooks/telegram/b-asgi", json.dumps(
+                    {"update_id": 901, "message": {"chat": {"id": 5}, "text": "مرحبا"}}).encode()))
+            return await lifespan.get()
+
+        async def send(message):
+            replies.append(message)
+
+        await asgi.app({"type": "lifespan"}, receive, send)
+        return replies, threading.get_ident()
+
+    replies, loop_thread = asyncio.run(run())
+
+    assert replies[1] == (200, {"ok": True})
+    assert replies[-1] == {"type": "lifespan.shutdown.complete"}
+    assert bot.handled == [(901, loop_thread)]  # أكمله الإيقاف قبل الخروج، داخل الـ loop
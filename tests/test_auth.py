@@ -0,0 +1,85 @@
+# tests/test_auth.py
+# -*- coding: utf-8 -*-
+import json
+import time
+
+import jwt
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from services import auth
+
+
+class _FakeJWKS:
+    """بديل PyJWKClient: مجموعة مفاتيح ثابتة ويعدّ مرات إعادة الجلب."""
+    match_kid = staticmethod(jwt.PyJWKClient.match_kid)
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.refreshes = 0
+
+    def get_signing_keys(self, refresh=False):
+        if refresh:
+            self.refreshes += 1
+        return self.keys
+
+
+@pytest.fixture
+def rsa_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+@pytest.fixture
+def jwks(monkeypatch, rsa_key):
+    jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(rsa_key.public_key()))
+    fake = _FakeJWKS([jwt.PyJWK({**jwk, "kid": "k1", "use": "sig"}, algorithm="RS256")])
+    monkeypatch.setattr(auth, "_jwks", lambda: fake)
+    monkeypatch.setattr(auth, "_jwks_refreshed", float("-inf"))
+    return fake
+
+
+def _token(key, kid):
+    claims = {"sub": "u1", "aud": auth.SUPABASE_JWT_AUD, "exp": int(time.time()) + 60}
+    return jwt.encode(claims, key, algorithm="RS256", headers={"kid": kid})
+
+
+def test_known_kid_uses_cached_keys(jwks, rsa_key):
+    assert auth._decode_local(_token(rsa_key, "k1"))["sub"] == "u1"
+    assert jwks.refreshes == 0
+
+
+def test_unknown_kid_refreshes_jwks_at_most_once_per_interval(jwks, rsa_key, monkeypatch):
+    for _ in range(5):
+        assert auth._decode_local(_token(rsa_key, "forged")) is None
+    assert jwks.refreshes == 1
+
+    monkeypatch.setattr(auth, "JWKS_REFRESH_MIN_S", 0)
+    assert auth._decode_local(_token(rsa_key, "forged")) is None
+    assert jwks.refreshes == 2
+
+
+def test_verify_token_is_local_and_cached(monkeypatch):
+    monkeypatch.setattr(auth, "SUPABASE_JWT_SECRET", "s" * 32)
+    monkeypatch.setattr(auth, "_cache", auth.TokenCache())
+    monkeypatch.setattr(auth.http_client, "get", lambda *a, **kw: pytest.fail("HTTP round-trip"))
+    decodes = []
+    decode = auth._decode_local
+    monkeypatch.setattr(auth, "_decode_local", lambda token: decodes.append(token) or decode(token))
+    token = jwt.encode({"sub": "u1", "aud": auth.SUPABASE_JWT_AUD, "exp": int(time.time()) + 60},
+                       "s" * 32, algorithm="HS256")
+
+    assert auth.verify_token(token)["sub"] == "u1"
+    assert auth.verify_token(token)["sub"] == "u1"
+    assert len(decodes) == 1
+    assert auth.verify_token(token + "x") is None
+
+
+def test_token_cache_honours_exp_and_size():
+    cache = auth.TokenCache(maxsize=2, ttl=300)
+    cache.put("expired", {"exp": time.time() - 1})
+    assert cache.get("expired") is None
+
+    for t in ("a", "b", "c"):
+        cache.put(t, {"exp": time.time() + 60})
+    assert cache.get("a") is None  # الأقدم خرج عند تجاوز الحد
+    assert cache.get("c") is not None
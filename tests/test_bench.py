@@ -0,0 +1,59 @@
+# tests/test_bench.py
+# -*- coding: utf-8 -*-
+import pytest
+
+import app as app_module
+from bench import fakes
+from bench.loadgen import Payloads, percentile
+from services import http_client, nlp
+
+
+@pytest.fixture
+def openai_fake(monkeypatch):
+    srv = fakes.FakeServer("openai").start()
+    monkeypatch.setattr(nlp, "OPENAI_BASE", srv.base_url + "/v1/chat/completions")
+    yield srv
+    srv.stop()
+
+
+def test_latency_specs():
+    assert fakes.Latency("fixed:0.2").sample() == 0.2
+    assert 0.1 <= fakes.Latency("uniform:0.1:0.3").sample() <= 0.3
+    assert fakes.Latency("0").sample() == 0.0
+    with pytest.raises(ValueError):
+        fakes.Latency("gauss:1")
+
+
+def test_fake_openai_serves_plain_and_streamed_replies(openai_fake):
+    assert nlp.generate_reply("sk-bench-plain", "sys", [], "مرحبا") == fakes.FAKE_REPLY
+    assert "".join(nlp.generate_reply_stream("sk-bench-stream", "sys", [], "مرحبا")) == fakes.FAKE_REPLY
+    assert openai_fake.counts["chat"] == 2
+
+
+def test_fake_errors_look_like_the_provider():
+    srv = fakes.FakeServer("telegram", error_rate=1.0).start()
+    try:
+        r = http_client.post(f"{srv.base_url}/bot1:x/sendMessage", json={"chat_id": 1, "text": "hi"})
+    finally:
+        srv.stop()
+    body = r.json()
+    assert r.status_code in (429, 500) and body["ok"] is False and body["error_code"] == r.status_code
+    assert srv.counts["sendMessage:error"] == 1
+
+
+def test_generated_webhooks_are_unique_and_routable():
+    payloads = Payloads(users=5, seed=1)
+    a, b = payloads.telegram("bot"), payloads.telegram("bot")
+    assert a["update_id"] != b["update_id"]
+    assert app_module._tg_update_type(a) == "message"
+
+    tasks = []
+    assert app_module._enqueue_whatsapp(payloads.whatsapp("555"),
+                                        submit=lambda fn, value, key=None: tasks.append(key) or True,
+                                        route=lambda value: None)
+    assert len(tasks) == 1 and tasks[0][:2] == ("wa", "555")
+
+
+def test_percentile():
+    vals = sorted(float(i) for i in range(1, 101))
+    assert (percentile(vals, 50), percentile(vals, 99), percentile([], 95)) == (51.0, 99.0, 0.0)
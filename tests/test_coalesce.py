@@ -0,0 +1,84 @@
+# tests/test_coalesce.py
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+from services.coalesce import Coalescer
+
+
+class _Submit:
+    """بديل pool.submit: ينفّذ flush فورًا ويسجّل، ويمكنه رفض أول n مرات (طابور ممتلئ)."""
+
+    def __init__(self, reject: int = 0):
+        self.reject = reject
+        self.flushed = []
+        self.done = threading.Event()
+
+    def __call__(self, fn, text, key=None):
+        if self.reject:
+            self.reject -= 1
+            return False
+        fn(text)
+        return True
+
+    def flush(self, text):
+        self.flushed.append(text)
+        self.done.set()
+
+
+def test_burst_including_first_message_is_one_call():
+    c = Coalescer(window=0.15, max_wait=2, idle_window=0.1)
+    sub = _Submit()
+    for text in ("مرحبا", "عندي سؤال", "عن الأسعار"):
+        c.add("k", text, sub.flush, submit=sub)
+        time.sleep(0.03)
+    assert sub.done.wait(2)
+    time.sleep(0.2)
+    assert sub.flushed == ["مرحبا\nعندي سؤال\nعن الأسعار"]
+    assert c.stats()["llm_calls"] == 1
+    assert c.stats()["merged_away"] == 2
+
+
+def test_idle_message_waits_only_the_idle_window():
+    c = Coalescer(window=1.0, max_wait=5, idle_window=0.05)
+    sub = _Submit()
+    t0 = time.monotonic()
+    c.add("k", "سؤال", sub.flush, submit=sub)
+    assert sub.done.wait(2)
+    assert time.monotonic() - t0 < 0.5
+    assert sub.flushed == ["سؤال"]
+
+
+def test_rejected_flush_is_retried_in_order():
+    c = Coalescer(window=0.05, max_wait=1, idle_window=0.02)
+    sub = _Submit(reject=1)
+    c.add("k", "أولى", sub.flush, submit=sub)
+    time.sleep(0.04)  # الدفعة الأولى رُفضت وأُعيدت للمخزن
+    c.add("k", "ثانية", sub.flush, submit=sub)
+    assert sub.done.wait(3)
+    assert sub.flushed == ["أولى\nثانية"]
+    assert c.stats()["requeued"] == 1
+
+
+def test_idle_message_is_submitted_without_waiting():
+    """idle_window=0 (الافتراضي): لا شيء معلّق للمحادثة فتُرسل الرسالة في نفس الاستدعاء."""
+    c = Coalescer(window=1.0, max_wait=5, idle_window=0)
+    sub = _Submit()
+    c.add("k", "سؤال", sub.flush, submit=sub)
+    assert sub.flushed == ["سؤال"]
+
+    # ما يصل خلال النافذة بعدها يُدمج في دفعة تالية
+    c.add("k", "وسؤال آخر", sub.flush, submit=sub)
+    assert c.stats()["pending_conversations"] == 1
+
+
+def test_flush_all_sends_pending_batches_on_shutdown():
+    c = Coalescer(window=10, max_wait=30, idle_window=10)
+    sub = _Submit(reject=1)
+    c.add("a", "أولى", sub.flush, submit=sub)
+    c.add("b", "ثانية", sub.flush, submit=sub)
+
+    # الطابور رفض الأولى: تُنفَّذ في ثريد المستدعي بدل إسقاطها
+    assert c.flush_all() == 2
+    assert sorted(sub.flushed) == ["أولى", "ثانية"]
+    assert c.stats()["pending_conversations"] == 0
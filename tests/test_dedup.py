@@ -0,0 +1,44 @@
+# tests/test_dedup.py
+# -*- coding: utf-8 -*-
+from services.dedup import DedupStore
+
+
+def test_claim_survives_restart(tmp_path):
+    path = str(tmp_path / "dedup.db")
+    store = DedupStore(ttl=60, db_path=path)
+    assert store.first_seen("tg:1:100", "telegram")
+    assert store.claim(["tg:1:100"], "telegram") == {"tg:1:100"}
+    assert not store.first_seen("tg:1:100", "telegram")
+
+    # عملية جديدة (بعد إعادة تشغيل أو worker آخر): الذاكرة فارغة والـ SQLite يتذكر
+    restarted = DedupStore(ttl=60, db_path=path)
+    assert restarted.first_seen("tg:1:100", "telegram")  # مسار الـ ack لا يلمس القرص
+    assert restarted.claim(["tg:1:100", "tg:1:101"], "telegram") == {"tg:1:101"}
+    assert restarted.stats()["duplicates"] == {"telegram": 1}
+
+
+def test_forget_allows_redelivery_across_restart(tmp_path):
+    path = str(tmp_path / "dedup.db")
+    store = DedupStore(ttl=60, db_path=path)
+    assert store.first_seen("wa:abc") and store.claim(["wa:abc"])
+    store.forget("wa:abc")
+
+    restarted = DedupStore(ttl=60, db_path=path)
+    assert restarted.claim(["wa:abc"]) == {"wa:abc"}
+    assert store.first_seen("wa:abc")
+    assert store.claim(["wa:abc"]) == set()
+
+
+def test_expired_key_is_fresh_again(tmp_path):
+    path = str(tmp_path / "dedup.db")
+    assert DedupStore(ttl=-1, db_path=path).claim(["ig:1"]) == {"ig:1"}
+    assert DedupStore(ttl=60, db_path=path).claim(["ig:1"]) == {"ig:1"}
+
+
+def test_claim_fails_open_and_counts(tmp_path):
+    store = DedupStore(ttl=60, db_path=str(tmp_path / "dedup.db"))
+    store.claim(["x"])
+    store._db.execute("DROP TABLE seen")
+
+    assert store.claim(["a", "b"], "whatsapp") == {"a", "b"}
+    assert store.stats()["fail_open"] == 2
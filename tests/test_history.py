@@ -0,0 +1,75 @@
+# tests/test_history.py
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+from services.history import HistoryStore
+
+
+def _msgs(*texts):
+    return [{"role": "user", "content": t} for t in texts]
+
+
+def test_workers_see_each_others_writes(tmp_path):
+    db = str(tmp_path / "h.db")
+    a, b = HistoryStore(db_path=db), HistoryStore(db_path=db)
+
+    a.set("bot", 1, _msgs("أ"))
+    assert b.get("bot", 1) == _msgs("أ")
+
+    b.set("bot", 1, _msgs("أ", "ب"))
+    assert a.get("bot", 1) == _msgs("أ", "ب")  # نسخة a في الذاكرة قديمة فتُعاد قراءتها
+
+    a.drop_bot("bot")
+    assert b.get("bot", 1) == []
+
+
+def test_other_conversations_writes_keep_the_memory_copy(tmp_path):
+    db = str(tmp_path / "h.db")
+    a, b = HistoryStore(db_path=db), HistoryStore(db_path=db)
+    a.set("bot", 1, _msgs("أ"))
+
+    b.set("bot", 2, _msgs("ب"))  # عامل آخر يكتب محادثة أخرى
+    assert a.get("bot", 1) == _msgs("أ")
+    assert a.reloaded == 0
+
+
+def test_idle_conversations_are_evicted_without_a_new_set(tmp_path):
+    store = HistoryStore(idle_s=0.05, db_path=str(tmp_path / "h.db"))
+    store.set("bot", 1, _msgs("مرحبا"))
+    assert store.stats()["conversations"] == 1
+
+    time.sleep(0.1)
+    assert store.stats()["conversations"] == 0
+    assert store.get("bot", 1) == _msgs("مرحبا")  # تُقرأ من SQLite
+
+
+def test_evicted_conversation_reads_through(tmp_path):
+    store = HistoryStore(mem_budget=0, db_path=str(tmp_path / "h.db"))
+    store.set("bot", 1, _msgs("مرحبا"))
+
+    assert store.stats()["conversations"] == 0
+    assert store.get("bot", 1) == _msgs("مرحبا")
+    assert store.spilled >= 1 and store.reloaded == 1
+
+
+def test_sqlite_io_runs_outside_the_memory_lock(tmp_path):
+    store = HistoryStore(db_path=str(tmp_path / "h.db"))
+    free = []
+    write = store._write
+
+    def probe():
+        if store._lock.acquire(timeout=1):
+            store._lock.release()
+            free.append(True)
+
+    def checked(key, hist):
+        t = threading.Thread(target=probe)  # ثريد آخر يصل إلى الذاكرة أثناء الكتابة
+        t.start()
+        t.join()
+        write(key, hist)
+
+    store._write = checked
+    store.set("bot", 1, _msgs("hi"))
+
+    assert free == [True]
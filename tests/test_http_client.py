@@ -0,0 +1,72 @@
+# tests/test_http_client.py
+# -*- coding: utf-8 -*-
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from services import http_client
+
+
+class _KeepAlive(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _KeepAlive)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+
+
+def test_session_is_shared_per_process_and_renewed_after_fork(monkeypatch):
+    s = http_client.session()
+    assert http_client.session() is s
+
+    monkeypatch.setattr(http_client.os, "getpid", lambda: -1)  # عملية جديدة بعد fork
+    assert http_client.session() is not s
+
+
+def test_per_host_timeouts(monkeypatch):
+    seen = []
+    monkeypatch.setattr(http_client.session(), "request", lambda method, url, **kw: seen.append(kw["timeout"]))
+
+    http_client.post("https://api.openai.com/v1/chat/completions")
+    http_client.get("https://example.com/")
+    http_client.get("https://api.telegram.org/x", timeout=3)
+
+    assert seen == [http_client.HOST_TIMEOUTS["api.openai.com"], http_client.DEFAULT_TIMEOUT, 3]
+
+
+def test_host_map_skips_bad_entries():
+    assert http_client._parse_host_map("a.com=5, b.com=x,junk", float) == {"a.com": 5.0}
+
+
+def test_connections_are_reused(server, monkeypatch):
+    monkeypatch.setattr(http_client, "_session", None)  # إحصائيات نظيفة
+    for _ in range(3):
+        assert http_client.get(server).text == "ok"
+
+    row = http_client.stats()["http://127.0.0.1"]
+    assert (row["requests"], row["misses"], row["hits"]) == (3, 1, 2)
+
+
+def test_multipart_stream_does_not_buffer_the_file():
+    ctype, body = http_client.multipart_stream({"chat_id": "7"}, "voice", "v.ogg", "audio/ogg", iter([b"ab", b"cd"]))
+    boundary = ctype.split("boundary=", 1)[1]
+    parts = list(body)
+
+    assert parts[1:3] == [b"ab", b"cd"]  # المقاطع تمر كما هي
+    data = b"".join(parts)
+    assert b'name="chat_id"\r\n\r\n7\r\n' in data
+    assert data.endswith(f"\r\n--{boundary}--\r\n".encode())
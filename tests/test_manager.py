@@ -0,0 +1,202 @@
+# tests/test_manager.py
+# -*- coding: utf-8 -*-
+import threading
+
+import pytest
+
+from bots import manager as manager_mod
+from bots.manager import BotManager
+from bots.registry import BotRegistry
+
+
+class _Resp:
+    status_code = 200
+    ok = True
+    headers = {"content-type": "application/json"}
+    text = '{"ok":true}'
+
+    def json(self):
+        return {"ok": True, "result": True}
+
+
+@pytest.fixture
+def posts(monkeypatch):
+    calls = []
+
+    def fake_post(url, **kwargs):
+        calls.append(url)
+        return _Resp()
+
+    monkeypatch.setattr(manager_mod.http_client, "post", fake_post)
+    return calls
+
+
+def _tg_meta(bot_id, token):
+    return {"id": bot_id, "platform": "telegram", "creds": {"openai": "sk-x", "tgToken": token}}
+
+
+def test_delete_unbuilt_telegram_bot_removes_webhook(tmp_path, posts):
+    registry = BotRegistry(str(tmp_path / "bots.db"), creds_key="")
+    registry.put("b1", _tg_meta("b1", "123:old"))
+
+    # worker جديد (بعد إعادة تشغيل): البوت في السجل لكن كائنه لم يُبنَ
+    mgr = BotManager(registry)
+    assert "b1" not in mgr.bots_obj
+    mgr.delete("b1")
+
+    assert posts == [f"{manager_mod.TELEGRAM_API_BASE}/bot123:old/deleteWebhook"]
+    assert registry.get("b1") is None
+
+
+def test_token_change_removes_old_webhook_without_built_bot(tmp_path, posts):
+    registry = BotRegistry(str(tmp_path / "bots.db"), creds_key="")
+    registry.put("b1", _tg_meta("b1", "123:old"))
+    mgr = BotManager(registry)
+
+    mgr.update("b1", {"creds": {"tgToken": "123:new"}})
+
+    base = manager_mod.TELEGRAM_API_BASE
+    assert posts == [f"{base}/bot123:old/deleteWebhook", f"{base}/bot123:new/setWebhook"]
+
+
+def test_bulk_activate_reports_per_bot_webhook_failure(tmp_path, monkeypatch):
+    def fake_post(url, **kwargs):
+        resp = _Resp()
+        if "bad" in url:
+            resp.json = lambda: {"ok": False}
+        return resp
+
+    monkeypatch.setattr(manager_mod.http_client, "post", fake_post)
+    mgr = BotManager(BotRegistry(str(tmp_path / "bots.db"), creds_key=""))
+
+    results = mgr.create_many([_tg_meta("b1", "1:good"), _tg_meta("b2", "2:bad"), _tg_meta("b3", "3:good")],
+                              wait=True)
+
+    assert [(r["id"], r["ok"], r["webhook_ok"]) for r in results] == [
+        ("b1", True, True), ("b2", True, False), ("b3", True, True)]
+    assert set(mgr.bots_meta) == {"b1", "b2", "b3"}
+    assert {b["id"]: b["webhook_ok"] for b in mgr.list()}["b2"] is False
+
+
+def test_bulk_registry_failure_changes_nothing(tmp_path, posts, monkeypatch):
+    registry = BotRegistry(str(tmp_path / "bots.db"), creds_key="")
+    registry.put("b1", _tg_meta("b1", "1:old"))
+    mgr = BotManager(registry)
+
+    def locked(items):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(registry, "write_many", locked)
+    with pytest.raises(manager_mod.RegistryUnavailable):
+        mgr.create_many([_tg_meta("b1", "1:new"), _tg_meta("b2", "2:new")], wait=True)
+    with pytest.raises(manager_mod.RegistryUnavailable):
+        mgr.delete_many(["b1"], wait=True)
+
+    assert set(mgr.bots_meta) == {"b1"}
+    assert mgr.bots_meta["b1"]["creds"]["tgToken"] == "1:old"
+    assert posts == []
+
+
+def test_bulk_rejects_duplicate_ids(tmp_path, posts):
+    mgr = BotManager(BotRegistry(str(tmp_path / "bots.db"), creds_key=""))
+    seen = set()
+    assert mgr.validate(_tg_meta("b1", "1:a"), seen) is None
+    assert mgr.validate(_tg_meta("b1", "1:b"), seen) == "duplicate id"
+
+    with pytest.raises(ValueError):
+        mgr.create_many([_tg_meta("b1", "1:a"), _tg_meta("b1", "1:b")])
+    assert posts == []
+
+
+class _FakeBot:
+    def __init__(self):
+        self.events = []
+
+    def handle_webhook(self, value):
+        self.events.append(value)
+
+
+def _wa_meta(bot_id, phone_id):
+    return {"id": bot_id, "platform": "whatsapp", "creds": {"openai": "sk-x", "waToken": "t", "waPhoneId": phone_id}}
+
+
+def _ig_meta(bot_id, user_id, page_id):
+    return {"id": bot_id, "platform": "instagram",
+            "creds": {"openai": "sk-x", "igAccess": "t", "igUserId": user_id, "igPageId": page_id}}
+
+
+@pytest.fixture
+def routed(tmp_path):
+    """مدير فيه بوتا واتساب وبوت انستجرام، وكائنات وهمية تسجّل ما وصلها."""
+    registry = BotRegistry(str(tmp_path / "bots.db"), creds_key="")
+    for meta in (_wa_meta("w1", "555"), _wa_meta("w2", "666"), _ig_meta("i1", "ig-user", "ig-page")):
+        registry.put(meta["id"], meta)
+    mgr = BotManager(registry)
+    fakes = {bot_id: _FakeBot() for bot_id in ("w1", "w2", "i1")}
+    mgr.bots_obj.update(fakes)
+    return mgr, fakes
+
+
+def test_whatsapp_routes_by_phone_number_id_only(routed):
+    mgr, fakes = routed
+    mgr.route_whatsapp({"metadata": {"phone_number_id": "666"}, "messages": [{"id": "m1"}]})
+    mgr.route_whatsapp({"metadata": {"phone_number_id": "999"}, "messages": [{"id": "m2"}]})
+
+    assert [len(fakes[b].events) for b in ("w1", "w2")] == [0, 1]
+    assert mgr.unroutable["whatsapp"] == 1
+
+
+def test_instagram_routes_by_recipient_or_entry_id(routed):
+    mgr, fakes = routed
+    value = {"messaging": [{"recipient": {"id": "ig-page"}, "message": {"mid": "a"}},
+                           {"recipient": {}, "message": {"mid": "b"}},
+                           {"recipient": {"id": "other"}, "message": {"mid": "c"}}]}
+    mgr.route_instagram(value, entry_id="ig-user")
+
+    [delivered] = fakes["i1"].events
+    assert [ev["message"]["mid"] for ev in delivered["messaging"]] == ["a", "b"]
+    assert mgr.unroutable["instagram"] == 1
+
+
+def test_index_follows_phone_id_change(routed):
+    mgr, fakes = routed
+    mgr._apply_change("w1", _wa_meta("w1", "777"))
+    mgr.bots_obj["w1"] = fakes["w1"]
+
+    assert mgr._snapshot.wa.get("555") is None
+    assert mgr._resolve_whatsapp({"metadata": {"phone_number_id": "777"}}) is fakes["w1"]
+
+
+def _in_thread(fn, timeout=2.0):
+    """يشغّل fn في ثريد ويرجع هل انتهى خلال timeout."""
+    t = threading.Thread(target=fn, daemon=True)
+    t.start()
+    t.join(timeout)
+    return not t.is_alive()
+
+
+def test_routing_does_not_wait_for_held_locks(routed):
+    mgr, fakes = routed
+    bot_lock = mgr._bot_lock("w1")
+    with mgr._lock, bot_lock:  # تحديث/إنشاء جارٍ في ثريد آخر
+        assert _in_thread(lambda: mgr.route_whatsapp({"metadata": {"phone_number_id": "555"}}))
+    assert len(fakes["w1"].events) == 1
+
+
+def test_webhook_registration_runs_outside_the_locks(tmp_path, monkeypatch):
+    mgr = BotManager(BotRegistry(str(tmp_path / "bots.db"), creds_key=""))
+    free = []
+
+    def grab():
+        for lock in (mgr._lock, mgr._bot_lock("b1")):
+            with lock:
+                pass
+
+    def slow_post(url, **kwargs):
+        free.append(_in_thread(grab))  # أثناء طلب الشبكة: الأقفال متاحة لبقية الثريدات
+        return _Resp()
+
+    monkeypatch.setattr(manager_mod.http_client, "post", slow_post)
+    mgr.create(_tg_meta("b1", "1:a"))
+
+    assert free and all(free)
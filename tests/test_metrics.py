@@ -0,0 +1,37 @@
+# tests/test_metrics.py
+# -*- coding: utf-8 -*-
+import threading
+
+import app as app_module
+from services import metrics
+
+
+def test_render_merges_thread_shards():
+    def work():
+        metrics.inc("webhooks_received_total", platform="test")
+        metrics.observe("stage_seconds", 0.2, stage="test")
+
+    threads = [threading.Thread(target=work) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    text = metrics.render()
+    prefix = metrics.METRICS_PREFIX
+    assert f"# TYPE {prefix}webhooks_received_total counter" in text
+    assert f'{prefix}webhooks_received_total{{platform="test"}} 3' in text
+    assert f'{prefix}stage_seconds_bucket{{stage="test",le="0.25"}} 3' in text
+    assert f'{prefix}stage_seconds_count{{stage="test"}} 3' in text
+
+
+def test_metrics_route_is_disabled_without_token(monkeypatch):
+    client = app_module.app.test_client()
+    monkeypatch.setattr(app_module, "METRICS_TOKEN", "")
+    assert client.get("/metrics").status_code == 404
+
+    monkeypatch.setattr(app_module, "METRICS_TOKEN", "s3cret")
+    assert client.get("/metrics").status_code == 401
+    assert client.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code == 401
+    resp = client.get("/metrics", headers={"Authorization": "Bearer s3cret"})
+    assert resp.status_code == 200 and resp.mimetype == "text/plain"
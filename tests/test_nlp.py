@@ -0,0 +1,87 @@
+# tests/test_nlp.py
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+import requests
+
+from services import nlp
+
+
+class _StreamResp:
+    status_code = 200
+    headers = {}
+
+    def __init__(self, deltas, done=True, cut=False):
+        self.lines = [b"data: " + json.dumps({"choices": [{"delta": {"content": d}}]}).encode() for d in deltas]
+        if done:
+            self.lines.append(b"data: [DONE]")
+        self.cut = cut
+
+    def iter_lines(self, decode_unicode=False):
+        yield from self.lines
+        if self.cut:
+            raise requests.exceptions.ChunkedEncodingError("connection reset")
+
+    def close(self):
+        pass
+
+
+def _stream(monkeypatch, resp):
+    monkeypatch.setattr(nlp, "_post_openai", lambda *a, **kw: resp)
+    return nlp.generate_reply_stream(f"sk-{id(resp)}", "sys", [], "سؤال")
+
+
+def test_stream_yields_complete_reply(monkeypatch):
+    assert "".join(_stream(monkeypatch, _StreamResp(["مرحبا", " بك"]))) == "مرحبا بك"
+
+
+def test_stream_cut_after_first_chunk_raises(monkeypatch):
+    got = []
+    with pytest.raises(nlp.StreamInterrupted):
+        for delta in _stream(monkeypatch, _StreamResp(["نصف", " الرد"], done=False, cut=True)):
+            got.append(delta)
+    assert got == ["نصف", " الرد"]
+
+
+def test_stream_without_done_is_incomplete(monkeypatch):
+    with pytest.raises(nlp.StreamInterrupted):
+        list(_stream(monkeypatch, _StreamResp(["نصف"], done=False)))
+
+
+def _turns(n):
+    hist = []
+    for i in range(n):
+        hist += [{"role": "user", "content": f"سؤال رقم {i} " * 5},
+                 {"role": "assistant", "content": f"جواب رقم {i} " * 5}]
+    return hist
+
+
+def test_context_keeps_newest_messages_within_budget():
+    hist = _turns(20)
+    base = nlp.count_tokens("sys") + nlp.count_tokens("جديد") + 2 * nlp.MSG_OVERHEAD_TOKENS
+    budget = base + sum(nlp._msg_tokens(m) for m in hist[-4:])
+
+    messages, used, n = nlp.build_context("sys", hist, "جديد", budget=budget)
+
+    assert n == 4 and used <= budget
+    assert messages[0] == {"role": "system", "content": "sys"}
+    assert messages[1:-1] == [{"role": m["role"], "content": m["content"]} for m in hist[-4:]]
+    assert messages[-1] == {"role": "user", "content": "جديد"}
+    assert all("tokens" in m for m in hist[-4:])  # العدّ مخزّن مع الرسالة
+
+
+def test_context_never_starts_with_an_orphan_reply():
+    hist = _turns(3)
+    budget = (nlp.count_tokens("sys") + nlp.count_tokens("جديد") + 2 * nlp.MSG_OVERHEAD_TOKENS
+              + sum(nlp._msg_tokens(m) for m in hist[-3:]))
+
+    messages, used, n = nlp.build_context("sys", hist, "جديد", budget=budget)
+
+    assert n == 2 and messages[1]["role"] == "user"
+    assert used == budget - nlp._msg_tokens(hist[-3])
+
+
+def test_context_too_small_still_sends_the_question():
+    messages, _used, n = nlp.build_context("sys", _turns(5), "جديد", budget=1)
+    assert n == 0 and [m["role"] for m in messages] == ["system", "user"]
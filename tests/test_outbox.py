@@ -0,0 +1,162 @@
+# tests/test_outbox.py
+# -*- coding: utf-8 -*-
+import asyncio
+import threading
+import time
+
+import pytest
+import requests
+
+from bots.wa_bot import WhatsAppCloudBot
+from bots import wa_bot
+from services import outbox as outbox_mod, workers
+from services.outbox import Outbox
+from services.resilience import RetryLater
+from services.workers import WorkerPool
+
+
+def _in_pool(fn):
+    """ينفّذ fn داخل services.workers (محاولة واحدة) ويرجع الاستثناء الذي رماه أو None."""
+    pool = WorkerPool(size=1, maxsize=0, name="test")
+    result = {}
+    done = threading.Event()
+
+    def task():
+        try:
+            fn()
+        except Exception as e:
+            result["error"] = e
+            raise
+        finally:
+            done.set()
+
+    pool.submit(task, key="k")
+    assert done.wait(5)
+    return result.get("error")
+
+
+@pytest.fixture
+def full(monkeypatch):
+    """outbox طابوره ممتلئ دائمًا، وإعادة الرسالة بعيدة حتى لا تتكرر أثناء الاختبار."""
+    ob = Outbox(workers=1, maxsize=0)
+    monkeypatch.setattr(ob._pool, "submit", lambda *a, **kw: False)
+    monkeypatch.setattr(outbox_mod, "OUTBOX_FULL_RETRY_S", 60.0)
+    return ob
+
+
+def test_full_outbox_in_pool_retries_the_message(full):
+    sent = []
+    err = _in_pool(lambda: full.send_or_retry("whatsapp", "phone", "user", sent.append, "hi"))
+
+    assert isinstance(err, RetryLater) and not err.count_attempt
+    assert sent == []
+    assert full.counters["whatsapp"]["rejected"] == 1
+    assert full.counters["whatsapp"]["failed"] == 0
+
+
+def test_full_outbox_outside_pool_sends_inline(full):
+    sent = []
+    assert full.send_or_retry("whatsapp", "phone", "user", sent.append, "hi")
+    assert full.send_or_inline("whatsapp", "phone", "user", sent.append, "more")
+
+    assert sent == ["hi", "more"]
+    row = full.counters["whatsapp"]
+    assert (row["rejected"], row["inline"], row["sent"]) == (2, 2, 2)
+
+
+def test_transient_failure_on_last_attempt_counts_failed(monkeypatch):
+    monkeypatch.setattr(workers, "TASK_MAX_ATTEMPTS", 1)
+    ob = Outbox(workers=1, maxsize=0)
+
+    def down(text):
+        raise requests.ConnectionError("down")
+
+    assert ob.send("telegram", "bot", 1, down, "hi")
+    deadline = time.monotonic() + 5
+    while ob.counters["telegram"]["failed"] == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    row = ob.counters["telegram"]
+    assert (row["failed"], row["retried"], row["sent"]) == (1, 0, 0)
+
+
+def test_rejected_reply_is_not_remembered(full, monkeypatch):
+    monkeypatch.setattr(wa_bot, "outbox", full)
+    monkeypatch.setattr(wa_bot, "generate_reply", lambda *a: "نعمل من التاسعة حتى الخامسة.")
+    bot = WhatsAppCloudBot("wa-test-outbox", "token", "phone", "sk-x", {"reply_mode": "text", "reply_cache": True})
+
+    err = _in_pool(lambda: bot._reply("966500000000", "متى تفتحون؟"))
+
+    assert isinstance(err, RetryLater)
+    assert bot.history.get("966500000000", []) == []
+    assert bot.reply_cache.lookup(bot.profile, [], "متى تفتحون؟")[1] is None
+
+
+def _asend(result, sent):
+    async def asend(platform, key, recipient, fn, *args, **kwargs):
+        sent.append(args)
+        return result
+    return asend
+
+
+def test_async_reply_is_remembered_only_after_delivery(monkeypatch):
+    sent = []
+    monkeypatch.setattr(wa_bot.outbox, "asend", _asend(False, sent))
+
+    async def reply(*a):
+        return "نعمل من التاسعة حتى الخامسة."
+
+    monkeypatch.setattr(wa_bot, "agenerate_reply", reply)
+    bot = WhatsAppCloudBot("wa-test-async-fail", "token", "phone", "sk-x", {"reply_mode": "text", "reply_cache": True})
+
+    asyncio.run(bot._areply("966500000009", "متى تفتحون؟"))
+
+    assert sent  # حاولنا الإرسال وفشل نهائيًا
+    assert bot.history.get("966500000009", []) == []
+    assert bot.reply_cache.lookup(bot.profile, [], "متى تفتحون؟")[1] is None
+
+
+def test_async_fallback_is_not_cached_and_history_is_off_loop(monkeypatch):
+    from bots import tg_bot
+    from services import nlp
+
+    monkeypatch.setattr(tg_bot.outbox, "asend", _asend(True, []))
+
+    async def down(*a):
+        return nlp.FALLBACK_UNAVAILABLE
+
+    monkeypatch.setattr(tg_bot, "agenerate_reply", down)
+    bot = tg_bot.TelegramClientBot("tg-test-async-fallback", "123:abc", "sk-x", {"reply_cache": True})
+    threads = []
+    get = bot.history._backend.get
+    monkeypatch.setattr(bot.history._backend, "get", lambda *a: threads.append(threading.get_ident()) or get(*a))
+
+    async def run():
+        await bot._ahandle_message(77, 1, "سارة", "text", "كم السعر")
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(run())
+
+    assert threads == [threads[0]] and loop_thread not in threads  # قراءة واحدة، في ثريد
+    assert bot.history.get(77, []) == []
+    assert bot.reply_cache.lookup(bot.profile, [], "كم السعر")[1] is None
+
+
+def test_rejected_text_in_both_mode_closes_voice_clips(full, monkeypatch):
+    closed = []
+
+    class _Clips:
+        def close(self):
+            closed.append(True)
+
+    monkeypatch.setattr(wa_bot, "outbox", full)
+    monkeypatch.setattr(wa_bot, "TTS_STREAM_UPLOAD", False)
+    monkeypatch.setattr(wa_bot, "synth_chunks", lambda *a: _Clips())
+    monkeypatch.setattr(wa_bot, "generate_reply", lambda *a: "نعمل من التاسعة حتى الخامسة.")
+    bot = WhatsAppCloudBot("wa-test-both", "token", "phone", "sk-x",
+                           {"reply_mode": "both", "voice": {"ek": "ek", "vid": "vid"}})
+
+    err = _in_pool(lambda: bot._reply("966500000000", "متى تفتحون؟"))
+
+    assert isinstance(err, RetryLater)
+    assert closed == [True]  # مقاطع الصوت لا تبقى تُولَّد لرسالة ستُعاد
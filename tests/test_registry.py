@@ -0,0 +1,39 @@
+# tests/test_registry.py
+# -*- coding: utf-8 -*-
+from bots.registry import BotRegistry
+
+
+def _meta(bot_id, **kw):
+    return {"id": bot_id, "platform": "telegram", "creds": {"token": "t-" + bot_id}, **kw}
+
+
+def test_changes_replay_between_instances(tmp_path):
+    """كل instance بمثابة worker مستقل على نفس الملف."""
+    path = str(tmp_path / "bots.db")
+    a = BotRegistry(path, creds_key="")
+    b = BotRegistry(path, creds_key="")
+    seen = b.last_seq()
+    version = b.data_version()
+
+    a.put("b1", _meta("b1"))
+    a.write_many([("b2", _meta("b2")), ("b3", _meta("b3"))])
+    a.delete("b1")
+
+    assert b.data_version() != version
+    rows, oldest = b.changes_since(seen)
+    assert [(bot_id, op) for _seq, bot_id, op in rows] == [
+        ("b1", "put"), ("b2", "put"), ("b3", "put"), ("b1", "delete"),
+    ]
+    assert [seq for seq, _b, _o in rows] == sorted(seq for seq, _b, _o in rows)
+    assert oldest <= rows[0][0]
+    assert b.get("b1") is None
+    assert b.get("b2")["creds"] == {"token": "t-b2"}
+    assert set(b.load_all()) == {"b2", "b3"}
+
+    # b متزامن الآن: لا تغييرات جديدة، والكتابة من b نفسها تظهر لـ a
+    last = rows[-1][0]
+    assert b.changes_since(last)[0] == []
+    b.put("b3", _meta("b3", active=False))
+    rows, _ = a.changes_since(last)
+    assert [(bot_id, op) for _seq, bot_id, op in rows] == [("b3", "put")]
+    assert a.get("b3")["active"] is False
@@ -0,0 +1,53 @@
+# tests/test_reply_cache.py
+# -*- coding: utf-8 -*-
+from bots import wa_bot
+from bots.wa_bot import WhatsAppCloudBot
+from services import nlp
+from services.reply_cache import ReplyCache, normalize_ar
+
+PROFILE = {"reply_cache": True, "company": {"name": "مطعم"}}
+
+
+def test_arabic_spelling_variants_normalize_together():
+    assert normalize_ar("كم السّعر؟") == normalize_ar("كم  السعر")
+    assert normalize_ar("أين الفرع") == normalize_ar("اين الفرع!")
+    assert normalize_ar("الساعة ٩") == normalize_ar("الساعه 9")
+
+
+def test_only_first_message_of_enabled_bots_is_cached():
+    cache = ReplyCache()
+    assert cache.lookup({**PROFILE, "reply_cache": False}, [], "كم السعر") == (None, None)
+    assert cache.lookup(PROFILE, [{"role": "user", "content": "مرحبا"}], "كم السعر") == (None, None)
+    assert cache.lookup(PROFILE, [], "طويل " * 100) == (None, None)
+
+    key, reply = cache.lookup(PROFILE, [], "كم السعر")
+    assert key and reply is None
+    cache.store(key, "عشرة ريالات")
+    assert cache.lookup(PROFILE, [], "كم السّعر؟")[1] == "عشرة ريالات"
+    assert cache.lookup({**PROFILE, "company": {"name": "مقهى"}}, [], "كم السعر")[1] is None
+
+
+def test_fallbacks_and_expired_replies_are_not_served():
+    cache = ReplyCache(ttl=0)
+    key, _ = cache.lookup(PROFILE, [], "كم السعر")
+    cache.store(key, "عشرة ريالات")
+    assert cache.lookup(PROFILE, [], "كم السعر")[1] is None  # انتهت صلاحيته
+
+    cache = ReplyCache()
+    cache.store(key, nlp.FALLBACK_UNAVAILABLE)
+    assert cache.lookup(PROFILE, [], "كم السعر")[1] is None
+
+
+def test_repeated_question_skips_the_llm_and_profile_update_clears(monkeypatch):
+    calls, sent = [], []
+    monkeypatch.setattr(wa_bot, "generate_reply", lambda *a: calls.append(a) or "من التاسعة حتى الخامسة.")
+    bot = WhatsAppCloudBot("wa-test-reply-cache", "token", "phone", "sk-x", dict(PROFILE, reply_mode="text"))
+    monkeypatch.setattr(bot, "send_text", lambda to, text, **kw: sent.append(text) or True)
+
+    bot._reply("966500000001", "متى تفتحون؟")
+    bot._reply("966500000002", "متى تفتحون")
+    assert len(calls) == 1 and sent == ["من التاسعة حتى الخامسة."] * 2
+
+    bot.update_profile(dict(PROFILE, reply_mode="text", company={"name": "مطعم", "city": "جدة"}))
+    bot._reply("966500000003", "متى تفتحون")
+    assert len(calls) == 2
@@ -0,0 +1,55 @@
+# tests/test_resilience.py
+# -*- coding: utf-8 -*-
+from services import resilience
+from services.resilience import CircuitBreaker, backoff_delay, parse_retry_after
+
+
+def _open_breaker(monkeypatch, cool_down: float) -> CircuitBreaker:
+    monkeypatch.setattr(resilience, "BREAKER_MIN_CALLS", 4)
+    monkeypatch.setattr(resilience, "BREAKER_OPEN_S", cool_down)
+    br = CircuitBreaker("test")
+    for _ in range(4):
+        assert br.allow()
+        br.record(False, 0.1)
+    assert br.state == CircuitBreaker.OPEN
+    return br
+
+
+def test_breaker_opens_on_error_rate_and_rejects(monkeypatch):
+    br = _open_breaker(monkeypatch, cool_down=60)
+    assert not br.allow()
+    assert br.snapshot()["rejected"] == 1
+
+
+def test_half_open_allows_one_probe_and_closes_on_success(monkeypatch):
+    br = _open_breaker(monkeypatch, cool_down=0)
+    assert br.allow()          # probe
+    assert br.state == CircuitBreaker.HALF_OPEN
+    assert not br.allow()      # طلب ثانٍ أثناء التجربة
+    br.record(True, 0.1)
+    assert br.state == CircuitBreaker.CLOSED
+    assert br.allow()
+
+
+def test_failed_probe_reopens(monkeypatch):
+    br = _open_breaker(monkeypatch, cool_down=0)
+    assert br.allow()
+    br.record(False, 0.1)
+    assert br.state == CircuitBreaker.OPEN
+    assert [t["to"] for t in br.snapshot()["transitions"]] == ["open", "half_open", "open"]
+
+
+def test_slow_calls_open_the_breaker(monkeypatch):
+    monkeypatch.setattr(resilience, "BREAKER_MIN_CALLS", 4)
+    br = CircuitBreaker("slow", slow_call_s=1.0)
+    for _ in range(4):
+        br.record(True, 2.0)
+    assert br.state == CircuitBreaker.OPEN
+
+
+def test_backoff_respects_retry_after():
+    assert parse_retry_after("7") == 7.0
+    assert parse_retry_after("soon") is None
+    for attempt in range(5):
+        assert backoff_delay(attempt, retry_after=5, base=0.1, cap=30) >= 5
+        assert backoff_delay(attempt, base=0.1, cap=0.2) <= 0.2
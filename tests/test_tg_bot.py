@@ -0,0 +1,122 @@
+# tests/test_tg_bot.py
+# -*- coding: utf-8 -*-
+from types import SimpleNamespace
+
+import pytest
+
+from bots import tg_bot
+from bots.tg_bot import TelegramClientBot, STREAM_CUT_NOTICE
+from services import nlp
+
+
+class _FakeTeleBot:
+    def __init__(self):
+        self.sent, self.edits = [], []
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(text)
+        return SimpleNamespace(message_id=len(self.sent))
+
+    def edit_message_text(self, text, chat_id, msg_id, **kwargs):
+        self.edits.append(text)
+
+
+@pytest.fixture
+def bot(monkeypatch):
+    # outbox ينفّذ الإرسال فورًا في نفس الثريد
+    monkeypatch.setattr(tg_bot.outbox, "send", lambda platform, key, rcpt, fn, *a, **kw: fn(*a, **kw) or True)
+    b = TelegramClientBot("tg-test-stream", "123:abc", "sk-x", {"reply_mode": "text", "reply_cache": True})
+    b.tg = _FakeTeleBot()
+    return b
+
+
+def test_interrupted_stream_is_not_remembered(bot, monkeypatch):
+    def cut_stream(*args):
+        yield "هذا جواب طويل بما يكفي لإرسال الرسالة الأولى"
+        raise nlp.StreamInterrupted("cut")
+
+    monkeypatch.setattr(tg_bot, "generate_reply_stream", cut_stream)
+    bot._handle_message(42, 1, "سارة", "text", "ما هي ساعات العمل؟")
+
+    final = (bot.tg.edits or bot.tg.sent)[-1]
+    assert final.endswith(STREAM_CUT_NOTICE)
+    assert bot.history.get(42, []) == []
+    assert bot.reply_cache.lookup(bot.profile, [], "ما هي ساعات العمل؟")[1] is None
+
+
+def test_complete_stream_is_remembered(bot, monkeypatch):
+    monkeypatch.setattr(tg_bot, "generate_reply_stream", lambda *a: (d for d in ["نعمل من التاسعة حتى الخامسة مساءً."]))
+    bot._handle_message(43, 1, "سارة", "text", "متى تفتحون؟")
+
+    assert [m["role"] for m in bot.history.get(43, [])] == ["user", "assistant"]
+
+
+def test_intermediate_edit_never_lands_after_final(bot, monkeypatch):
+    """تعديل وسيط تأخر في outbox (حدود المعدل) يُتخطى إذا وُضع التعديل النهائي بعده."""
+    held = []
+
+    def send(platform, key, rcpt, fn, *a, **kw):
+        if fn.__name__ == "_stream_edit":
+            held.append((fn, a))
+            return True
+        return fn(*a, **kw) or True
+
+    monkeypatch.setattr(tg_bot.outbox, "send", send)
+    monkeypatch.setattr(tg_bot, "STREAM_EDIT_INTERVAL", 0)
+    monkeypatch.setattr(tg_bot, "generate_reply_stream",
+                        lambda *a: (d for d in ["جواب طويل بما يكفي للرسالة الأولى", " ثم تتمة", " ونهاية."]))
+
+    reply, complete = bot._stream_reply(44, "sys", [], "سؤال")
+    assert complete and len(held) == 1  # تعديل واحد معلّق على الأكثر
+    for fn, a in held:
+        fn(*a)
+
+    assert bot.tg.edits == [reply]
+
+
+def test_shared_session_is_set_once_per_worker(monkeypatch):
+    marker = object()
+    monkeypatch.setattr(tg_bot.apihelper, "session", marker)
+    TelegramClientBot("tg-test-session", "123:abc", "sk-x", {})
+    assert tg_bot.apihelper.session is marker  # البناء لا يغيّر متغيرًا على مستوى العملية
+
+    tg_bot.use_shared_session()
+    assert tg_bot.apihelper.session is tg_bot.http_client.session()
+
+
+def _update(text=None, **msg):
+    msg.setdefault("message_id", 11)
+    msg.setdefault("chat", {"id": 42})
+    msg.setdefault("from", {"first_name": " سارة "})
+    if text is not None:
+        msg["text"] = text
+    return {"update_id": 1, "message": msg}
+
+
+def test_incoming_reads_the_raw_update():
+    incoming = TelegramClientBot._incoming
+    assert incoming(_update("مرحبا")) == (42, 11, "سارة", "text", "مرحبا", "")
+    assert incoming(_update("/start@PiaazBot hi"))[5] == "/start"
+    assert incoming(_update("/price"))[5] == ""  # أمر لا نعالجه = رسالة عادية
+    assert incoming(_update(voice={"file_id": "v"}))[3] == "voice"
+    assert incoming(_update(sticker={"file_id": "s"})) is None
+    assert incoming({"update_id": 2, "edited_message": {"text": "x"}}) is None
+
+
+def test_start_command_sends_welcome_without_the_llm(bot, monkeypatch):
+    monkeypatch.setattr(tg_bot, "generate_reply", lambda *a: pytest.fail("LLM called for /start"))
+    bot.profile["company"] = {"name": "بياز"}
+    bot.process_update(_update("/start"))
+    assert bot.tg.sent == [tg_bot.WELCOME.format(name="سارة", company="بياز")]
+
+
+def test_handler_error_is_logged_with_traceback(bot, monkeypatch, caplog):
+    def broken(company):
+        raise KeyError("company")
+
+    monkeypatch.setattr(tg_bot, "build_system_prompt", broken)
+    bot.process_update(_update("مرحبا"))
+
+    [record] = [r for r in caplog.records if "handle_message error" in r.getMessage()]
+    assert record.exc_info and record.exc_info[0] is KeyError
+    assert bot.tg.sent == ["حدث خطأ بسيط. حاول مرة أخرى لاحقًا."]
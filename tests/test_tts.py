@@ -0,0 +1,268 @@
+# tests/test_tts.py
+# -*- coding: utf-8 -*-
+import asyncio
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from services import tts
+from services.resilience import RetryLater
+from services.workers import WorkerPool
+
+
+class _Resp:
+    def __init__(self, status=200, content=b"OggS", headers=None):
+        self.status_code = status
+        self.content = content
+        self.text = ""
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        pass
+
+
+def test_synth_in_pool_schedules_retry_instead_of_sleeping(monkeypatch):
+    monkeypatch.setattr(tts.http_client, "post", lambda *a, **kw: _Resp(429, headers={"Retry-After": "5"}))
+    monkeypatch.setattr(tts.time, "sleep", lambda s: (_ for _ in ()).throw(AssertionError("slept")))
+    pool = WorkerPool(size=1, maxsize=0, name="test")
+    seen = []
+    done = threading.Event()
+
+    def task():
+        try:
+            tts.synth_eleven("ek-retry", "vid", f"نص {time.time()}")
+        except RetryLater as e:
+            seen.append(e.delay)
+        done.set()
+
+    pool.submit(task, key="k")
+    assert done.wait(5)
+    assert seen and seen[0] >= 5
+
+
+class _StreamResp:
+    """رد بث: يسجّل عدد المقاطع المقروءة وهل أُغلق."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.read = 0
+        self.closed = False
+
+    def iter_content(self, size):
+        for chunk in self.chunks:
+            self.read += 1
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+
+class _Breaker:
+    def __init__(self):
+        self.records = []
+
+    def allow(self):
+        return True
+
+    def record(self, ok, latency):
+        self.records.append(ok)
+
+
+def test_stream_client_error_counts_as_breaker_failure(monkeypatch):
+    br = _Breaker()
+    resp = _StreamResp([])
+    resp.status_code, resp.text = 401, "invalid api key"
+    monkeypatch.setattr(tts, "breaker", lambda *a: br)
+    monkeypatch.setattr(tts.http_client, "post", lambda *a, **kw: resp)
+
+    with pytest.raises(RuntimeError):
+        tts.stream_eleven("ek-bad", "vid", f"نص {time.time()}")
+    assert br.records == [False] and resp.closed
+
+
+def test_tee_close_does_not_drain_the_stream(tmp_path, monkeypatch):
+    monkeypatch.setattr(tts, "audio_cache", tts.AudioCache(disk_dir=str(tmp_path)))
+    r = _StreamResp([b"a"] * 100)
+    tee = tts._Tee(r, "cut")
+
+    assert next(iter(tee)) == b"a"  # الرفع توقف بعد المقطع الأول
+    tee.close()
+
+    assert r.closed and r.read == 1
+    assert tts.audio_cache.open("cut") is None
+    assert not list(tmp_path.rglob("*.tmp"))
+
+
+def test_tee_caches_a_complete_stream(tmp_path, monkeypatch):
+    monkeypatch.setattr(tts, "audio_cache", tts.AudioCache(disk_dir=str(tmp_path)))
+    r = _StreamResp([b"a", b"b"])
+    tee = tts._Tee(r, "full")
+
+    assert b"".join(tee) == b"ab"
+    tee.close()
+
+    assert r.closed
+    with tts.audio_cache.open("full") as fh:
+        assert fh.read() == b"ab"
+
+
+class _ThreadFile(io.BytesIO):
+    """ملف يسجّل الثريد الذي قُرئ منه."""
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.threads = set()
+
+    def read(self, size=-1):
+        self.threads.add(threading.get_ident())
+        return super().read(size)
+
+
+class _AStreamResp:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    async def aiter_bytes(self, size):
+        for chunk in self.chunks:
+            yield chunk
+
+    async def aclose(self):
+        self.closed = True
+
+
+def test_async_file_stream_reads_off_the_event_loop():
+    data = b"x" * (tts.TTS_STREAM_CHUNK * 2 + 1)
+    fh = _ThreadFile(data)
+
+    async def run():
+        chunks = [c async for c in tts._AFileStream(fh)]
+        return chunks, threading.get_ident()
+
+    chunks, loop_thread = asyncio.run(run())
+
+    assert b"".join(chunks) == data
+    assert fh.threads and loop_thread not in fh.threads
+    assert fh.closed
+
+
+def test_async_tee_caches_a_complete_stream(tmp_path, monkeypatch):
+    monkeypatch.setattr(tts, "audio_cache", tts.AudioCache(disk_dir=str(tmp_path)))
+    r = _AStreamResp([b"a", b"b"])
+
+    async def run():
+        tee = tts._ATee(r, "afull")
+        try:
+            return b"".join([c async for c in tee])
+        finally:
+            await tee.aclose()
+
+    assert asyncio.run(run()) == b"ab"
+    assert r.closed
+    with tts.audio_cache.open("afull") as fh:
+        assert fh.read() == b"ab"
+
+
+def test_cache_key_ignores_whitespace_but_not_voice():
+    k = tts.AudioCache.key
+    assert k("v1", {}, "مرحبا   بك\n") == k("v1", {}, " مرحبا بك")
+    assert k("v1", {}, "مرحبا") != k("v2", {}, "مرحبا")
+
+
+def test_cache_tiers_share_disk_across_workers(tmp_path):
+    a = tts.AudioCache(disk_dir=str(tmp_path))
+    b = tts.AudioCache(disk_dir=str(tmp_path))  # worker آخر: ذاكرة منفصلة وقرص مشترك
+    a.put("k", b"OggS-1")
+
+    assert a.get("k") == b"OggS-1" and a.hits_mem == 1
+    assert b.get("k") == b"OggS-1" and b.hits_disk == 1
+    assert b.get("k") == b"OggS-1" and b.hits_mem == 1  # رُفع إلى ذاكرة b
+    assert b.get("missing") is None and b.misses == 1
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = tts.AudioCache(mem_budget=10, disk_dir=str(tmp_path), disk_budget=10)
+    cache.put("a", b"1234")
+    cache.put("b", b"5678")
+    assert cache.get("a")  # a الأحدث استخدامًا الآن
+    cache.put("c", b"9012")
+
+    assert list(cache._mem) == ["a", "c"]
+    assert sum(p.stat().st_size for p in tmp_path.rglob("*.ogg")) <= 9  # القرص نزل إلى 90% من الميزانية
+
+
+def test_synth_hit_skips_elevenlabs(tmp_path, monkeypatch):
+    monkeypatch.setattr(tts, "audio_cache", tts.AudioCache(disk_dir=str(tmp_path)))
+    calls = []
+    monkeypatch.setattr(tts.http_client, "post", lambda *a, **kw: calls.append(1) or _Resp(content=b"OggS-x"))
+
+    assert tts.synth_eleven("ek", "vid", "أهلًا") == b"OggS-x"
+    assert tts.synth_eleven("ek", "vid", "أهلًا ") == b"OggS-x"
+    assert calls == [1]
+
+
+def test_split_sentences_keeps_first_chunk_short():
+    text = " ".join(f"هذه الجملة رقم {i} من الرد." for i in range(30))
+    chunks = tts.split_sentences(text, first=60, size=200)
+
+    assert len(chunks[0]) <= 60 and all(len(c) <= 200 for c in chunks[1:])
+    assert " ".join(chunks) == text
+    assert all(c.endswith(".") for c in chunks)  # القطع عند حدود الجمل
+    assert tts.split_sentences("رد قصير.", first=60, size=200) == ["رد قصير."]
+    long = tts.split_sentences("كلمة " * 100, first=60, size=50)  # جملة بلا نهاية تُقسم عند المسافات
+    assert len(long) > 1 and all(len(c) <= 50 for c in long)
+
+
+def test_synth_chunks_overlap_and_keep_order(monkeypatch):
+    started = []
+    release = threading.Event()
+
+    def fake_synth(api_key, voice_id, text, defer=False):
+        started.append(text)
+        if text == "1":
+            release.wait(5)  # المقطع الأول أبطأ من التالي
+        if text == "3":
+            raise RuntimeError("eleven down")
+        return text.encode()
+
+    monkeypatch.setattr(tts, "synth_eleven", fake_synth)
+    monkeypatch.setattr(tts, "TTS_PARALLEL", 2)
+    clips = tts.synth_chunks("ek", "vid", ["1", "2", "3"])
+
+    deadline = time.monotonic() + 5
+    while len(started) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sorted(started) == ["1", "2"]  # بدأ التوليد قبل أول next
+    release.set()
+    assert next(clips) == b"1" and next(clips) == b"2"
+    with pytest.raises(RuntimeError):
+        next(clips)
+
+
+def test_synth_chunks_close_before_first_next_cancels_pending(monkeypatch):
+    started = []
+    release = threading.Event()
+
+    def fake_synth(api_key, voice_id, text, defer=False):
+        started.append(text)
+        release.wait(5)
+        return text.encode()
+
+    pool = ThreadPoolExecutor(max_workers=1)  # المقطع الأول يشغل الثريد والبقية في الطابور
+    monkeypatch.setattr(tts, "_pool", lambda: pool)
+    monkeypatch.setattr(tts, "synth_eleven", fake_synth)
+    monkeypatch.setattr(tts, "TTS_PARALLEL", 3)
+    clips = tts.synth_chunks("ek", "vid", ["1", "2", "3", "4"])
+    deadline = time.monotonic() + 5
+    while not started and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    clips.close()  # كما يفعل وضع both حين يرمي إرسال النص RetryLater
+    release.set()
+    pool.shutdown(wait=True)
+
+    assert started == ["1"]
+    assert next(clips, None) is None
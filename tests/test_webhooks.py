@@ -0,0 +1,143 @@
+# tests/test_webhooks.py
+# -*- coding: utf-8 -*-
+import json
+import threading
+
+import pytest
+
+import app as app_module
+from services.dedup import dedup
+from services.workers import WorkerPool
+
+
+def _wa_payload(*messages, phone_id="555"):
+    return {"entry": [{"changes": [{"value": {
+        "metadata": {"phone_number_id": phone_id},
+        "messages": [{"id": mid, "from": sender, "type": "text", "text": {"body": body}}
+                     for mid, sender, body in messages],
+    }}]}]}
+
+
+class _Submit:
+    def __init__(self, reject_keys=()):
+        self.calls = []
+        self.reject_keys = set(reject_keys)
+
+    def __call__(self, fn, value, key=None):
+        if key in self.reject_keys:
+            return False
+        self.calls.append((key, [m["id"] for m in value["messages"]]))
+        return True
+
+
+def test_whatsapp_batch_is_split_per_sender():
+    sub = _Submit()
+    ok = app_module._enqueue_whatsapp(_wa_payload(
+        ("wamid.s1", "111", "أ"), ("wamid.s2", "222", "ب"), ("wamid.s3", "111", "ج"),
+    ), submit=sub, route=lambda value: None)
+    assert ok
+    assert sub.calls == [(("wa", "555", "111"), ["wamid.s1", "wamid.s3"]),
+                         (("wa", "555", "222"), ["wamid.s2"])]
+
+
+def test_rejected_sender_group_is_forgotten_only():
+    sub = _Submit(reject_keys={("wa", "555", "222")})
+    ok = app_module._enqueue_whatsapp(_wa_payload(
+        ("wamid.r1", "111", "أ"), ("wamid.r2", "222", "ب"),
+    ), submit=sub, route=lambda value: None)
+    assert not ok  # 503: Meta يعيد الإرسال
+    # إعادة الإرسال: رسالة المرسل المقبول مكررة، والمرفوضة تُعالج من جديد
+    assert not dedup.first_seen("wa:wamid.r1", "whatsapp")
+    assert dedup.first_seen("wa:wamid.r2", "whatsapp")
+
+
+def test_task_processes_only_messages_no_other_worker_claimed(monkeypatch):
+    """التكرار عبر الـ workers يُفحص داخل المهمة (SQLite دفعة واحدة)، وإعادة المحاولة لا تعيد الفحص."""
+    dedup.claim(["wa:wamid.c1"], "whatsapp")  # worker آخر عالجها
+    tasks, routed = [], []
+    ok = app_module._enqueue_whatsapp(
+        _wa_payload(("wamid.c1", "333", "أ"), ("wamid.c2", "333", "ب")),
+        submit=lambda fn, value, key=None: tasks.append((fn, value)) or True,
+        route=lambda value: routed.append([m["id"] for m in value["messages"]]))
+    assert ok and len(tasks) == 1
+
+    fn, value = tasks[0]
+    fn(value)
+    fn(value)  # RetryLater: نفس المهمة تُشغَّل مرة ثانية
+    assert routed == [["wamid.c2"], ["wamid.c2"]]
+
+
+class _SlowBot:
+    def __init__(self):
+        self.release = threading.Event()
+        self.handled = []
+
+    def process_update(self, payload):
+        self.release.wait(5)
+        self.handled.append(payload["update_id"])
+
+
+def _tg_update(update_id, chat_id=7):
+    return json.dumps({"update_id": update_id,
+                       "message": {"chat": {"id": chat_id}, "text": "مرحبا"}}).encode()
+
+
+def test_telegram_webhook_acks_before_the_reply_is_generated(monkeypatch):
+    bot = _SlowBot()
+    monkeypatch.setattr(app_module.manager, "get_bot", lambda bot_id: bot)
+    pool = WorkerPool(size=1, maxsize=10, name="test")
+
+    body, status = app_module.accept_telegram("b-ack", _tg_update(1), submit=pool.submit)
+    assert (status, body) == (200, {"ok": True})
+    assert bot.handled == []  # المعالجة ما زالت تنتظر في الخلفية
+
+    bot.release.set()
+    pool.join(5)
+    assert bot.handled == [1]
+
+
+def test_full_queue_returns_503_and_redelivery_is_processed(monkeypatch):
+    bot = _SlowBot()
+    bot.release.set()
+    monkeypatch.setattr(app_module.manager, "get_bot", lambda bot_id: bot)
+    tasks = []
+
+    _body, status = app_module.accept_telegram("b-busy", _tg_update(2), submit=lambda *a, **kw: False)
+    assert status == 503  # تيليجرام يعيد الإرسال لاحقًا
+
+    body, status = app_module.accept_telegram("b-busy", _tg_update(2),
+                                              submit=lambda fn, *a, **kw: tasks.append((fn, a)) or True)
+    assert (status, body) == (200, {"ok": True})  # ليست مكررة: الرفض ألغى تسجيلها
+    fn, args = tasks[0]
+    fn(*args)
+    assert bot.handled == [2]
+
+
+def _no_submit(*args, **kwargs):
+    raise AssertionError("status-only event reached the queue")
+
+
+def test_status_only_events_are_acked_without_queueing(monkeypatch):
+    events = []
+    monkeypatch.setattr(app_module, "_count_event", lambda platform, kind, n=1: events.append((platform, kind, n)))
+    monkeypatch.setattr(app_module.manager, "get_bot", lambda bot_id: pytest.fail("bot lookup for a non-message"))
+
+    wa = {"entry": [{"changes": [{"value": {"metadata": {"phone_number_id": "555"},
+                                            "statuses": [{"id": "s1", "status": "read"}, {"id": "s2"}]}}]}]}
+    ig = {"entry": [{"id": "ig-1", "changes": [{"value": {"messaging": [
+        {"sender": {"id": "u"}, "recipient": {"id": "ig-1"}, "message": {"mid": "e1", "is_echo": True}},
+        {"sender": {"id": "u"}, "recipient": {"id": "ig-1"}, "read": {"mid": "e0"}}]}}]}]}
+
+    assert app_module.accept_meta("whatsapp", json.dumps(wa).encode(), "", submit=_no_submit) == ({"ok": True}, 200)
+    assert app_module.accept_meta("instagram", json.dumps(ig).encode(), "", submit=_no_submit) == ({"ok": True}, 200)
+    tg = json.dumps({"update_id": 5, "my_chat_member": {"chat": {"id": 1}}}).encode()
+    assert app_module.accept_telegram("b-status", tg, submit=_no_submit) == ({"ok": True}, 200)
+
+    assert events == [("whatsapp", "status", 2), ("instagram", "echo", 1), ("instagram", "read", 1),
+                      ("telegram", "my_chat_member", 1)]
+
+
+def test_garbage_body_is_acked_as_empty():
+    assert app_module.parse_json(b"[1, 2]") == {}
+    assert app_module.parse_json(b"not json") == {}
+    assert app_module.accept_meta("whatsapp", b"not json", "", submit=_no_submit) == ({"ok": True}, 200)
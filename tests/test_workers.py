@@ -0,0 +1,100 @@
+# tests/test_workers.py
+# -*- coding: utf-8 -*-
+import threading
+
+from services import workers
+from services.resilience import RetryLater
+from services.workers import WorkerPool, current_attempt, final_attempt
+
+
+def test_retry_keeps_per_key_fifo_order():
+    """مهمة ترمي RetryLater تعود لرأس طابور مفتاحها: ما بعدها لا يسبقها."""
+    pool = WorkerPool(size=4, maxsize=0, name="test")
+    done = []
+    finished = threading.Event()
+    attempts = []
+
+    def task(i):
+        if i == 1 and len(attempts) < 2:
+            attempts.append(current_attempt())
+            raise RetryLater(0.05, "test")
+        done.append(i)
+        if len(done) == 5:
+            finished.set()
+
+    for i in range(5):
+        assert pool.submit(task, i, key=("bot", "chat"))
+
+    assert finished.wait(5)
+    assert done == [0, 1, 2, 3, 4]
+    assert attempts == [0, 1]
+    assert pool.stats()["retries"] == 2
+
+
+def test_rate_limit_retry_does_not_count_attempt():
+    pool = WorkerPool(size=2, maxsize=0, name="test")
+    seen = []
+    finished = threading.Event()
+
+    def task():
+        seen.append(current_attempt())
+        if len(seen) < 3:
+            raise RetryLater(0.01, "429", count_attempt=False)
+        finished.set()
+
+    pool.submit(task, key="k")
+    assert finished.wait(5)
+    assert seen == [0, 0, 0]
+
+
+def test_endless_rate_limit_stops_after_max_defer(monkeypatch):
+    """429 متكرر بدون عدّ المحاولات لا يحجز المحادثة للأبد: تشغيل أخير ثم تُترك المهمة."""
+    monkeypatch.setattr(workers, "TASK_MAX_DEFER_S", 0.2)
+    pool = WorkerPool(size=1, maxsize=0, name="test")
+    finals = []
+    after = threading.Event()
+
+    def task():
+        finals.append(final_attempt())
+        raise RetryLater(0.05, "429", count_attempt=False)
+
+    pool.submit(task, key="k")
+    pool.submit(after.set, key="k")
+    assert after.wait(5)
+    assert finals[-1] is True and not any(finals[:-1])
+    assert pool.stats()["failed"] == 1
+
+
+def test_final_attempt_on_last_counted_attempt(monkeypatch):
+    monkeypatch.setattr(workers, "TASK_MAX_ATTEMPTS", 3)
+    pool = WorkerPool(size=1, maxsize=0, name="test")
+    finals = []
+    finished = threading.Event()
+
+    def task():
+        finals.append((current_attempt(), final_attempt()))
+        if final_attempt():
+            finished.set()  # هنا يرجع المستدعي الرد الاحتياطي بدل RetryLater
+            return
+        raise RetryLater(0.01, "503")
+
+    pool.submit(task, key="k")
+    assert finished.wait(5)
+    assert finals == [(0, False), (1, False), (2, True)]
+
+
+def test_join_waits_for_queued_and_deferred_tasks():
+    pool = WorkerPool(size=1, maxsize=0, name="test")
+    done = []
+
+    def task(i):
+        if i == 0 and not done:
+            done.append("retry")
+            raise RetryLater(0.05, "test")
+        done.append(i)
+
+    for i in range(3):
+        pool.submit(task, i, key="k")
+    assert pool.join(5)
+    assert done == ["retry", 0, 1, 2]
+    assert WorkerPool(name="unused").join(0)